@@ -60,6 +60,7 @@ setup(
     zip_safe=False,
     extras_require={
         'testing': tests_require,
+        'redis': ['redis'],
     },
     install_requires=requires,
     entry_points={
@@ -70,6 +71,9 @@ setup(
             'initialize_systems_api_db=systems_api.scripts.initialize_db:main',
             'generate_heatmap=systems_api.scripts.generate_heatmap:main',
             'load_edsmstations=systems_api.scripts.load_edsmstations:main',
+            'cluster_systems_api_db=systems_api.scripts.cluster_tables:main',
+            'build_typeahead_snapshot=systems_api.scripts.build_typeahead:main',
+            'build_known_ids_snapshot=systems_api.scripts.build_known_ids:main',
         ],
     },
 )
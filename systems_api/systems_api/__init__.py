@@ -10,6 +10,10 @@ def main(global_config, **settings):
         config.include('.models')
         config.include('pyramid_jinja2')
         config.include('.routes')
+        config.include('.utils.spatial')
+        config.include('.utils.prefixindex')
+        config.include('.utils.cache')
+        config.include('.utils.metrics')
         config.registry.settings['pyramid_jsonapi.pagination.max_page_size'] = 100
         config.scan()
         pj = pyramid_jsonapi.PyramidJSONAPI(config, models)
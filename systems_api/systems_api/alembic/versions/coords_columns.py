@@ -0,0 +1,41 @@
+"""Numeric coordinate columns with a spatial index on systems
+
+Revision ID: coords_columns
+Revises: add_carrier
+Create Date: 2026-10-18 10:12:04.118306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'coords_columns'
+down_revision = 'add_carrier'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS cube')
+    for axis in ('x', 'y', 'z'):
+        op.add_column('systems', sa.Column(axis, sa.Float(),
+                                           sa.Computed(f"(coords->>'{axis}')::double precision", persisted=True),
+                                           nullable=True))
+    # The jsonb_path_ops GIN indexes on the coords blob can't serve range filters.
+    op.execute('DROP INDEX IF EXISTS system_idx_coords_x')
+    op.execute('DROP INDEX IF EXISTS system_idx_coords_y')
+    op.execute('DROP INDEX IF EXISTS system_idx_coords_z')
+    # cube() rejects NULLs, so systems without coordinates are left out of the index.
+    op.create_index('system_idx_coords_cube', 'systems', [sa.text('cube(array[x, y, z])')], unique=False,
+                    postgresql_using='gist', postgresql_where=sa.text('x IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('system_idx_coords_cube', table_name='systems')
+    op.drop_column('systems', 'z')
+    op.drop_column('systems', 'y')
+    op.drop_column('systems', 'x')
+    op.execute("CREATE INDEX IF NOT EXISTS system_idx_coords_x ON systems USING gin ((coords->'x') jsonb_path_ops)")
+    op.execute("CREATE INDEX IF NOT EXISTS system_idx_coords_y ON systems USING gin ((coords->'y') jsonb_path_ops)")
+    op.execute("CREATE INDEX IF NOT EXISTS system_idx_coords_z ON systems USING gin ((coords->'z') jsonb_path_ops)")
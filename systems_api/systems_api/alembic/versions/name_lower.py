@@ -0,0 +1,25 @@
+"""Functional lower(name) index for case-insensitive lookups
+
+Revision ID: name_lower
+Revises: systems_date
+Create Date: 2026-10-18 14:31:52.617204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'name_lower'
+down_revision = 'systems_date'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # text_pattern_ops lets the same index serve LIKE 'prefix%' as well as equality, whatever the collation.
+    op.create_index('system_idx_name_lower', 'systems', [sa.text('lower(name) text_pattern_ops')], unique=False)
+
+
+def downgrade():
+    op.drop_index('system_idx_name_lower', table_name='systems')
@@ -0,0 +1,37 @@
+"""Stored phonetic key columns on systems
+
+Revision ID: phonetic_keys
+Revises: name_lower
+Create Date: 2026-10-18 15:12:40.274913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'phonetic_keys'
+down_revision = 'name_lower'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS fuzzystrmatch')
+    # The indexes revision created these as plain btrees on name (postgres_ops is not an option Alembic
+    # knows), so they never served phonetic lookups. Replace them with indexes on the stored keys.
+    op.execute('DROP INDEX IF EXISTS system_idx_name_soundex')
+    op.execute('DROP INDEX IF EXISTS system_idx_name_dmetaphone')
+    op.add_column('systems', sa.Column('name_soundex', sa.Text(), sa.Computed('soundex(name)', persisted=True),
+                                       nullable=True))
+    op.add_column('systems', sa.Column('name_dmetaphone', sa.Text(),
+                                       sa.Computed('dmetaphone(name)', persisted=True), nullable=True))
+    op.create_index('system_idx_name_soundex', 'systems', ['name_soundex'], unique=False)
+    op.create_index('system_idx_name_dmetaphone', 'systems', ['name_dmetaphone'], unique=False)
+
+
+def downgrade():
+    op.drop_index('system_idx_name_dmetaphone', table_name='systems')
+    op.drop_index('system_idx_name_soundex', table_name='systems')
+    op.drop_column('systems', 'name_dmetaphone')
+    op.drop_column('systems', 'name_soundex')
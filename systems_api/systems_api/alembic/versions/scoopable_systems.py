@@ -0,0 +1,41 @@
+"""Derived table of systems with scoopable stars
+
+Revision ID: scoopable_systems
+Revises: coords_columns
+Create Date: 2026-10-18 11:03:41.520917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'scoopable_systems'
+down_revision = 'coords_columns'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('scoopable_systems',
+                    sa.Column('id64', sa.BigInteger(), nullable=False),
+                    sa.Column('name', sa.Text(), nullable=True),
+                    sa.Column('x', sa.Float(), nullable=True),
+                    sa.Column('y', sa.Float(), nullable=True),
+                    sa.Column('z', sa.Float(), nullable=True),
+                    sa.PrimaryKeyConstraint('id64', name=op.f('pk_scoopable_systems'))
+    )
+    op.execute('''
+        INSERT INTO scoopable_systems (id64, name, x, y, z)
+        SELECT systems.id64, systems.name, systems.x, systems.y, systems.z
+        FROM systems
+        WHERE systems.x IS NOT NULL
+          AND EXISTS (SELECT 1 FROM stars WHERE stars."systemId64" = systems.id64 AND stars."isScoopable")
+    ''')
+    op.create_index('scoopable_idx_coords_cube', 'scoopable_systems', [sa.text('cube(array[x, y, z])')],
+                    unique=False, postgresql_using='gist')
+
+
+def downgrade():
+    op.drop_index('scoopable_idx_coords_cube', table_name='scoopable_systems')
+    op.drop_table('scoopable_systems')
@@ -0,0 +1,48 @@
+"""Spatial clustering key for systems, stars and bodies
+
+Revision ID: spatial_key
+Revises: scoopable_systems
+Create Date: 2026-10-18 13:21:47.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'spatial_key'
+down_revision = 'scoopable_systems'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Morton key of an ID64's boxel at mass code a resolution, see utils.util.id64_spatial_key.
+    op.execute('''
+        CREATE OR REPLACE FUNCTION id64_spatial_key(id64 bigint) RETURNS bigint AS $$
+        DECLARE
+            mc int := id64 & 7;
+            vx bigint := ((id64 >> (30 - 2 * mc)) & ((1::bigint << (14 - mc)) - 1)) << mc;
+            vy bigint := ((id64 >> (17 - mc)) & ((1::bigint << (13 - mc)) - 1)) << mc;
+            vz bigint := ((id64 >> 3) & ((1::bigint << (14 - mc)) - 1)) << mc;
+            output bigint := 0;
+        BEGIN
+            FOR i IN 0..13 LOOP
+                output := output | (((vx >> i) & 1) << (i * 3))
+                                 | (((vy >> i) & 1) << (i * 3 + 1))
+                                 | (((vz >> i) & 1) << (i * 3 + 2));
+            END LOOP;
+            RETURN output;
+        END
+        $$ LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE
+    ''')
+    op.create_index('system_idx_spatial_key', 'systems', [sa.text('id64_spatial_key(id64)')], unique=False)
+    op.create_index('star_idx_spatial_key', 'stars', [sa.text('id64_spatial_key("systemId64")')], unique=False)
+    op.create_index('body_idx_spatial_key', 'bodies', [sa.text('id64_spatial_key("systemId64")')], unique=False)
+
+
+def downgrade():
+    op.drop_index('body_idx_spatial_key', table_name='bodies')
+    op.drop_index('star_idx_spatial_key', table_name='stars')
+    op.drop_index('system_idx_spatial_key', table_name='systems')
+    op.execute('DROP FUNCTION IF EXISTS id64_spatial_key(bigint)')
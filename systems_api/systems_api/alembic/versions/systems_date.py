@@ -0,0 +1,28 @@
+"""Insertion timestamp on systems for typeahead delta updates
+
+Revision ID: systems_date
+Revises: spatial_key
+Create Date: 2026-10-18 14:02:19.388741
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'systems_date'
+down_revision = 'spatial_key'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Added without a default first, so existing rows are left NULL instead of rewriting the table.
+    op.add_column('systems', sa.Column('inserted', sa.DateTime(timezone=True), nullable=True))
+    op.alter_column('systems', 'inserted', server_default=sa.func.now())
+    op.create_index('system_idx_inserted', 'systems', ['inserted'], unique=False)
+
+
+def downgrade():
+    op.drop_index('system_idx_inserted', table_name='systems')
+    op.drop_column('systems', 'inserted')
@@ -1,3 +1,6 @@
+import collections
+import queue
+import threading
 import zlib
 import transaction
 import zmq
@@ -19,10 +22,11 @@ from pyramid.paster import (
 )
 
 from pyramid.scripts.common import parse_vars
+from pyramid.settings import asbool
 from sqlalchemy import func
-from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.orm.exc import StaleDataError
-from zope.sqlalchemy import mark_changed
 
 
 from systems_api.models import (
@@ -37,6 +41,11 @@ from systems_api.models.stats import Stats
 from systems_api.models.body import Body
 from systems_api.models.carrier import Carrier
 from systems_api.models.station import Station
+from systems_api.models.scoopablesystem import upsert_scoopable_many_sql
+from systems_api.utils.batchwriter import BatchWriter, TableBatch
+from systems_api.utils.knownids import load_known_ids
+from systems_api.utils.framelog import FrameLog, read_frames
+from systems_api.utils.pipeline import STOP, StageStats, feed, start_stage
 
 __relayEDDN = 'tcp://eddn.edcd.io:9500'
 __timeoutEDDN = 600000
@@ -166,6 +175,229 @@ def update_complete(future):
           f"                      Update completed: {datetime.now()}!\r", end='')
 
 
+def services(data):
+    """
+    Reads the service flags of a station or carrier from a Docked or CarrierJump event.
+    :param data: The event
+    :return: Dict of haveMarket, haveShipyard and haveOutfitting columns
+    """
+    return {'haveMarket': 'commodities' in data['StationServices'],
+            'haveShipyard': 'shipyard' in data['StationServices'],
+            'haveOutfitting': 'outfitting' in data['StationServices']}
+
+
+def carrier_row(data):
+    return dict(callsign=data['StationName'], marketId=data['MarketID'], name=data['StationName'],
+                updateTime=data['timestamp'], systemName=data['StarSystem'], systemId64=data['SystemAddress'],
+                **services(data))
+
+
+def station_row(data):
+    return dict(id64=data['MarketID'], name=data['StationName'], distanceToArrival=data['DistFromStarLS'],
+                government=data['StationGovernment'], economy=data['StationEconomy'],
+                otherServices=data['StationServices'], updateTime=data['timestamp'],
+                systemId64=data['SystemAddress'], systemName=data['StarSystem'],
+                stationState=data['StationState'] if 'StationState' in data else None, **services(data))
+
+
+def system_row(data):
+    return dict(id64=data['SystemAddress'], name=data['StarSystem'],
+                coords={'x': data['StarPos'][0], 'y': data['StarPos'][1], 'z': data['StarPos'][2]},
+                date=data['timestamp'],
+                systemAllegiance=data['SystemAllegiance'] if 'SystemAllegiance' in data else None)
+
+
+def star_row(data):
+    return dict(id64=data['SystemAddress'] + (data['BodyID'] << 55), bodyId=data['BodyID'], name=data['BodyName'],
+                age=data['Age_MY'], axialTilt=data['AxialTilt'],
+                orbitalEccentricity=data['Eccentricity'] if 'Eccentricity' in data else None,
+                orbitalInclination=data['OrbitalInclination'] if 'OrbitalInclination' in data else None,
+                orbitalPeriod=data['OrbitalPeriod'] if 'OrbitalPeriod' in data else None,
+                parents=data['Parents'] if 'Parents' in data else None,
+                argOfPeriapsis=data['Periapsis'] if 'Periapsis' in data else None,
+                belts=data['Rings'] if 'Rings' in data else None,
+                semiMajorAxis=data['SemiMajorAxis'] if 'SemiMajorAxis' in data else None,
+                systemName=data['StarSystem'], distanceToArrival=data['DistanceFromArrivalLS'],
+                luminosity=data['Luminosity'], solarRadius=data['Radius'],
+                rotationalPeriod=data['RotationPeriod'], type=data['StarType'],
+                solarMasses=data['StellarMass'], subType=data['Subclass'] if 'Subclass' in data else None,
+                surfaceTemperature=data['SurfaceTemperature'], isScoopable=data['StarType'] in __scoopable,
+                isMainStar=data['BodyID'] == 0, updateTime=data['timestamp'], systemId64=data['SystemAddress'])
+
+
+class ScoopableBatch(object):
+    """
+    Copies the systems of scoopable stars into scoopable_systems, for a BatchWriter.
+    """
+    key = 'id64'
+
+    def statement(self, rows):
+        return upsert_scoopable_many_sql.bindparams(id64s=[row['id64'] for row in rows])
+
+
+# Tables in the order they are written, so systems exist before the stars, stations and carriers in them.
+batch_tables = collections.OrderedDict([
+    ('systems', TableBatch(System.__table__, 'id64', keep=('systemAllegiance',), newest='date')),
+    ('stars', TableBatch(Star.__table__, 'id64', newest='updateTime')),
+    ('scoopable_systems', ScoopableBatch()),
+    ('stations', TableBatch(Station.__table__, 'id64',
+                            update=('updateTime', 'systemName', 'systemId64', 'haveShipyard', 'haveOutfitting',
+                                    'haveMarket'),
+                            keep=('stationState',), newest='updateTime')),
+    ('carriers', TableBatch(Carrier.__table__, 'callsign',
+                            update=('marketId', 'systemName', 'systemId64', 'haveShipyard', 'haveOutfitting',
+                                    'haveMarket', 'updateTime'), newest='updateTime')),
+])
+
+
+def queue_event(writer, data, known=None):
+    """
+    Turns a journal event into rows for the batch writer.
+    :param writer: The BatchWriter
+    :param data: The event
+    :param known: Dict of table name to KnownIds, to skip systems and stars already in the database
+    :return: Number of rows queued
+    :raises KeyError: If the event lacks a field we need
+    """
+    if 'event' not in data:
+        return 0
+    rows = []
+    if data['event'] in {'Docked', 'CarrierJump'}:
+        if 'StationType' in data and data['StationType'] == 'FleetCarrier':
+            rows.append(('carriers', carrier_row(data)))
+        else:
+            rows.append(('stations', station_row(data)))
+    # TODO: Handle other detail Carrier events, such as Stats.
+    if data['event'] == 'FSDJump':
+        system = system_row(data)
+        # Known systems only need writing to update their allegiance.
+        if not known or system['systemAllegiance'] is not None or system['id64'] not in known['systems']:
+            rows.append(('systems', system))
+    if data['event'] == 'Scan' and 'AbsoluteMagnitude' in data:
+        star = star_row(data)
+        if not known or star['id64'] not in known['stars']:
+            rows.append(('stars', star))
+            if star['isScoopable']:
+                rows.append(('scoopable_systems', {'id64': star['systemId64']}))
+    # Only queue once the whole event has been read, so a bad event never leaves half its rows behind.
+    for name, row in rows:
+        writer.add(name, row)
+    return len(rows)
+
+
+def add_missing_system(session, name, row, error):
+    """
+    Handles a row the database rejected in a batch. Stars of systems we don't know yet get their system
+    added from EDSM, after which the star is retried.
+    :return: True to retry the row
+    """
+    if name != 'stars' or not isinstance(error, IntegrityError):
+        print(f"Failed to add {name} row {row.get('name')}: {error.orig}")
+        return False
+    try:
+        r = requests.get(f"{__EDSM_url}/systems", params={'systemName': row['systemName'], 'showId': 1,
+                                                           'showCoordinates': 1, 'showInformation': 1}).json()[0]
+        with session.begin_nested():
+            session.execute(insert(System.__table__).values(id64=r['id64'], name=r['name'], coords=r['coords']).
+                            on_conflict_do_nothing(index_elements=['id64']))
+        return True
+    except (IntegrityError, KeyError, IndexError, ValueError, requests.RequestException):
+        print("Failed to add system during missing star handling. Bah. Give up.")
+        return False
+
+
+def receive(context, frames, stats, proxy=None, relay=__relayEDDN, log=None):
+    """
+    Moves raw frames from EDDN onto a queue, reconnecting on errors and after a long silence. Runs in its
+    own thread, so the socket is drained however slow the database is.
+    :param context: The ZMQ context
+    :param frames: Queue for the compressed frames, or None to only log them
+    :param stats: The StageStats
+    :param proxy: XMLRPC proxy for error reports, if any
+    :param relay: Address of the EDDN relay, or of a local stand-in
+    :param log: FrameLog every frame is appended to, if any
+    """
+    subscriber = context.socket(zmq.SUB)
+    subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+    subscriber.setsockopt(zmq.RCVTIMEO, __timeoutEDDN)
+    while True:
+        try:
+            subscriber.connect(relay)
+            while True:
+                __message = subscriber.recv()
+                if not __message:
+                    subscriber.disconnect(relay)
+                    break
+                stats.count('received')
+                if log:
+                    log.write(__message, time.time())
+                if frames is not None:
+                    feed(frames, __message, stats, 'frames')
+        except zmq.ZMQError as e:
+            print('ZMQSocketException: ' + str(e))
+            if proxy:
+                try:
+                    proxy.command("botserv", "Absolver", f"say #rattech [\x0315SAPI\x03] EDDN error: "
+                                                         f"Exiting due to exception: {str(e)}")
+                except (ProtocolError, TimeoutError, OSError) as e:
+                    print(f"Failed to send error message to XMLRPC. {e}")
+            sys.stdout.flush()
+            subscriber.disconnect(relay)
+            time.sleep(5)
+
+
+def replay(path, frames, stats, parsers, messages_queue):
+    """
+    Feeds frames from a frame log instead of EDDN, as fast as they can be handled. Once all are decoded,
+    STOP is put on the message queue.
+    :param path: A log file, or a directory of them
+    :param frames: Queue for the compressed frames
+    :param stats: The StageStats
+    :param parsers: The parse stage's threads
+    :param messages_queue: Queue of decoded messages
+    """
+    for _, frame in read_frames(path):
+        stats.count('received')
+        feed(frames, frame, stats, 'frames')
+    frames.put(STOP)
+    for parser in parsers:
+        parser.join()
+    messages_queue.put(STOP)
+
+
+def serve(path, address, realtime=False):
+    """
+    Publishes the frames in a frame log over ZMQ, standing in for the EDDN relay in tests. Point another
+    client's eddn.relay setting at the address.
+    :param path: A log file, or a directory of them
+    :param address: Address to bind to, e.g. tcp://127.0.0.1:9500
+    :param realtime: Keep the gaps between frames as they were recorded, rather than sending at full speed
+    """
+    publisher = zmq.Context().socket(zmq.PUB)
+    publisher.bind(address)
+    # Subscribers miss whatever is published before they have connected.
+    time.sleep(1)
+    last = None
+    sent = 0
+    for timestamp, frame in read_frames(path):
+        if realtime and last is not None and timestamp > last:
+            time.sleep(timestamp - last)
+        last = timestamp
+        publisher.send(frame)
+        sent += 1
+    print(f"Published {sent} frames.")
+    publisher.close(linger=-1)
+
+
+def decode(frame):
+    """
+    Decompresses and parses an EDDN frame.
+    :param frame: The compressed frame
+    :return: The message as a dict
+    """
+    return simplejson.loads(zlib.decompress(frame))
+
+
 def usage(argv):
     """
     Prints usage helpstring.
@@ -173,7 +405,11 @@ def usage(argv):
     """
     cmd = os.path.basename(argv[0])
     print('usage: %s <config_uri> [var=value]\n'
-          '(example: "%s development.ini")' % (cmd, cmd))
+          '(example: "%s development.ini")\n'
+          'Add record_only=true to only append frames to the eddn.log_dir frame log, or replay=<file or directory>\n'
+          'to write the frames in a frame log instead of listening to EDDN. serve=<file or directory> publishes\n'
+          'a frame log on bind=<address> (default tcp://127.0.0.1:9500) as a stand-in EDDN relay, paced as\n'
+          'recorded with realtime=true.' % (cmd, cmd))
     sys.exit(1)
 
 
@@ -191,18 +427,57 @@ def main(argv=None):
     engine = get_engine(settings)
     session_factory = get_session_factory(engine)
     session = get_tm_session(session_factory, transaction.manager)
-    if 'xml_proxy' in settings:
+    if options.get('serve'):
+        serve(options['serve'], options.get('bind', 'tcp://127.0.0.1:9500'), asbool(options.get('realtime', False)))
+        return
+    replay_path = options.get('replay')
+    if 'xml_proxy' in settings and not replay_path:
         serverurl = settings['xml_proxy']
         proxy = ServerProxy(serverurl)
+    relay = settings.get('eddn.relay', __relayEDDN)
+    log = None
+    if settings.get('eddn.log_dir') and not replay_path:
+        log = FrameLog(settings['eddn.log_dir'], int(settings.get('eddn.log_max_mb', 256)) * 1024 * 1024,
+                       int(settings.get('eddn.log_keep', 0)))
+    if asbool(options.get('record_only', False)):
+        if not log:
+            print("record_only needs an eddn.log_dir setting to record to.")
+            sys.exit(1)
+        print(f"Recording EDDN frames to {settings['eddn.log_dir']}.")
+        receive(zmq.Context(), None, StageStats(), proxy, relay, log)
 
-    context = zmq.Context()
-    subscriber = context.socket(zmq.SUB)
-
-    subscriber.setsockopt(zmq.SUBSCRIBE, b"")
-    subscriber.setsockopt(zmq.RCVTIMEO, __timeoutEDDN)
     starttime = time.time()
     lasthourly = time.time() - 3700  # Ensure we start by running the hourly once.
 
+    known = None
+    if settings.get('eddn.known_ids') or asbool(settings.get('eddn.known_ids_preload', False)):
+        start = time.time()
+        known = load_known_ids(settings.get('eddn.known_ids'), session)
+        transaction.abort()
+        print(f"Loaded {len(known['systems'])} known systems and {len(known['stars'])} known stars in "
+              f"{time.time() - start:.1f} seconds.")
+
+    def remember(name, keys):
+        if known and name in known:
+            known[name].add(keys)
+
+    writer = BatchWriter(session, batch_tables, max_rows=int(settings.get('eddn.batch_size', 500)),
+                         max_delay=float(settings.get('eddn.batch_delay', 0.25)), on_failed=add_missing_system,
+                         on_written=remember)
+
+    def flush():
+        nonlocal syscount, starcount, stationcount, failstar, failstation
+        try:
+            written = writer.flush()
+        except (DBAPIError, StaleDataError) as e:
+            print(f"Failed to write a batch: {e}")
+            return
+        syscount += written['systems'].inserted if 'systems' in written else 0
+        starcount += written['stars'].inserted if 'stars' in written else 0
+        stationcount += written['stations'].inserted if 'stations' in written else 0
+        failstar += writer.failed.pop('stars', 0)
+        failstation += writer.failed.pop('stations', 0) + writer.failed.pop('carriers', 0)
+
     messages = 0
     syscount = 0
     starcount = 0
@@ -218,271 +493,108 @@ def main(argv=None):
             print(f"Failed to send start message to XMLRPC. {e.errmsg}")
         except TimeoutError as e:
             print(f"Failed to send start message to XMLRPC. {e.strerror}")
-    while True:
-        try:
-            subscriber.connect(__relayEDDN)
 
-            while True:
-                __message = subscriber.recv()
-
-                if not __message:
-                    subscriber.disconnect(__relayEDDN)
-                    break
+    # Receiving, decoding and writing run in separate stages, so a slow write never holds up the socket.
+    frames = queue.Queue(maxsize=int(settings.get('eddn.queue_size', 10000)))
+    messages_queue = queue.Queue(maxsize=int(settings.get('eddn.queue_size', 10000)))
+    stats = StageStats()
+    parsers = start_stage('parse', decode, frames, messages_queue, 'messages', stats,
+                          threads=int(settings.get('eddn.parser_threads', 1)))
+    if replay_path:
+        threading.Thread(target=replay, args=(replay_path, frames, stats, parsers, messages_queue),
+                         name='replay', daemon=True).start()
+    else:
+        threading.Thread(target=receive, args=(zmq.Context(), frames, stats, proxy, relay, log), name='receive',
+                         daemon=True).start()
+    started = time.time()
 
-                __message = zlib.decompress(__message)
-                __json = simplejson.loads(__message)
-                totmsg = totmsg + 1
-                print(f"EDDN Client running. Messages: {messages:10} Stars: {starcount:10} Systems: {syscount:10} "
-                      f" Stations: {stationcount:5} Missing systems: {failstar+failstation:10}\r",
-                      end='')
-                if validsoftware(__json['header']['softwareName'], __json['header']['softwareVersion']) \
-                        and __json['$schemaRef'] in __allowedSchema:
-                    hmessages = hmessages + 1
-                    if proxy:
-                        if time.time() > (starttime + 3600 * 24):
-                            try:
-                                session = get_tm_session(session_factory, transaction.manager)
-                                startot = session.query(func.count(Star.id64)).scalar()
-                                systot = session.query(func.count(System.id64)).scalar()
-                                proxy.command("botserv", "Absolver", f"say #ratchat [\x0315SAPI\x03] Daily report: "
-                                                                     f"{'{:,}'.format(messages)} messages processed"
-                                                                     f", {'{:,}'.format(syscount)} new systems,"
-                                                                     f"  {'{:,}'.format(starcount)} new stars."
-                                                                     f" DB contains {'{:,}'.format(startot)} stars "
-                                                                     f"and {'{:,}'.format(systot)} systems.")
-                                messages = 0
-                                syscount = 0
-                                starcount = 0
-                                failstar = 0
-                                stationcount = 0
-                                failstation = 0
-                                starttime = time.time()
-                            except TimeoutError:
-                                print("XMLRPC call failed due to timeout, retrying in 320 seconds.")
-                                starttime = starttime + 320
-                            except ProtocolError as e:
-                                print(f"XMLRPC call failed, skipping this update. {e.errmsg}")
-                                starttime = time.time()
-                        if time.time() > (lasthourly + 3600):
-                            # print("Running stats update...")
-                            loop = asyncio.get_event_loop()
-                            future = asyncio.Future()
-                            asyncio.ensure_future(update_stats(session, future))
-                            future.add_done_callback(update_complete)
-                            try:
-                                loop.run_until_complete(future)
-                                proxy.command(f"botserv", "Absolver", f"say #announcerdev [\x0315SAPI\x03] "
-                                                                      f"Hourly report: {hmessages} messages, "
-                                                                      f"{totmsg - hmessages} ignored.")
-                                lasthourly = time.time()
-                                hmessages = 0
-                                totmsg = 0
-                            except TimeoutError:
-                                print("XMLRPC call failed due to timeout, retrying in one hour.")
-                                lasthourly = time.time() + 3600
-                            except ProtocolError as e:
-                                print(f"XMLRPC call failed, skipping this update. {e.errmsg}")
-                                lasthourly = time.time()
-
-                    data = __json['message']
-                    messages = messages + 1
-                    if 'event' in data:
-                        if data['event'] in {'Docked', 'CarrierJump'}:
-                            if 'StationType' in data and data['StationType'] == 'FleetCarrier':
-                                try:
-                                    oldcarrier = session.query(Carrier).filter(Carrier.callsign
-                                                                               == data['StationName']).one_or_none()
-                                    # Consistency?! What's that? Bah.
-                                    if oldcarrier:
-                                        oldcarrier.marketId = data['MarketID']
-                                        oldcarrier.systemName = data['StarSystem']
-                                        oldcarrier.systemId64 = data['SystemAddress']
-                                        oldcarrier.haveShipyard = True if 'shipyard' in data['StationServices'] \
-                                            else False
-                                        oldcarrier.haveOutfitting = True if 'outfitting' in data[
-                                            'StationServices'] else False
-                                        oldcarrier.haveMarket = True if 'commodities' in data['StationServices'] \
-                                            else False
-                                        oldcarrier.updateTime = data['timestamp']
-                                    elif 'StationType' in data and data['StationType'] != 'FleetCarrier':
-                                        newcarrier = Carrier(callsign=data['StationName'], marketId=data['MarketID'],
-                                                             name=data['StationName'], updateTime=data['timestamp'],
-                                                             systemName=data['StarSystem'],
-                                                             systemId64=data['SystemAddress'],
-                                                             haveShipyard=True if 'shipyard' in data['StationServices']
-                                                             else False,
-                                                             haveOutfitting=True if 'outfitting' in data['StationServices']
-                                                             else False,
-                                                             haveMarket=True if 'commodities' in data['StationServices']
-                                                             else False
-                                                             )
-                                        session.add(newcarrier)
-                                    transaction.commit()
-                                except DataError as e:
-                                    print(f"Failed to add a carrier! Invalid data passed: {e}")
-                                    transaction.abort()
-                                except KeyError as e:
-                                    print(f"Invalid key in carrier data: {e}")
-                                    print(data)
-                                    print(
-                                        f"Software: {__json['header']['softwareName']} "
-                                        f"{__json['header']['softwareVersion']}")
-                                    transaction.abort()
-                            else:
-                                try:
-                                    #print(f"Got a station: {data}")
-                                    # Station data, check if exists.
-                                    oldstation = session.query(Station).filter(Station.name == data['StationName']).\
-                                        filter(Station.systemName == data['StarSystem']).one_or_none()
-                                    if oldstation:
-                                        # print(f"Updating station {data['StationName']}")
-                                        oldstation.updateTime = data['timestamp']
-                                        oldstation.systemName = data['StarSystem']
-                                        oldstation.systemId64 = data['SystemAddress']
-                                        oldstation.haveShipyard = True if 'shipyard' in data['StationServices'] \
-                                            else False
-                                        oldstation.haveOutfitting = True if 'outfitting' in data['StationServices'] \
-                                            else False
-                                        oldstation.haveMarket = True if 'commodities' in data['StationServices'] \
-                                            else False
-                                        oldstation.haveRefuel = True if 'refuel' in data['StationServices'] \
-                                            else False
-                                        if 'StationState' in data:
-                                            oldstation.stationState = data['StationState']
-                                        mark_changed(session)
-                                        transaction.commit()
-                                    else:
-                                        # New station, add it!
-                                        newstation = Station(id64=data['MarketID'], name=data['StationName'],
-                                                             distanceToArrival=data['DistFromStarLS'],
-                                                             government=data['StationGovernment'],
-                                                             economy=data['StationEconomy'],
-                                                             haveMarket=True if 'commodities' in data['StationServices']
-                                                             else False,
-                                                             haveShipyard=True if 'shipyard' in data['StationServices']
-                                                             else False,
-                                                             haveOutfitting=True if 'outfitting' in data['StationServices']
-                                                             else False,
-                                                             otherServices=data['StationServices'],
-                                                             updateTime=data['timestamp'],
-                                                             systemId64=data['SystemAddress'],
-                                                             systemName=data['StarSystem'],
-                                                             stationState=data['StationState'] if 'StationState' in
-                                                                                                  data else None,
-                                                             )
-                                        session.add(newstation)
-                                        session.flush()
-                                        stationcount += 1
-                                except DataError as e:
-                                    print(f"Failed to add a station! Invalid data passed: {e}")
-                                    transaction.abort()
-                                except KeyError as e:
-                                    print(f"Invalid key in station data: {e}")
-                                except IntegrityError:
-                                    failstation = failstation + 1
-                                    transaction.abort()
-                                except StaleDataError:
-                                    print(f"Stale data error, skipping this update for {data['StationName']}")
-                                    failstation = failstation + 1
-                                    transaction.abort()
-                        transaction.commit()
-
-                        # TODO: Handle other detail Carrier events, such as Stats.
-                        if data['event'] == 'FSDJump':
-                            id64 = data['SystemAddress']
-                            res = None
-                            if 'SystemAllegiance' in data:
-                                res = session.query(System).filter(System.id64 == id64).one_or_none()
-                            else:
-                                res = session.query(System.id64).filter(System.id64 == id64).scalar()
-                            if not res:
-                                syscount = syscount + 1
-                                newsys = System(id64=data['SystemAddress'], name=data['StarSystem'],
-                                                coords={'x': data['StarPos'][0], 'y': data['StarPos'][1],
-                                                        'z': data['StarPos'][2]}, date=data['timestamp'],
-                                                systemAllegiance=data['SystemAllegiance'] if 'SystemAllegiance' in data
-                                                else None)
-                                try:
-                                    session.add(newsys)
-                                    session.flush()
-                                    transaction.commit()
-                                except DataError:
-                                    print("Failed to add a system! Invalid data passed")
-                                    transaction.abort()
-                                except IntegrityError:
-                                    transaction.abort()
-                            else:
-                                if 'SystemAllegiance' in data:
-                                    res.systemAllegiance = data['SystemAllegiance']
-                                    mark_changed(session)
-                                    transaction.commit()
-
-                        if data['event'] == 'Scan':
-                            bodyid = data['SystemAddress'] + (data['BodyID'] << 55)
-                            if 'AbsoluteMagnitude' in data:
-                                res = session.query(Star.id64).filter(Star.id64 == bodyid).scalar() or False
-                                if not res:
-                                    starcount = starcount + 1
-                                    newstar = Star(id64=bodyid, bodyId=data['BodyID'], name=data['BodyName'],
-                                                   age=data['Age_MY'], axialTilt=data['AxialTilt'],
-                                                   orbitalEccentricity=data['Eccentricity']
-                                                   if 'Eccentricity' in data else None,
-                                                   orbitalInclination=data['OrbitalInclination']
-                                                   if 'OrbitalInclination' in data else None,
-                                                   orbitalPeriod=data['OrbitalPeriod']
-                                                   if 'OrbitalPeriod' in data else None,
-                                                   parents=data['Parents']
-                                                   if 'Parents' in data else None,
-                                                   argOfPeriapsis=data['Periapsis']
-                                                   if 'Periapsis' in data else None,
-                                                   belts=data['Rings'] if 'Rings' in data else None,
-                                                   semiMajorAxis=data['SemiMajorAxis']
-                                                   if 'SemiMajorAxis' in data else None,
-                                                   systemName=data['StarSystem'],
-                                                   distanceToArrival=data['DistanceFromArrivalLS'],
-                                                   luminosity=data['Luminosity'], solarRadius=data['Radius'],
-                                                   rotationalPeriod=data['RotationPeriod'], type=data['StarType'],
-                                                   solarMasses=data['StellarMass'],
-                                                   subType=data['Subclass'] if 'Subclass' in data else None,
-                                                   surfaceTemperature=data['SurfaceTemperature'],
-                                                   isScoopable=True if data['StarType'] in __scoopable else False,
-                                                   isMainStar=True if data['BodyID'] == 0 else False,
-                                                   updateTime=data['timestamp'],
-                                                   systemId64=data['SystemAddress'])
-                                    try:
-                                        session.add(newstar)
-                                        transaction.commit()
-                                    except DataError:
-                                        print("Failed to add star - Data Error!")
-                                        transaction.abort()
-                                    except IntegrityError:
-                                        try:
-                                            r = requests.get(f"{__EDSM_url}/systems?systemName={data['SystemName']}&"
-                                                             f"showId=1&showCoordinates=1&showInformation=1").json()[0]
-                                            if r:
-                                                system = System(id64=r['id64'], name=r['name'], coords=r['coords'])
-                                                session.add(system)
-                                                session.flush()
-                                                transaction.commit()
-                                        except IntegrityError:
-                                            print("Failed to add system during missing star handling. Bah. Give up.")
-                                            failstar = failstar + 1
-                                            transaction.abort()
-                                        except KeyError:
-                                            #print("No EDSM data found.")
-                                            failstar += 1
-                                            transaction.abort()
-
-                sys.stdout.flush()
-
-        except zmq.ZMQError as e:
-            print('ZMQSocketException: ' + str(e))
-            proxy.command("botserv", "Absolver", f"say #rattech [\x0315SAPI\x03] EDDN error: "
-                                                 f"Exiting due to exception: {str(e)}")
-
-            sys.stdout.flush()
-            subscriber.disconnect(__relayEDDN)
-            time.sleep(5)
+    while True:
+        # Wait no longer than the buffered rows may, writing them out if no message comes first.
+        timeout = writer.timeout()
+        try:
+            __json = messages_queue.get(timeout=1 if timeout is None else timeout)
+        except queue.Empty:
+            if writer.due():
+                flush()
+            continue
+        if __json is STOP:
+            flush()
+            elapsed = time.time() - started
+            print(f"\nReplayed {totmsg} messages in {elapsed:.1f} seconds ({totmsg / max(elapsed, 0.001):.0f}/s). "
+                  f"New systems: {syscount} New stars: {starcount} New stations: {stationcount} "
+                  f"Failed: {failstar + failstation}")
+            return
+        totmsg = totmsg + 1
+        print(f"EDDN Client running. Messages: {messages:10} Stars: {starcount:10} Systems: {syscount:10} "
+              f" Stations: {stationcount:5} Missing systems: {failstar+failstation:10} "
+              f" Queued: {stats.depth('frames', frames):6} {stats.depth('messages', messages_queue):6}\r",
+              end='')
+        if validsoftware(__json['header']['softwareName'], __json['header']['softwareVersion']) \
+                and __json['$schemaRef'] in __allowedSchema:
+            hmessages = hmessages + 1
+            if proxy:
+                if time.time() > (starttime + 3600 * 24):
+                    try:
+                        session = get_tm_session(session_factory, transaction.manager)
+                        startot = session.query(func.count(Star.id64)).scalar()
+                        systot = session.query(func.count(System.id64)).scalar()
+                        proxy.command("botserv", "Absolver", f"say #ratchat [\x0315SAPI\x03] Daily report: "
+                                                             f"{'{:,}'.format(messages)} messages processed"
+                                                             f", {'{:,}'.format(syscount)} new systems,"
+                                                             f"  {'{:,}'.format(starcount)} new stars."
+                                                             f" DB contains {'{:,}'.format(startot)} stars "
+                                                             f"and {'{:,}'.format(systot)} systems.")
+                        messages = 0
+                        syscount = 0
+                        starcount = 0
+                        failstar = 0
+                        stationcount = 0
+                        failstation = 0
+                        starttime = time.time()
+                    except TimeoutError:
+                        print("XMLRPC call failed due to timeout, retrying in 320 seconds.")
+                        starttime = starttime + 320
+                    except ProtocolError as e:
+                        print(f"XMLRPC call failed, skipping this update. {e.errmsg}")
+                        starttime = time.time()
+                if time.time() > (lasthourly + 3600):
+                    # print("Running stats update...")
+                    loop = asyncio.get_event_loop()
+                    future = asyncio.Future()
+                    asyncio.ensure_future(update_stats(session, future))
+                    future.add_done_callback(update_complete)
+                    try:
+                        loop.run_until_complete(future)
+                        pipeline = stats.snapshot(reset=True)
+                        proxy.command(f"botserv", "Absolver", f"say #announcerdev [\x0315SAPI\x03] "
+                                                              f"Hourly report: {hmessages} messages, "
+                                                              f"{totmsg - hmessages} ignored. Queue peaks: "
+                                                              f"{pipeline['max_depth'].get('frames', 0)} frames, "
+                                                              f"{pipeline['max_depth'].get('messages', 0)} "
+                                                              f"messages. Stalled "
+                                                              f"{sum(pipeline['stall_seconds'].values()):.1f}s.")
+                        lasthourly = time.time()
+                        hmessages = 0
+                        totmsg = 0
+                    except TimeoutError:
+                        print("XMLRPC call failed due to timeout, retrying in one hour.")
+                        lasthourly = time.time() + 3600
+                    except ProtocolError as e:
+                        print(f"XMLRPC call failed, skipping this update. {e.errmsg}")
+                        lasthourly = time.time()
+
+            data = __json['message']
+            messages = messages + 1
+            try:
+                queue_event(writer, data, known)
+            except KeyError as e:
+                print(f"Invalid key in {data.get('event')} data: {e}")
+                print(f"Software: {__json['header']['softwareName']} "
+                      f"{__json['header']['softwareVersion']}")
+        if writer.due():
+            flush()
+
+        sys.stdout.flush()
 
 
 if __name__ == '__main__':
@@ -16,6 +16,7 @@ from .permits import Permits
 from .landmark import Landmark
 from .stats import Stats
 from .carrier import Carrier
+from .scoopablesystem import ScoopableSystem
 
 # run configure_mappers after defining all of the models to ensure
 # all relationships can be setup
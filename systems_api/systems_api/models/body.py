@@ -7,7 +7,8 @@ from sqlalchemy import (
     Float,
     Integer,
     ForeignKey,
-    Index
+    Index,
+    text,
 )
 
 from .meta import Base
@@ -52,3 +53,4 @@ class Body(Base):
 
 Index('body_idx_id64', Body.id64, unique=True)
 Index('body_idx_systemid64', Body.systemId64)
+Index('body_idx_spatial_key', text('id64_spatial_key("systemId64")'))
@@ -0,0 +1,52 @@
+from sqlalchemy import (
+    Column,
+    BigInteger,
+    Text,
+    Float,
+    Index,
+    text,
+)
+
+from .meta import Base
+
+
+class ScoopableSystem(Base):
+    """Derived table of systems with at least one known scoopable star, for fuel star lookups."""
+    __tablename__ = 'scoopable_systems'
+    id64 = Column(BigInteger, primary_key=True)
+    """ID64 of the system."""
+    name = Column(Text)
+    """Name of the system."""
+    x = Column(Float)
+    """X coordinate of the system."""
+    y = Column(Float)
+    """Y coordinate of the system."""
+    z = Column(Float)
+    """Z coordinate of the system."""
+
+
+Index('scoopable_idx_coords_cube', text("cube(array[x, y, z])"), postgresql_using='gist')
+
+# Copies a system into scoopable_systems, refreshing its name and position if it is already there.
+upsert_scoopable_sql = text("""
+    INSERT INTO scoopable_systems (id64, name, x, y, z)
+    SELECT id64, name, x, y, z FROM systems WHERE id64 = :id64 AND x IS NOT NULL
+    ON CONFLICT (id64) DO UPDATE SET name = excluded.name, x = excluded.x, y = excluded.y, z = excluded.z
+""")
+
+# The same for many systems at once, for the EDDN client's batched writes. Returns whether each row was new.
+upsert_scoopable_many_sql = text("""
+    INSERT INTO scoopable_systems (id64, name, x, y, z)
+    SELECT id64, name, x, y, z FROM systems WHERE id64 = ANY(:id64s) AND x IS NOT NULL
+    ON CONFLICT (id64) DO UPDATE SET name = excluded.name, x = excluded.x, y = excluded.y, z = excluded.z
+    RETURNING (xmax = 0) AS inserted
+""")
+
+
+def add_scoopable_system(session, id64):
+    """
+    Records that a system has a scoopable star. Does nothing if the system itself is not known.
+    :param session: The DBSession
+    :param id64: ID64 of the system
+    """
+    session.execute(upsert_scoopable_sql, {'id64': id64})
@@ -7,7 +7,8 @@ from sqlalchemy import (
     Float,
     Integer,
     ForeignKey,
-    Index
+    Index,
+    text,
 )
 
 from sqlalchemy.dialects.postgresql import JSONB
@@ -49,3 +50,4 @@ class Star(Base):
 
 Index('star_idx_id64', Star.id64, unique=True)
 Index('star_idx_systemid64', Star.systemId64)
+Index('star_idx_spatial_key', text('id64_spatial_key("systemId64")'))
@@ -3,7 +3,10 @@ from sqlalchemy import (
     BigInteger,
     Text,
     DateTime,
+    Float,
+    Computed,
     Index,
+    func,
     text,
 )
 
@@ -18,8 +21,24 @@ class System(Base):
     id64 = Column(BigInteger, primary_key=True, name='id64')
     name = Column(Text)
     coords = Column(JSONB)
+    # Numeric copies of coords, maintained by Postgres, so spatial lookups can use a GiST index.
+    x = Column(Float, Computed("(coords->>'x')::double precision", persisted=True))
+    x.info.update({'pyramid_jsonapi': {'visible': False}})
+    y = Column(Float, Computed("(coords->>'y')::double precision", persisted=True))
+    y.info.update({'pyramid_jsonapi': {'visible': False}})
+    z = Column(Float, Computed("(coords->>'z')::double precision", persisted=True))
+    z.info.update({'pyramid_jsonapi': {'visible': False}})
+    # Phonetic keys of the name, maintained by Postgres (fuzzystrmatch), so sound-alike searches are index lookups.
+    name_soundex = Column(Text, Computed("soundex(name)", persisted=True))
+    name_soundex.info.update({'pyramid_jsonapi': {'visible': False}})
+    name_dmetaphone = Column(Text, Computed("dmetaphone(name)", persisted=True))
+    name_dmetaphone.info.update({'pyramid_jsonapi': {'visible': False}})
     date = Column(DateTime)
     date.info.update({'pyramid_jsonapi': {'visible': False}})
+    # When the row was added, by the database's clock. Unlike date (the event's timestamp), it only goes up,
+    # so it's safe to poll for new systems on.
+    inserted = Column(DateTime(timezone=True), server_default=func.now())
+    inserted.info.update({'pyramid_jsonapi': {'visible': False}})
     systemAllegiance = Column(Text)
     planets = relationship("Body")
     stars = relationship("Star")
@@ -30,8 +49,11 @@ Index('system_idx_id64', System.id64, unique=True)
 Index('system_idx_name_gin', System.name, postgresql_using='gin',
       postgresql_ops={'name': 'gin_trgm_ops'})
 Index('system_idx_name_btree', System.name, postgresql_using='btree')
-Index('system_idx_name_soundex', System.name, postgresql_using='soundex')
-# Index('system_idx_name_dmetaphone', System.name, postgresql_using='dmetaphone')
-Index('system_idx_coords_x', text("(coords->'x') jsonb_path_ops"), postgresql_using='gin')
-Index('system_idx_coords_y', text("(coords->'y') jsonb_path_ops"), postgresql_using='gin')
-Index('system_idx_coords_z', text("(coords->'z') jsonb_path_ops"), postgresql_using='gin')
+# Serves both lower(name) = :lname and lower(name) LIKE :prefix lookups.
+Index('system_idx_name_lower', text('lower(name) text_pattern_ops'))
+Index('system_idx_name_soundex', System.name_soundex)
+Index('system_idx_name_dmetaphone', System.name_dmetaphone)
+Index('system_idx_coords_cube', text("cube(array[x, y, z])"), postgresql_using='gist',
+      postgresql_where=text('x IS NOT NULL'))
+Index('system_idx_spatial_key', text("id64_spatial_key(id64)"))
+Index('system_idx_inserted', System.inserted)
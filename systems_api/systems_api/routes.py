@@ -4,13 +4,20 @@ def includeme(config):
     config.add_route('search', '/search')
     config.add_route('typeahead', '/typeahead')
     config.add_route('mecha', '/mecha')
+    config.add_route('mecha_batch', '/mecha_batch')
+    config.add_route('cache_stats', '/cache_stats')
+    config.add_route('search_stats', '/search_stats')
     config.add_route('landmark', '/landmark')
+    config.add_route('landmark_batch', '/landmark_batch')
     config.add_route('galaxy', '/galaxy')
     config.add_route('procname', '/procname')
     config.add_route('nearest_populated', '/nearest_populated')
+    config.add_route('nearest_populated_batch', '/nearest_populated_batch')
     config.add_route('nearest_scoopable', '/nearest_scoopable')
     config.add_route('heatmap', '/heatmap')
     config.add_route('proccoords', '/proccoords')
     config.add_route('get_ha_regions', '/get_ha_regions')
     config.add_route('nearest_coords', '/nearest_coords')
+    config.add_route('systems_in_radius', '/systems_in_radius')
+    config.add_route('systems_in_box', '/systems_in_box')
     config.add_route('fetch_system', '/fetch_system')
@@ -0,0 +1,52 @@
+import argparse
+import sys
+import time
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+)
+from sqlalchemy.exc import OperationalError
+
+from systems_api.models import (
+    get_engine,
+    get_session_factory,
+)
+from systems_api.utils.knownids import write_known_ids
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Write a snapshot of all known system and star ID64s for the EDDN client. Point the '
+                    'eddn.known_ids setting at it and restart the client to use it.'
+    )
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument(
+        '--output',
+        help='Path prefix for the snapshot files (default: the eddn.known_ids setting)',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    path = args.output or settings.get('eddn.known_ids')
+    if not path:
+        print("No output path given, and no eddn.known_ids setting in your config.")
+        sys.exit(1)
+    session = get_session_factory(get_engine(settings))()
+    start = time.time()
+    try:
+        counts = write_known_ids(path, session)
+    except OperationalError as e:
+        print(f"Could not read ID64s: {e}")
+        sys.exit(1)
+    finally:
+        session.close()
+    print(f"Wrote {counts['systems']} system and {counts['stars']} star ID64s to {path} in "
+          f"{time.time() - start:.1f} seconds.")
@@ -0,0 +1,54 @@
+import argparse
+import datetime
+import sys
+import time
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+)
+from sqlalchemy.exc import OperationalError
+
+from systems_api.models import (
+    get_engine,
+    get_session_factory,
+)
+from systems_api.utils.prefixindex import query_sorted_names, write_snapshot
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Write a snapshot of all system names for the typeahead index. Point the '
+                    'typeahead.snapshot setting at it and restart the API to use it.'
+    )
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument(
+        '--output',
+        help='Path prefix for the snapshot files (default: the typeahead.snapshot setting)',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    path = args.output or settings.get('typeahead.snapshot')
+    if not path:
+        print("No output path given, and no typeahead.snapshot setting in your config.")
+        sys.exit(1)
+    session = get_session_factory(get_engine(settings))()
+    start = time.time()
+    # Taken before reading, so systems added while the snapshot is written are picked up by the delta.
+    built = datetime.datetime.utcnow()
+    try:
+        count = write_snapshot(path, query_sorted_names(session), built)
+    except OperationalError as e:
+        print(f"Could not read system names: {e}")
+        sys.exit(1)
+    finally:
+        session.close()
+    print(f"Wrote {count} names to {path} in {time.time() - start:.1f} seconds.")
@@ -64,3 +64,645 @@ class TestMyViewFailureCondition(BaseTest):
         from .views.default import my_view
         info = my_view(dummy_request(self.session))
         self.assertEqual(info.status_int, 500)
+
+
+class TestKDTree(unittest.TestCase):
+
+    def setUp(self):
+        import numpy
+        rng = numpy.random.default_rng(42)
+        self.points = rng.uniform(-1000, 1000, (2000, 3))
+        self.queries = rng.uniform(-1200, 1200, (25, 3))
+
+    def test_query_matches_brute_force(self):
+        import numpy
+        from .utils.kdtree import KDTree
+        tree = KDTree(self.points, leafsize=16)
+        for q in self.queries:
+            dists, idx = tree.query(q, 10)
+            brute = numpy.sqrt(((self.points - q) ** 2).sum(axis=1))
+            self.assertTrue(numpy.allclose(dists, numpy.sort(brute)[:10]))
+            self.assertTrue(numpy.allclose(brute[idx], dists))
+
+    def test_query_radius_matches_brute_force(self):
+        import numpy
+        from .utils.kdtree import KDTree
+        tree = KDTree(self.points, leafsize=16)
+        for q in self.queries:
+            dists, idx = tree.query_radius(q, 250)
+            brute = numpy.sqrt(((self.points - q) ** 2).sum(axis=1))
+            self.assertEqual(set(idx), set(numpy.flatnonzero(brute <= 250)))
+
+    def test_populated_index_legacy_filter(self):
+        from .utils.spatial import PopulatedIndex
+        index = PopulatedIndex([
+            (1, 'Sol', {'x': 0, 'y': 0, 'z': 0}, False),
+            (2, 'Alpha Centauri', {'x': 3.03, 'y': -0.09, 'z': 3.16}, True),
+            (3, 'Broken', None, True),
+        ])
+        self.assertEqual(len(index), 2)
+        self.assertEqual([r[1] for r in index.nearest((0, 0, 0), 5)], [1, 2])
+        self.assertEqual([r[1] for r in index.nearest((0, 0, 0), 5, legacy=True)], [2])
+
+
+class TestExpandPopulated(unittest.TestCase):
+
+    def test_groups_bulk_details_per_candidate(self):
+        from .models import Station
+        from .views.nearest import expand_populated
+        stations = {
+            1: [Station(name='Abraham Lincoln', type='Orbis', stationState=None)],
+            2: [Station(name='Jameson Memorial', type='Orbis', stationState=None)],
+        }
+        details = (stations, {1: 'Federation', 2: 'Thargoid'}, {1: 'Sol'})
+        systems, permits = expand_populated([(0.0, 1, 'Sol'), (5.0, 2, 'Shinrarta Dezhra'), (7.0, 3, 'Nowhere')],
+                                            details)
+        self.assertEqual([s['name'] for s in systems], ['Sol', 'Shinrarta Dezhra', 'Nowhere'])
+        self.assertEqual(systems[0]['stations'][0]['name'], 'Abraham Lincoln')
+        self.assertIsNone(systems[0]['stations'][0]['stationState'])
+        self.assertEqual(systems[1]['stations'][0]['stationState'], 'Abandoned')
+        self.assertEqual(systems[2]['stations'], [])
+        self.assertIsNone(systems[2]['allegiance'])
+        self.assertEqual(permits, [{'id64': 1, 'name': 'Sol'}])
+
+
+class TestNearestPopulatedBatch(unittest.TestCase):
+
+    def test_malformed_requests(self):
+        from webob.multidict import MultiDict
+        from .views.nearest import nearest_populated_batch
+        request = testing.DummyRequest(params=MultiDict(name='Sol', limit='ten'))
+        self.assertEqual(nearest_populated_batch(request).code, 400)
+        for body in ({'names': ['Sol', 42]}, {'names': [None]}, {'systemid64s': ['10477373803']},
+                     {'systemid64s': [True]}, {'names': ['Sol'], 'limit': 'ten'}, ['Sol']):
+            request = testing.DummyRequest(params=MultiDict(), json_body=body, content_type='application/json')
+            self.assertEqual(nearest_populated_batch(request).code, 400)
+
+
+class TestPGBoxels(unittest.TestCase):
+
+    def test_boxels_near_match_system_names(self):
+        from .utils import pgboxels, pgnames
+        estimate = pgnames.get_system('Eol Prou RS-T d3-94')['coords']
+        boxels = pgboxels.boxels_near((estimate['x'], estimate['y'], estimate['z']), 50, mass_codes='d')
+        # The boxel a system is named after holds its estimated position.
+        self.assertIn('Eol Prou RS-T d3-', [b.name for _, b in boxels])
+        self.assertEqual(pgboxels.get_boxel_name('eol prou RS-T d3-94'), 'Eol Prou RS-T d3-')
+        self.assertIsNone(pgboxels.get_boxel_name('Sol'))
+
+    def test_boxels_near_only_returns_overlapping_boxels(self):
+        from .utils import pgboxels
+        pos = (-9530.5, -910.28, 19808.125)
+        boxels = pgboxels.boxels_near(pos, 30, mass_codes='c')
+        self.assertTrue(boxels)
+        self.assertEqual([d for d, _ in boxels], sorted(d for d, _ in boxels))
+        for dist, boxel in boxels:
+            # Nothing further than the radius plus half a boxel diagonal can overlap the sphere.
+            self.assertLessEqual(dist, 30 + boxel.uncertainty * 3 ** 0.5)
+
+
+class TestLandmarkIndex(unittest.TestCase):
+
+    def test_soi_filter_and_order(self):
+        from .utils.spatial import LandmarkIndex
+        index = LandmarkIndex([
+            ('Sol', 0.0, 0.0, 0.0, None),
+            ('Sagittarius A*', 25.21875, -20.90625, 25899.96875, 0.0),
+            ('Colonia', -9530.5, -910.28125, 19808.125, 1000.0),
+            ('Broken', None, None, None, None),
+        ])
+        self.assertEqual(len(index), 3)
+        near_sol, near_colonia = index.nearest_many([(1, 0, 0), (-9530.5, -910.28125, 19800.125)])
+        # Colonia's sphere of influence doesn't reach Sol, landmarks without one always apply.
+        self.assertEqual([n for n, _ in near_sol], ['Sol', 'Sagittarius A*'])
+        self.assertAlmostEqual(near_sol[0][1], 1.0)
+        self.assertEqual([n for n, _ in near_colonia], ['Colonia', 'Sagittarius A*', 'Sol'])
+        self.assertEqual(index.nearest((1, 0, 0)), near_sol)
+        self.assertEqual(index.nearest_many([]), [])
+
+
+class TestStreamSystems(unittest.TestCase):
+
+    def test_streams_ndjson_in_batches(self):
+        import json
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import Session
+        from .views.region import stream_systems
+        engine = create_engine('sqlite://')
+        with engine.begin() as conn:
+            conn.exec_driver_sql('CREATE TABLE systems (id64 INTEGER, name TEXT, x FLOAT, y FLOAT, z FLOAT)')
+            conn.exec_driver_sql("INSERT INTO systems VALUES (1, 'Sol', 0, 0, 0), (2, 'Achenar', 67.5, -119.46875, "
+                                 "24.84375), (3, 'Alioth', -33.65625, 72.46875, -20.65625)")
+        request = testing.DummyRequest(dbsession=Session(bind=engine))
+        request.registry.settings = {'spatial.fetch_size': 2}
+        response = stream_systems(request, "SELECT id64, name, x, y, z FROM systems ORDER BY id64", {})
+        chunks = list(response.app_iter)
+        self.assertEqual(len(chunks), 2)
+        systems = [json.loads(line) for line in b''.join(chunks).decode('utf-8').splitlines()]
+        self.assertEqual([s['name'] for s in systems], ['Sol', 'Achenar', 'Alioth'])
+        self.assertEqual(systems[1]['coords'], {'x': 67.5, 'y': -119.46875, 'z': 24.84375})
+        self.assertNotIn('distance', systems[0])
+        response.app_iter.close()
+        # A response that is never read still gives its connection back.
+        response = stream_systems(request, "SELECT id64, name, x, y, z FROM systems", {})
+        self.assertFalse(response.app_iter.conn.closed)
+        response.app_iter.close()
+        self.assertTrue(response.app_iter.conn.closed)
+
+
+class TestSpatialKey(unittest.TestCase):
+
+    def test_key_ignores_n2_and_body(self):
+        from .utils.util import id64_spatial_key
+        sol = 10477373803
+        self.assertEqual(id64_spatial_key(sol), id64_spatial_key(sol + (5 << 55)))
+        # Same boxel as Sol, different N2.
+        self.assertEqual(id64_spatial_key(sol), id64_spatial_key(sol + (1 << 44)))
+
+    def test_larger_boxels_share_keys_with_their_corner(self):
+        from .utils.util import id64_spatial_key, interleave3
+        # Mass code h boxel (7) at x=1, y=2, z=3, and the mass code a boxel (0) at its corner.
+        h = (1 << 16) | (2 << 10) | (3 << 3) | 7
+        a = (128 << 30) | (256 << 17) | (384 << 3)
+        self.assertEqual(id64_spatial_key(h), id64_spatial_key(a))
+        self.assertEqual(id64_spatial_key(a), interleave3(128, 256, 384, 14))
+
+
+class TestPrefixIndex(unittest.TestCase):
+    names = ['Col 285 Sector AB-C d1-2', 'Colonia', 'Sol', 'Sol', 'Solati', 'Wregoe AA-A h1', 'Ærø']
+
+    def test_complete_with_delta(self):
+        from .utils.prefixindex import PrefixIndex, build_arrays
+        blob, offsets, extra = build_arrays(sorted(self.names, key=str.lower))
+        index = PrefixIndex(blob, offsets, extra=extra)
+        self.assertEqual(index.complete('col'), ['Col 285 Sector AB-C d1-2', 'Colonia'])
+        self.assertEqual(index.complete('SOL'), ['Sol', 'Solati'])
+        self.assertEqual(index.complete('sol', 1), ['Sol'])
+        self.assertEqual(index.complete('sol', 2), ['Sol', 'Solati'])
+        self.assertEqual(index.complete('xyz'), [])
+        self.assertEqual(index.add(['Colonia', 'Cold Sector', 'Solitude']), 2)
+        self.assertEqual(index.complete('col'), ['Col 285 Sector AB-C d1-2', 'Cold Sector', 'Colonia'])
+        self.assertEqual(index.complete('æ'), ['Ærø'])
+
+    def test_duplicates_do_not_use_up_limit(self):
+        from .utils.prefixindex import PrefixIndex, build_arrays
+        blob, offsets, extra = build_arrays(['Sol', 'Sol', 'Sol', 'Solati'])
+        self.assertEqual(PrefixIndex(blob, offsets, extra=extra).complete('sol', 3), ['Sol', 'Solati'])
+
+    def test_snapshot_round_trip(self):
+        import datetime
+        import os
+        import tempfile
+        from .utils.prefixindex import load_snapshot, write_snapshot
+        built = datetime.datetime(3307, 1, 1, 12, 0)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'typeahead')
+            # Out of order names are kept aside instead of breaking the search.
+            self.assertEqual(write_snapshot(path, sorted(self.names, key=str.lower) + ['Achenar'], built), 8)
+            index = load_snapshot(path)
+            self.assertEqual(index.built, built)
+            self.assertEqual(index.complete('sol'), ['Sol', 'Solati'])
+            self.assertEqual(index.complete('ach'), ['Achenar'])
+            self.assertIn('Wregoe AA-A h1', index)
+            self.assertNotIn('Wregoe', index)
+
+
+class TestLikePrefix(unittest.TestCase):
+
+    def test_escapes_wildcards(self):
+        from .utils.util import like_prefix
+        self.assertEqual(like_prefix('col 285'), 'col 285%')
+        self.assertEqual(like_prefix('100%_a\\b'), '100\\%\\_a\\\\b%')
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_lru_ttl_and_counters(self):
+        from .utils.cache import LocalBackend, ResultCache
+        cache = ResultCache(LocalBackend(size=2, ttl=300))
+        self.assertIsNone(cache.get('sol'))
+        cache.set('sol', {'meta': {'type': 'Perfect match'}})
+        cache.set('colonia', {'meta': {}})
+        # Hits hand out copies, so callers can't change what is cached.
+        cache.get('sol')['meta']['type'] = 'changed'
+        self.assertEqual(cache.get('sol'), {'meta': {'type': 'Perfect match'}})
+        cache.set('maia', {'meta': {}})
+        self.assertIsNone(cache.get('colonia'))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 2)
+        cache.backend.ttl = -1
+        cache.set('achenar', {})
+        self.assertIsNone(cache.get('achenar'))
+
+    def test_counters_from_many_threads(self):
+        import threading
+        from .utils.cache import LocalBackend, ResultCache
+        cache = ResultCache(LocalBackend())
+        cache.set('sol', {})
+        threads = [threading.Thread(target=lambda: [cache.get(key) for key in ('sol', 'maia') * 1000])
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (8000, 8000))
+
+    def test_backend_errors_are_misses(self):
+        from .utils.cache import ResultCache
+
+        class Broken(object):
+            def get(self, key):
+                raise ConnectionError('down')
+
+            def set(self, key, value):
+                raise ConnectionError('down')
+
+        cache = ResultCache(Broken())
+        cache.set('sol', {})
+        self.assertIsNone(cache.get('sol'))
+        self.assertEqual(cache.stats()['errors'], 2)
+
+
+class TestMechaParallel(unittest.TestCase):
+
+    def setUp(self):
+        from pyramid.registry import Registry
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from sqlalchemy.pool import QueuePool
+        # Connections are checked out here and used, then closed, by the strategy threads.
+        self.engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=QueuePool,
+                                    pool_size=4, max_overflow=0, pool_timeout=1)
+        self.registry = Registry('mecha')
+        self.registry['dbsession_factory'] = sessionmaker(bind=self.engine)
+        self.registry.settings = {'mecha.parallel': 'true', 'mecha.parallel_workers': 8}
+
+    def make_request(self, **params):
+        request = testing.DummyRequest(params=params, dbsession=None)
+        request.registry = self.registry
+        return request
+
+    def strategy(self, rows, delay=0.0):
+        import time
+
+        def search(session, name, lname):
+            time.sleep(delay)
+            if isinstance(rows, Exception):
+                raise rows
+            return rows
+        return search
+
+    def test_prefers_earlier_strategy(self):
+        from .views.mecha import run_strategies
+        strategies = [('slow', 'similarity', self.strategy(['slow'], 0.2)),
+                      ('fast', 'similarity', self.strategy(['fast']))]
+        self.assertEqual(run_strategies(self.make_request(), strategies, 'Sol', 'sol'), (0, ['slow']))
+
+    def test_falls_through_empty_and_failed_strategies(self):
+        from .views.mecha import run_strategies
+        strategies = [('empty', 'similarity', self.strategy([])),
+                      ('broken', 'similarity', self.strategy(RuntimeError('boom'))),
+                      ('found', 'distance', self.strategy(['found'], 0.05)),
+                      ('late', 'similarity', self.strategy(['late'], 0.5))]
+        self.assertEqual(run_strategies(self.make_request(), strategies, 'Sol', 'sol'), (2, ['found']))
+        self.assertEqual(run_strategies(self.make_request(), strategies[:2], 'Sol', 'sol'), (None, []))
+
+    def test_parallel_parameter_needs_setting(self):
+        from .views.mecha import run_strategies
+        sessions = []
+        strategies = [('found', 'similarity', lambda session, name, lname: sessions.append(session) or ['Sol'])]
+        self.registry.settings['mecha.parallel'] = 'false'
+        run_strategies(self.make_request(parallel='1'), strategies, 'Sol', 'sol')
+        self.registry.settings['mecha.parallel'] = 'request'
+        run_strategies(self.make_request(), strategies, 'Sol', 'sol')
+        run_strategies(self.make_request(parallel='1'), strategies, 'Sol', 'sol')
+        # Sequential runs use the request's session, which is None here.
+        self.assertEqual([session is None for session in sessions], [True, True, False])
+
+    def test_concurrent_requests_stay_within_pool(self):
+        import threading
+        import time
+        from .views.mecha import run_strategies
+        lock = threading.Lock()
+        seen = {'max': 0, 'sequential': 0, 'errors': 0}
+
+        def search(session, name, lname):
+            with lock:
+                seen['max'] = max(seen['max'], self.engine.pool.checkedout())
+                seen['sequential'] += session is None
+            time.sleep(0.1)
+            return []
+
+        def request():
+            try:
+                run_strategies(self.make_request(), [('a', 'similarity', search), ('b', 'similarity', search)],
+                               'Sol', 'sol')
+            except Exception:
+                with lock:
+                    seen['errors'] += 1
+
+        threads = [threading.Thread(target=request) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        time.sleep(0.2)
+        self.assertEqual(seen['errors'], 0)
+        self.assertLessEqual(seen['max'], 4)
+        # Requests that found no free connections ran their strategies one after the other instead.
+        self.assertGreater(seen['sequential'], 0)
+        self.assertEqual(self.registry['mecha_connections'].used, 0)
+        self.assertEqual(self.engine.pool.checkedout(), 0)
+
+
+class TestPGID64(unittest.TestCase):
+
+    def test_name_to_id64(self):
+        from .utils.pgboxels import get_pg_id64
+        self.assertEqual(get_pg_id64('Wregoe AC-D d12-0'), 10477373803)  # Sol
+        self.assertEqual(get_pg_id64('eol prou rs-t d3-94'), 3238296097059)  # Colonia
+        self.assertIsNone(get_pg_id64('Sol'))
+
+    def test_out_of_range(self):
+        from .utils.pgboxels import get_pg_id64
+        from .utils.system_internal import calculate_from_id64
+        # N2 only has 11 bits at mass code a; this used to wrap around to a1-255.
+        self.assertIsNone(get_pg_id64('Eol Prou RS-T a1-99999999'))
+        self.assertIsNone(get_pg_id64('Eol Prou RS-T a1-2048'))
+        self.assertEqual(calculate_from_id64(get_pg_id64('Eol Prou RS-T a1-2047'))[2], 2047)
+        self.assertEqual(calculate_from_id64(get_pg_id64('Eol Prou RS-T d3-262143'))[2], 262143)
+        # A sector is a single h boxel, and 16 d boxels wide.
+        self.assertIsNotNone(get_pg_id64('Eol Prou AA-A h0'))
+        self.assertIsNone(get_pg_id64('Eol Prou BA-A h0'))
+        self.assertIsNone(get_pg_id64('Eol Prou AA-A d1000-0'))
+
+    def test_neighbours(self):
+        from .utils.pgboxels import get_pg_id64, get_pg_neighbours
+        neighbours = get_pg_neighbours('Eol Prou RS-T d3-94')
+        # Changing L2, L3 or N1 moves a d boxel out of its sector, so only L1 and N2 neighbours are names.
+        self.assertEqual(len(neighbours), 4)
+        self.assertEqual(neighbours[get_pg_id64('Eol Prou RS-T d3-95')], 'Eol Prou RS-T d3-95')
+        self.assertIn('Eol Prou QS-T d3-94', neighbours.values())
+        self.assertNotIn(3238296097059, neighbours)
+        self.assertEqual(get_pg_neighbours('Sol'), {})
+
+
+class TestPreparedStatement(unittest.TestCase):
+
+    def test_positional_sql(self):
+        from .utils.prepared import PreparedStatement
+        statement = PreparedStatement('test_stmt', "SELECT :name, :name_len WHERE :name = :name LIMIT :limit",
+                                      [('name', 'text'), ('limit', 'integer'), ('name_len', 'integer')])
+        self.assertEqual(statement.prepare_sql,
+                         "PREPARE test_stmt(text, integer, integer) AS SELECT $1, $3 WHERE $1 = $1 LIMIT $2")
+        self.assertEqual(statement.execute_sql, "EXECUTE test_stmt(:name, :limit, :name_len)")
+
+    def test_runs_directly_elsewhere(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import Session
+        from .utils.prepared import PreparedStatement
+        statement = PreparedStatement('test_stmt', "SELECT :a + :b AS total", [('a', 'integer'), ('b', 'integer')])
+        with Session(create_engine('sqlite://')) as session:
+            self.assertEqual(statement.execute(session, a=2, b=3).scalar(), 5)
+
+
+class TestLatencyRecorder(unittest.TestCase):
+
+    def test_buckets(self):
+        from .utils.metrics import LatencyRecorder
+        recorder = LatencyRecorder(buckets=(10, 100))
+        for ms in (1, 10, 50, 500):
+            recorder.histogram('soundex').observe(ms)
+        with recorder.time('lev'):
+            pass
+        stats = recorder.stats()
+        self.assertEqual(list(stats), ['lev', 'soundex'])
+        self.assertEqual(stats['soundex']['buckets'], {'<=10ms': 2, '<=100ms': 1, '>100ms': 1})
+        self.assertEqual(stats['soundex']['mean_ms'], 140.25)
+        self.assertEqual(stats['lev']['count'], 1)
+
+
+class TestSearchPaging(unittest.TestCase):
+
+    def setUp(self):
+        import sqlalchemy
+        from sqlalchemy import create_engine, event
+        from sqlalchemy.orm import Session
+        engine = create_engine('sqlite://')
+
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, record):
+            dbapi_connection.create_function('similarity', 2, lambda a, b: round(1 / (1 + abs(len(a) - len(b))), 2))
+
+        self.session = Session(engine)
+        self.session.execute(sqlalchemy.text("CREATE TABLE systems (id64 INTEGER, name TEXT)"))
+        names = ['Col 285 Sector A', 'Col 285 Sector B', 'Col 285 Sector AB', 'Col 285 Sector AC',
+                 'Col 285 Sector AB', 'Col 285 Sector ABC', 'Col 359 Sector A', 'Sol']
+        for id64, name in enumerate(names):
+            self.session.execute(sqlalchemy.text("INSERT INTO systems VALUES (:id64, :name)"), {'id64': id64, 'name': name})
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_pages_cover_all_matches_once(self):
+        from .views.search import statements, encode_cursor, decode_cursor
+        first, after = statements['lev']
+        values = {'name': 'Col 285 Sector AB', 'limit': 2, 'pattern': 'col 285%'}
+        pages = [first.execute(self.session, **values).fetchall()]
+        while len(pages[-1]) == 2:
+            cursor = decode_cursor(encode_cursor(pages[-1][-1]))
+            pages.append(after.execute(self.session, **values, **cursor).fetchall())
+        rows = [(row.name, row.id64) for page in pages for row in page]
+        self.assertEqual(len(pages), 4)
+        self.assertEqual(rows, [('Col 285 Sector AB', 2), ('Col 285 Sector AB', 4), ('Col 285 Sector AC', 3),
+                                ('Col 285 Sector A', 0), ('Col 285 Sector ABC', 5), ('Col 285 Sector B', 1)])
+
+    def test_single_row_pages(self):
+        from .views.search import statements, encode_cursor, decode_cursor
+        first, after = statements['lev']
+        values = {'name': 'Col 359 Sector A', 'limit': 1, 'pattern': 'col 359%'}
+        page = first.execute(self.session, **values).fetchall()
+        self.assertEqual([row.name for row in page], ['Col 359 Sector A'])
+        cursor = decode_cursor(encode_cursor(page[-1]))
+        self.assertEqual(after.execute(self.session, **values, **cursor).fetchall(), [])
+
+    def test_limit_out_of_range(self):
+        from .views.search import search
+        for limit in ('0', '-5', '201', 'ten'):
+            request = testing.DummyRequest(params={'name': 'Col 285', 'limit': limit})
+            self.assertEqual(search(request).code, 400)
+
+    def test_malformed_cursor(self):
+        from .views.search import decode_cursor
+        self.assertIsNone(decode_cursor('not a cursor'))
+        self.assertIsNone(decode_cursor('WzEsIDJd'))  # [1, 2]
+
+
+class TestTrigramOptions(unittest.TestCase):
+
+    def test_adapt_threshold(self):
+        from .utils.trigram import adapt_threshold
+        tried = []
+
+        def count(threshold, cap):
+            tried.append(threshold)
+            return min(int(2000 * (1 - threshold)), cap)
+
+        self.assertEqual(adapt_threshold(count, 0.3, 500), 0.8)
+        self.assertEqual(tried, [0.3, 0.4, 0.5, 0.6, 0.7, 0.8])
+        self.assertEqual(adapt_threshold(lambda threshold, cap: cap, 0.3, 10), 1.0)
+
+    def test_options(self):
+        from .utils.trigram import get_trigram_options
+        request = testing.DummyRequest(params={'mode': 'word', 'adaptive': 'true'})
+        request.registry.settings = {'trigram.threshold': '0.4'}
+        self.assertEqual(tuple(get_trigram_options(request)), ('word', 0.4, True, 1000))
+        for params in ({'mode': 'fuzzy'}, {'threshold': '2'}, {'threshold': 'high'}):
+            request = testing.DummyRequest(params=params)
+            request.registry.settings = {}
+            self.assertRaises(ValueError, get_trigram_options, request)
+
+
+class TestMechaBatch(unittest.TestCase):
+
+    def test_exact_match_type(self):
+        from types import SimpleNamespace
+        from .views.mecha import exact_match_type
+        row = SimpleNamespace(name='Sol')
+        self.assertEqual(exact_match_type('Sol', 'sol', row), 'Perfect match')
+        self.assertEqual(exact_match_type('SOL', 'sol', row), 'Case-insensitive match')
+        self.assertEqual(exact_match_type('Wregoe AC-D d12-0', 'wregoe ac-d d12-0', row), 'pg_id64')
+
+    def test_malformed_requests(self):
+        from .views.mecha import mecha_batch
+        for body in ({'name': ['Sol']}, {'names': 42}, {'names': 'Sol'}, {'names': {'Sol': 1}}, ['Sol']):
+            request = testing.DummyRequest(json_body=body, post={})
+            self.assertEqual(mecha_batch(request).code, 400)
+        request = testing.DummyRequest(json_body={'names': ['Sol'] * 3}, post={})
+        request.registry.settings = {'mecha.batch_limit': '2'}
+        self.assertEqual(mecha_batch(request).code, 400)
+
+
+class TestBatchWriter(unittest.TestCase):
+
+    def setUp(self):
+        from .models import System
+        from .utils.batchwriter import BatchWriter, TableBatch
+        self.tables = {'systems': TableBatch(System.__table__, 'id64', update=('name',), keep=('systemAllegiance',))}
+        self.writer = BatchWriter(None, self.tables, max_rows=3, max_delay=60)
+
+    def test_merges_rows_by_key(self):
+        self.writer.add('systems', {'id64': 1, 'name': 'Sol', 'systemAllegiance': 'Federation'})
+        self.writer.add('systems', {'id64': 2, 'name': 'Achenar', 'systemAllegiance': None})
+        self.writer.add('systems', {'id64': 1, 'name': 'Sol', 'systemAllegiance': None})
+        self.assertEqual(len(self.writer), 2)
+        self.assertEqual(self.writer.pending['systems'][1]['systemAllegiance'], 'Federation')
+        self.assertFalse(self.writer.due())
+        self.assertGreater(self.writer.timeout(), 59)
+        self.writer.add('systems', {'id64': 3, 'name': 'Alioth'})
+        self.assertTrue(self.writer.due())
+
+    def test_merge_keeps_newest_observation(self):
+        from .models import Station
+        from .utils.batchwriter import BatchWriter, TableBatch
+        writer = BatchWriter(None, {'stations': TableBatch(Station.__table__, 'id64', update=('updateTime',),
+                                                           keep=('stationState',), newest='updateTime')})
+        writer.add('stations', {'id64': 1, 'systemName': 'Sol', 'updateTime': '3307-01-02T00:00:00Z',
+                                'stationState': None})
+        writer.add('stations', {'id64': 1, 'systemName': 'Achenar', 'updateTime': '3307-01-01T00:00:00Z',
+                                'stationState': 'Damaged'})
+        self.assertEqual(writer.pending['stations'][1], {'id64': 1, 'systemName': 'Sol', 'stationState': 'Damaged',
+                                                         'updateTime': '3307-01-02T00:00:00Z'})
+        writer.add('stations', {'id64': 1, 'systemName': 'Alioth', 'updateTime': '3307-01-03T00:00:00Z'})
+        self.assertEqual(writer.pending['stations'][1]['systemName'], 'Alioth')
+
+    def test_statement(self):
+        from sqlalchemy.dialects import postgresql
+        rows = [{'id64': 1, 'name': 'Sol', 'systemAllegiance': None}, {'id64': 2, 'name': 'Achenar',
+                                                                       'systemAllegiance': 'Empire'}]
+        sql = str(self.tables['systems'].statement(rows).compile(dialect=postgresql.dialect()))
+        self.assertIn('VALUES (%(id64_m0)s, %(name_m0)s, %(systemAllegiance_m0)s), (%(id64_m1)s', sql)
+        self.assertIn('ON CONFLICT (id64) DO UPDATE SET name = excluded.name, '
+                      '"systemAllegiance" = coalesce(excluded."systemAllegiance", systems."systemAllegiance")', sql)
+        self.assertIn('WHERE excluded.name IS DISTINCT FROM systems.name OR', sql)
+        self.assertTrue(sql.endswith('RETURNING (xmax = 0) AS inserted'))
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_stage(self):
+        import queue
+        from .utils.pipeline import STOP, StageStats, start_stage
+        inbox, outbox = queue.Queue(), queue.Queue(maxsize=2)
+        stats = StageStats()
+        workers = start_stage('parse', lambda item: 10 // item, inbox, outbox, 'parsed', stats, threads=2)
+        for item in (1, 0, 2, 5):
+            inbox.put(item)
+        results = sorted(outbox.get(timeout=5) for _ in range(3))
+        inbox.put(STOP)
+        for worker in workers:
+            worker.join(timeout=5)
+        self.assertEqual(results, [2, 5, 10])
+        counts = stats.snapshot()['counts']
+        self.assertEqual((counts['parse'], counts['parse_failed']), (3, 1))
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+
+    def test_feed_counts_stalls(self):
+        import queue
+        import threading
+        from .utils.pipeline import StageStats, feed
+        q = queue.Queue(maxsize=1)
+        stats = StageStats()
+        feed(q, 1, stats, 'frames')
+        threading.Timer(0.05, q.get).start()
+        feed(q, 2, stats, 'frames')
+        snapshot = stats.snapshot(reset=True)
+        self.assertEqual(snapshot['counts']['frames_stalls'], 1)
+        self.assertGreater(snapshot['stall_seconds']['frames'], 0)
+        self.assertEqual(snapshot['max_depth']['frames'], 1)
+        self.assertEqual(stats.snapshot()['counts'], {})
+
+
+class TestKnownIds(unittest.TestCase):
+
+    def test_membership(self):
+        import numpy
+        from .utils.knownids import KnownIds
+        known = KnownIds(numpy.array([3, 10477373803, 3238296097059], dtype=numpy.int64), compact_at=3)
+        self.assertIn(10477373803, known)
+        self.assertNotIn(4, known)
+        self.assertNotIn(2 ** 64, known)
+        known.add([4, 1])
+        self.assertIn(4, known)
+        self.assertEqual((len(known.ids), len(known.delta)), (3, 2))
+        known.add([2])
+        self.assertEqual(list(known.ids), [1, 2, 3, 4, 10477373803, 3238296097059])
+        self.assertEqual(len(known.delta), 0)
+        self.assertIn(1, known)
+
+    def test_empty(self):
+        from .utils.knownids import KnownIds
+        self.assertNotIn(1, KnownIds())
+
+
+class TestFrameLog(unittest.TestCase):
+
+    def test_rotate_and_read(self):
+        import os
+        import tempfile
+        from .utils.framelog import FrameLog, log_files, read_frames
+        with tempfile.TemporaryDirectory() as directory:
+            log = FrameLog(directory, max_bytes=30, keep=2)
+            frames = [bytes([i]) * 10 for i in range(5)]
+            for i, frame in enumerate(frames):
+                log.write(frame, 1000.0 + i)
+            log.close()
+            # Records take 22 bytes and files rotate once past 30, so each holds two; the newest two files are kept.
+            files = log_files(directory)
+            self.assertEqual(len(files), 2)
+            self.assertEqual(list(read_frames(directory)), [(1002.0, frames[2]), (1003.0, frames[3]),
+                                                            (1004.0, frames[4])])
+            with open(files[-1], 'ab') as f:
+                f.write(b'\x00\x00\x00\x10partial')
+            self.assertEqual(list(read_frames(files[-1])), [(1004.0, frames[4])])
+            self.assertEqual(log_files(os.path.join(directory, 'x.log')), [os.path.join(directory, 'x.log')])
@@ -0,0 +1,188 @@
+"""
+Micro-batched writes for the EDDN client.
+
+Rows are buffered per table and written as one multi-row INSERT ... ON CONFLICT per table, in a single
+transaction, once enough rows are buffered or the oldest has waited long enough. If a table's batch is
+rejected, its rows are retried one at a time so only the bad ones are lost.
+"""
+import collections
+import time
+
+import transaction
+from sqlalchemy import func, and_, or_, literal_column
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from zope.sqlalchemy import mark_changed
+
+
+# Rows written by an upsert come back with this flag: a row version created by an INSERT has no xmax, while
+# one created by ON CONFLICT DO UPDATE carries the updating transaction's ID.
+inserted_column = literal_column('(xmax = 0)').label('inserted')
+
+Written = collections.namedtuple('Written', ['inserted', 'updated'])
+"""Number of rows a batch inserted, and number of existing rows it changed."""
+
+
+class TableBatch(object):
+    """
+    How rows for one table are written.
+    """
+
+    def __init__(self, table, key, update=(), keep=(), newest=None):
+        """
+        :param table: The Table, e.g. System.__table__
+        :param key: Name of the primary key column rows conflict on
+        :param update: Columns overwritten when the row already exists
+        :param keep: Columns overwritten when the row already exists, unless the new value is NULL
+        :param newest: Column holding the time a row was observed; when buffered rows share a key, the values of
+            the most recently observed one win, whichever arrived first
+        """
+        self.table = table
+        self.key = key
+        self.update = update
+        self.keep = keep
+        self.newest = newest
+
+    def statement(self, rows):
+        """
+        :param rows: List of row dicts, all with the same keys
+        :return: The INSERT ... ON CONFLICT statement for the rows, returning an inserted flag per row written
+        """
+        stmt = insert(self.table).values(rows).returning(inserted_column)
+        if not self.update and not self.keep:
+            return stmt.on_conflict_do_nothing(index_elements=[self.key])
+        changes = {column: stmt.excluded[column] for column in self.update}
+        changes.update({column: func.coalesce(stmt.excluded[column], self.table.c[column]) for column in self.keep})
+        # Rows that would not change are left alone, saving a dead tuple each and keeping rowcount meaningful.
+        changed = [stmt.excluded[column].is_distinct_from(self.table.c[column]) for column in self.update]
+        changed += [and_(stmt.excluded[column].isnot(None),
+                         stmt.excluded[column].is_distinct_from(self.table.c[column])) for column in self.keep]
+        return stmt.on_conflict_do_update(index_elements=[self.key], set_=changes, where=or_(*changed))
+
+
+class BatchWriter(object):
+    """
+    Buffers rows per table and writes them in batches.
+    """
+
+    def __init__(self, session, tables, max_rows=500, max_delay=0.25, on_failed=None, on_written=None,
+                 manager=transaction.manager):
+        """
+        :param session: A DB session registered with the transaction manager
+        :param tables: Dict of table name to TableBatch, in the order tables must be written in
+        :param max_rows: Number of buffered rows that triggers a write
+        :param max_delay: Seconds the oldest buffered row may wait for a write
+        :param on_failed: Called as on_failed(session, name, row, error) for rows the database rejects. Returning
+            True retries the row once, e.g. after adding a missing system.
+        :param on_written: Called as on_written(name, keys) after a commit, with the keys of the rows now in a table
+        :param manager: The transaction manager
+        """
+        self.session = session
+        self.tables = tables
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.on_failed = on_failed
+        self.on_written = on_written
+        self.manager = manager
+        self.pending = collections.OrderedDict((name, collections.OrderedDict()) for name in tables)
+        self.count = 0
+        self.oldest = None
+        # Rows the database rejected, by table name.
+        self.failed = collections.Counter()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, name, row):
+        """
+        Buffers a row. A row with the same key as a buffered one is merged into it, newer values winning
+        unless they are None, since one statement can't touch the same row twice. Rows are newer by their
+        table's newest column if it has one, else by arrival.
+        :param name: The table name
+        :param row: Dict of column values
+        """
+        rows = self.pending[name]
+        batch = self.tables[name]
+        key = row[batch.key]
+        if key in rows:
+            buffered = rows[key]
+            newest = getattr(batch, 'newest', None)
+            if newest and row.get(newest) is not None and buffered.get(newest) is not None \
+                    and row[newest] < buffered[newest]:
+                # An older observation only fills in what the newer one left out.
+                for column, value in row.items():
+                    if buffered.get(column) is None:
+                        buffered[column] = value
+            else:
+                buffered.update({column: value for column, value in row.items() if value is not None})
+        else:
+            rows[key] = dict(row)
+            self.count += 1
+            if self.oldest is None:
+                self.oldest = time.time()
+
+    def timeout(self):
+        """
+        :return: Seconds until the buffered rows are due to be written, or None if there are none
+        """
+        if self.oldest is None:
+            return None
+        return max(self.oldest + self.max_delay - time.time(), 0.0)
+
+    def due(self):
+        return self.count >= self.max_rows or (self.oldest is not None and self.timeout() == 0)
+
+    def flush(self):
+        """
+        Writes all buffered rows and commits.
+        :return: Dict of table name to Written counts
+        """
+        written = {}
+        keys = {}
+        try:
+            for name, batch in self.tables.items():
+                rows = list(self.pending[name].values())
+                if rows:
+                    written[name], keys[name] = self._write(name, batch, rows)
+            mark_changed(self.session)
+            self.manager.commit()
+            if self.on_written:
+                for name, table_keys in keys.items():
+                    self.on_written(name, table_keys)
+        except Exception:
+            self.manager.abort()
+            raise
+        finally:
+            for rows in self.pending.values():
+                rows.clear()
+            self.count = 0
+            self.oldest = None
+        return written
+
+    def _execute(self, statement):
+        with self.session.begin_nested():
+            flags = [row.inserted for row in self.session.execute(statement)]
+        return Written(sum(flags), len(flags) - sum(flags))
+
+    def _write(self, name, batch, rows):
+        columns = set().union(*rows)
+        rows = [{column: row.get(column) for column in columns} for row in rows]
+        try:
+            return self._execute(batch.statement(rows)), [row[batch.key] for row in rows]
+        except (DataError, IntegrityError) as e:
+            print(f"Batch of {len(rows)} {name} rejected, writing them one by one: {e.orig}")
+        inserted = updated = 0
+        keys = []
+        for row in rows:
+            for attempt in (1, 2):
+                try:
+                    written = self._execute(batch.statement([row]))
+                    inserted += written.inserted
+                    updated += written.updated
+                    keys.append(row[batch.key])
+                    break
+                except (DataError, IntegrityError) as e:
+                    if attempt == 2 or not (self.on_failed and self.on_failed(self.session, name, row, e)):
+                        self.failed[name] += 1
+                        break
+        return Written(inserted, updated), keys
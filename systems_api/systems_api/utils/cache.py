@@ -0,0 +1,168 @@
+"""
+Result caches for lookups that are repeated often, such as /mecha during a rescue.
+
+A ResultCache counts hits and misses over a backend, which stores values as JSON strings so every
+hit hands out a fresh copy. LocalBackend keeps entries in-process, and is what tests and single
+worker setups use. RedisBackend shares entries between workers, and needs the optional redis
+package (pip install systems_api[redis]).
+"""
+import collections
+import json
+import threading
+import time
+
+
+class LocalBackend(object):
+    """
+    In-process LRU cache with a TTL on every entry.
+    """
+
+    def __init__(self, size=10000, ttl=300):
+        """
+        :param size: Maximum number of entries kept
+        :param ttl: Seconds an entry stays valid
+        """
+        self.size = size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend(object):
+    """
+    Cache shared between workers through Redis. Redis expires entries after the TTL; size limits are
+    left to the Redis server's maxmemory policy.
+    """
+
+    def __init__(self, url, ttl=300, prefix='systems_api:'):
+        """
+        :param url: Redis URL, e.g. redis://localhost:6379/0
+        :param ttl: Seconds an entry stays valid
+        :param prefix: Prefix for all keys, so several caches can share a database
+        """
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+
+class ResultCache(object):
+    """
+    Caches results by key over a backend, counting hits and misses. Backend errors are treated as
+    misses, so a cache outage never takes lookups down with it.
+    """
+
+    def __init__(self, backend):
+        """
+        :param backend: A LocalBackend, RedisBackend or anything with get(key) and set(key, value) of strings
+        """
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        # Requests are served by several threads at once.
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        """
+        Looks up a cached result.
+        :param key: The cache key
+        :return: The cached value, or None
+        """
+        try:
+            value = self.backend.get(key)
+            if value is not None:
+                value = json.loads(value)
+        except Exception as e:
+            print(f"Cache backend error on get: {e}")
+            self._count('errors')
+            value = None
+        self._count('misses' if value is None else 'hits')
+        return value
+
+    def set(self, key, value):
+        """
+        Stores a result.
+        :param key: The cache key
+        :param value: A JSON serializable value
+        """
+        try:
+            self.backend.set(key, json.dumps(value))
+        except Exception as e:
+            print(f"Cache backend error on set: {e}")
+            self._count('errors')
+
+    def stats(self):
+        """
+        :return: A dict of the hit, miss and error counters of this process
+        """
+        with self._lock:
+            hits, misses, errors = self.hits, self.misses, self.errors
+        total = hits + misses
+        return {'hits': hits, 'misses': misses, 'errors': errors, 'hit_ratio': hits / total if total else 0.0,
+                'backend': type(self.backend).__name__}
+
+
+def cache_from_settings(settings, prefix):
+    """
+    Creates a ResultCache configured by prefix.url, prefix.size and prefix.ttl settings. Without a URL
+    the cache is local to the process.
+    :param settings: The application settings
+    :param prefix: The settings prefix, e.g. 'mecha_cache'
+    :return: A ResultCache
+    """
+    ttl = int(settings.get(f'{prefix}.ttl', 300))
+    url = settings.get(f'{prefix}.url')
+    if url:
+        return ResultCache(RedisBackend(url, ttl, prefix=f'systems_api:{prefix}:'))
+    return ResultCache(LocalBackend(int(settings.get(f'{prefix}.size', 10000)), ttl))
+
+
+def includeme(config):
+    """
+    Register the result caches with the application.
+
+    Activate this setup using ``config.include('systems_api.utils.cache')``.
+
+    """
+    config.registry['mecha_cache'] = cache_from_settings(config.get_settings(), 'mecha_cache')
@@ -0,0 +1,91 @@
+"""
+Append-only log of raw EDDN frames, for replaying traffic later.
+
+Each record is a 4 byte big-endian length, an 8 byte receive timestamp and the compressed frame as it came off
+the socket. Logs rotate to a new file once they reach a size limit, and the oldest are deleted beyond a count
+limit. A record cut short by a crash ends reading of its file, without losing the records before it.
+"""
+import datetime
+import os
+import struct
+
+header = struct.Struct('>Id')
+
+
+class FrameLog(object):
+    """
+    Writes frames to rotating log files in a directory.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, keep=0):
+        """
+        :param directory: Directory for the log files, created if missing
+        :param max_bytes: Size at which a new file is started
+        :param keep: Number of files kept, 0 to keep them all
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _rotate(self):
+        if self.file:
+            self.file.close()
+        now = datetime.datetime.utcnow()
+        # Names sort in time order; never reuse one, even when rotating twice within a microsecond.
+        while os.path.exists(os.path.join(self.directory, now.strftime('eddn-%Y%m%dT%H%M%S%f.log'))):
+            now += datetime.timedelta(microseconds=1)
+        self.file = open(os.path.join(self.directory, now.strftime('eddn-%Y%m%dT%H%M%S%f.log')), 'ab')
+        if self.keep:
+            for old in log_files(self.directory)[:-self.keep]:
+                os.remove(old)
+
+    def write(self, frame, timestamp):
+        """
+        Appends a frame, starting a new file first if the current one is full.
+        :param frame: The compressed frame
+        :param timestamp: Unix time the frame was received
+        """
+        if self.file is None or self.file.tell() >= self.max_bytes:
+            self._rotate()
+        self.file.write(header.pack(len(frame), timestamp))
+        self.file.write(frame)
+        # Hand every frame to the OS, so a crash of this process loses nothing already received.
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def log_files(path):
+    """
+    :param path: A log file, or a directory of them
+    :return: List of log file paths, oldest first
+    """
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.startswith('eddn-') and name.endswith('.log'))
+
+
+def read_frames(path):
+    """
+    Reads frames back from a log file or directory, in the order they were received.
+    :param path: A log file, or a directory of them
+    :return: Iterable of (timestamp, frame) tuples
+    """
+    for filename in log_files(path):
+        with open(filename, 'rb') as log:
+            while True:
+                record = log.read(header.size)
+                if len(record) < header.size:
+                    break
+                length, timestamp = header.unpack(record)
+                frame = log.read(length)
+                if len(frame) < length:
+                    print(f"Skipping truncated frame at the end of {filename}.")
+                    break
+                yield timestamp, frame
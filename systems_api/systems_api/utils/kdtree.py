@@ -0,0 +1,125 @@
+"""
+A small static KD-tree over points in 3D space, for in-process nearest-neighbour lookups.
+
+Leaves hold small buckets of points which are scanned with numpy, so the Python-level
+traversal only has to touch a handful of nodes per query.
+"""
+import numpy
+
+
+class KDTree(object):
+    """
+    Static KD-tree built once from an array of points. Rebuild it to pick up new points.
+    """
+
+    def __init__(self, points, leafsize=64):
+        """
+        Builds the tree.
+        :param points: An (n, 3) array-like of coordinates
+        :param leafsize: Maximum number of points held in a leaf bucket
+        """
+        self.points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+        self.leafsize = max(int(leafsize), 1)
+        self._order = numpy.arange(len(self.points))
+        # Each node is [start, end, axis, split, left, right]; leaves have axis -1.
+        self._nodes = []
+        if len(self.points):
+            self._build(0, len(self.points))
+        # Leaf buckets are scanned as contiguous slices of the points in tree order.
+        self._tree_points = self.points[self._order]
+
+    def __len__(self):
+        return len(self.points)
+
+    def _build(self, start, end):
+        node = len(self._nodes)
+        self._nodes.append([start, end, -1, 0.0, -1, -1])
+        if end - start <= self.leafsize:
+            return node
+        idx = self._order[start:end]
+        pts = self.points[idx]
+        axis = int(numpy.argmax(pts.max(axis=0) - pts.min(axis=0)))
+        mid = (end - start) // 2
+        part = numpy.argpartition(pts[:, axis], mid)
+        self._order[start:end] = idx[part]
+        split = self.points[self._order[start + mid], axis]
+        left = self._build(start, start + mid)
+        right = self._build(start + mid, end)
+        self._nodes[node][2:] = [axis, split, left, right]
+        return node
+
+    def query(self, point, k=1, max_distance=None):
+        """
+        Finds the k nearest points to a position.
+        :param point: An (x, y, z) position
+        :param k: Number of neighbours to return
+        :param max_distance: Optional cutoff; points further away than this are never returned
+        :return: A tuple of (distances, indices) as numpy arrays, nearest first
+        """
+        point = numpy.asarray(point, dtype=numpy.float64)
+        k = min(int(k), len(self.points))
+        if k < 1:
+            return numpy.empty(0), numpy.empty(0, dtype=numpy.intp)
+        bound = numpy.inf if max_distance is None else float(max_distance) ** 2
+        best_d = numpy.empty(0)
+        best_i = numpy.empty(0, dtype=numpy.intp)
+        # Stack entries carry the squared distance to the splitting plane that separates them
+        # from the query point, so branches can be skipped once the bound has tightened.
+        stack = [(0, 0.0)]
+        while stack:
+            node, plane = stack.pop()
+            if plane > bound:
+                continue
+            start, end, axis, split, left, right = self._nodes[node]
+            if axis < 0:
+                d2 = ((self._tree_points[start:end] - point) ** 2).sum(axis=1)
+                keep = numpy.flatnonzero(d2 <= bound)
+                if not len(keep):
+                    continue
+                best_d = numpy.concatenate((best_d, d2[keep]))
+                best_i = numpy.concatenate((best_i, keep + start))
+                if len(best_d) > k:
+                    part = numpy.argpartition(best_d, k - 1)[:k]
+                    best_d, best_i = best_d[part], best_i[part]
+                if len(best_d) == k:
+                    bound = min(bound, best_d.max())
+                continue
+            diff = point[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            # Push the far side first so the near side is searched first and tightens the bound.
+            stack.append((far, diff * diff))
+            stack.append((near, plane))
+        order = numpy.argsort(best_d)
+        return numpy.sqrt(best_d[order]), self._order[best_i[order]]
+
+    def query_radius(self, point, radius):
+        """
+        Finds all points within a radius of a position.
+        :param point: An (x, y, z) position
+        :param radius: Search radius
+        :return: A tuple of (distances, indices) as numpy arrays, nearest first
+        """
+        point = numpy.asarray(point, dtype=numpy.float64)
+        bound = float(radius) ** 2
+        found_d = []
+        found_i = []
+        stack = [0] if len(self.points) else []
+        while stack:
+            start, end, axis, split, left, right = self._nodes[stack.pop()]
+            if axis < 0:
+                d2 = ((self._tree_points[start:end] - point) ** 2).sum(axis=1)
+                keep = numpy.flatnonzero(d2 <= bound)
+                found_d.append(d2[keep])
+                found_i.append(keep + start)
+                continue
+            diff = point[axis] - split
+            if diff < 0 or diff * diff <= bound:
+                stack.append(left)
+            if diff >= 0 or diff * diff <= bound:
+                stack.append(right)
+        if not found_d:
+            return numpy.empty(0), numpy.empty(0, dtype=numpy.intp)
+        d2 = numpy.concatenate(found_d)
+        idx = numpy.concatenate(found_i)
+        order = numpy.argsort(d2)
+        return numpy.sqrt(d2[order]), self._order[idx[order]]
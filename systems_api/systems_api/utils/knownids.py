@@ -0,0 +1,105 @@
+"""
+Exact membership set of known ID64s, so the EDDN client can skip writes for systems and stars we already have.
+
+Known IDs are kept as a sorted int64 array, looked up by binary search, plus a set of IDs added since. Snapshots
+of the arrays are written by the build_known_ids_snapshot command and memory-mapped, so starting the client
+doesn't mean reading every ID from the database. IDs added after a snapshot was taken just look new, which
+costs a write that turns out to do nothing.
+"""
+import numpy
+from sqlalchemy import text
+
+# Tables whose ID64s are tracked, by the table name the batch writer uses.
+known_tables = ('systems', 'stars')
+
+
+class KnownIds(object):
+    """
+    Sorted array of ID64s with a delta set of newer ones.
+    """
+
+    def __init__(self, ids=None, compact_at=1000000):
+        """
+        :param ids: Sorted, unique int64 array of known IDs, which may be memory-mapped
+        :param compact_at: Size of the delta at which it is merged into the array
+        """
+        self.ids = numpy.zeros(0, dtype=numpy.int64) if ids is None else ids
+        self.delta = set()
+        self.compact_at = compact_at
+
+    def __len__(self):
+        return len(self.ids) + len(self.delta)
+
+    def __contains__(self, id64):
+        if not -2 ** 63 <= id64 < 2 ** 63:
+            return False
+        if id64 in self.delta:
+            return True
+        i = numpy.searchsorted(self.ids, id64)
+        return i < len(self.ids) and self.ids[i] == id64
+
+    def add(self, ids):
+        """
+        Records IDs as known, merging the delta into the array once it has grown large.
+        :param ids: Iterable of ID64s
+        """
+        self.delta.update(ids)
+        if len(self.delta) >= self.compact_at:
+            self.ids = numpy.union1d(self.ids, numpy.fromiter(self.delta, dtype=numpy.int64, count=len(self.delta)))
+            self.delta.clear()
+
+
+def query_sorted_ids(session, table, chunk=1000000):
+    """
+    Reads all ID64s of a table, in order.
+    :param session: A DB session
+    :param table: One of known_tables
+    :param chunk: Number of IDs fetched at a time
+    :return: A sorted int64 array
+    """
+    if table not in known_tables:
+        raise ValueError(f"Unknown table {table}")
+    result = session.connection().execution_options(stream_results=True). \
+        execute(text(f"SELECT id64 FROM {table} ORDER BY id64"))
+    chunks = []
+    while True:
+        rows = result.fetchmany(chunk)
+        if not rows:
+            break
+        chunks.append(numpy.fromiter((row[0] for row in rows), dtype=numpy.int64, count=len(rows)))
+    return numpy.concatenate(chunks) if chunks else numpy.zeros(0, dtype=numpy.int64)
+
+
+def snapshot_path(path, table):
+    return f'{path}.{table}.npy'
+
+
+def load_known_ids(path=None, session=None):
+    """
+    Loads the known IDs of every tracked table, from a snapshot if one is given, else from the database.
+    :param path: Path prefix of a snapshot written by build_known_ids_snapshot
+    :param session: A DB session, used when there is no snapshot
+    :return: Dict of table name to KnownIds
+    """
+    known = {}
+    for table in known_tables:
+        if path:
+            known[table] = KnownIds(numpy.load(snapshot_path(path, table), mmap_mode='r'))
+        else:
+            known[table] = KnownIds(query_sorted_ids(session, table))
+    return known
+
+
+def write_known_ids(path, session):
+    """
+    Writes a snapshot of the known IDs of every tracked table.
+    :param path: Path prefix of the snapshot files
+    :param session: A DB session
+    :return: Dict of table name to number of IDs written
+    """
+    counts = {}
+    for table in known_tables:
+        ids = query_sorted_ids(session, table)
+        numpy.save(snapshot_path(path, table), ids)
+        counts[table] = len(ids)
+    return counts
@@ -0,0 +1,89 @@
+"""
+Latency histograms, counted per worker process.
+"""
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in milliseconds. Anything slower lands in a final overflow bucket.
+default_buckets = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class LatencyHistogram(object):
+    """
+    Counts timings into fixed buckets, keeping a total so the mean can be reported as well.
+    """
+
+    def __init__(self, buckets=default_buckets):
+        """
+        :param buckets: Ascending bucket upper bounds, in milliseconds
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, ms):
+        """
+        Records one timing.
+        :param ms: The timing, in milliseconds
+        """
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+            self.count += 1
+            self.total += ms
+
+    def stats(self):
+        """
+        :return: A dict with the count, mean and per-bucket counts, keyed by bucket upper bound
+        """
+        labels = [f'<={bound}ms' for bound in self.buckets] + [f'>{self.buckets[-1]}ms']
+        return {'count': self.count, 'mean_ms': self.total / self.count if self.count else 0.0,
+                'buckets': dict(zip(labels, self.counts))}
+
+
+class LatencyRecorder(object):
+    """
+    A set of histograms by name, created as names are first seen.
+    """
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram(self.buckets)
+            return self.histograms[name]
+
+    @contextlib.contextmanager
+    def time(self, name):
+        """
+        Times the enclosed block into the named histogram.
+        :param name: The histogram name, e.g. a search type
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name).observe((time.perf_counter() - start) * 1000)
+
+    def stats(self):
+        """
+        :return: A dict of histogram stats by name
+        """
+        return {name: histogram.stats() for name, histogram in sorted(self.histograms.items())}
+
+
+def includeme(config):
+    """
+    Register the latency recorders with the application.
+
+    Activate this setup using ``config.include('systems_api.utils.metrics')``.
+
+    """
+    config.registry['search_latency'] = LatencyRecorder()
@@ -0,0 +1,154 @@
+"""
+Enumeration of the procedurally generated boxels around a position, used to estimate where systems we
+have no data for are likely to be. Only the regular PG grid is used, so boxels inside hand-authored
+regions are named as if the region was not there.
+"""
+import collections
+import functools
+import math
+
+from . import pgnames
+from . import sector
+from . import system_internal
+from . import vector3
+
+# Mass codes whose boxels mostly hold main sequence primaries, which are usually scoopable.
+# Codes 'a' and 'b' are dominated by brown dwarfs and would also mean enumerating thousands of tiny boxels.
+scoopable_mass_codes = 'cdefgh'
+
+Boxel = collections.namedtuple('Boxel', ['name', 'mass_code', 'x', 'y', 'z', 'uncertainty'])
+"""A boxel's name prefix (e.g. 'Eol Prou LW-L c8-'), mass code, estimated centre and half width."""
+
+
+@functools.lru_cache(maxsize=65536)
+def get_boxel(mcode, ix, iy, iz):
+    """
+    Gets the name and centre of a boxel. Results are cached, so repeat lookups in the same area only
+    pay for the naming once.
+    :param mcode: The boxel's mass code ('a'-'h')
+    :param ix: Index of the boxel along X, counted in boxel widths from the galaxy's internal origin
+    :param iy: Index of the boxel along Y
+    :param iz: Index of the boxel along Z
+    :return: A Boxel, or None if the position can not be named
+    """
+    width = sector.get_mcode_cube_width(mcode)
+    origin = sector.internal_origin_offset
+    centre = vector3.Vector3(origin.x + (ix + 0.5) * width, origin.y + (iy + 0.5) * width,
+                             origin.z + (iz + 0.5) * width)
+    sect = pgnames.get_sector(centre, allow_ha=False)
+    if sect is None or sect.name is None:
+        return None
+    relpos = centre - sect.get_origin(width)
+    sysid = pgnames._get_sysid_from_relpos(relpos, mcode, format_output=True)
+    return Boxel(f"{sect.name} {sysid}", mcode, centre.x, centre.y, centre.z, width / 2)
+
+
+def boxels_near(pos, radius, mass_codes=scoopable_mass_codes):
+    """
+    Enumerates every boxel of the given mass codes that overlaps a sphere around a position.
+    :param pos: An (x, y, z) position
+    :param radius: Radius of the sphere, in ly
+    :param mass_codes: Mass codes to enumerate
+    :return: List of (distance to boxel centre, Boxel) tuples, nearest first
+    """
+    origin = sector.internal_origin_offset
+    rel = (pos[0] - origin.x, pos[1] - origin.y, pos[2] - origin.z)
+    found = []
+    for mcode in mass_codes:
+        width = sector.get_mcode_cube_width(mcode)
+        ranges = [range(math.floor((p - radius) / width), math.floor((p + radius) / width) + 1) for p in rel]
+        for ix in ranges[0]:
+            dx = max(ix * width - rel[0], 0.0, rel[0] - (ix + 1) * width)
+            for iy in ranges[1]:
+                dy = max(iy * width - rel[1], 0.0, rel[1] - (iy + 1) * width)
+                for iz in ranges[2]:
+                    dz = max(iz * width - rel[2], 0.0, rel[2] - (iz + 1) * width)
+                    # Skip boxels whose closest point lies outside the sphere.
+                    if dx * dx + dy * dy + dz * dz > radius * radius:
+                        continue
+                    boxel = get_boxel(mcode, ix, iy, iz)
+                    if boxel is not None:
+                        dist = math.sqrt((boxel.x - pos[0]) ** 2 + (boxel.y - pos[1]) ** 2 + (boxel.z - pos[2]) ** 2)
+                        found.append((dist, boxel))
+    found.sort(key=lambda b: b[0])
+    return found
+
+
+def get_boxel_name(name):
+    """
+    Gets the boxel name prefix of a PG system name, in the same form as Boxel.name.
+    :param name: A system name, such as 'Eol Prou LW-L c8-15'
+    :return: The boxel name prefix, or None if the name is not a PG system name
+    """
+    frags = pgnames.get_system_fragments(name)
+    if frags is None or frags['SectorName'] is None:
+        return None
+    boxel = f"{frags['SectorName']} {frags['L1']}{frags['L2']}-{frags['L3']} {frags['MCode'].lower()}"
+    if frags['N1']:
+        boxel += f"{frags['N1']}-"
+    return boxel
+
+
+def fits_sector(frags):
+    """
+    Checks that the numbers in a PG system name fit the fields of an ID64. Names past the limits are
+    well-formed, but would wrap around to the ID64 of a different system.
+    :param frags: The fragments of a PG system name, from pgnames.get_system_fragments
+    :return: True if the boxel lies inside its sector and N2 fits its mass code's bits
+    """
+    mc = ord(frags['MCode'].lower()) - ord('a')
+    if not 0 <= frags['N2'] < 2 ** (11 + 3 * mc):
+        return False
+    # The letters and N1 count boxels along rows of 128, whatever the mass code; only the first
+    # 128 >> mc of each row, stack and layer are inside the sector.
+    soffset = pgnames._get_soffset_from_sysid(frags['L1'], frags['L2'], frags['L3'], frags['N1'])
+    side = 2 ** (7 - mc)
+    row, rest = divmod(soffset, 128 * 128)
+    stack, column = divmod(rest, 128)
+    return row < side and stack < side and column < side
+
+
+def get_pg_id64(name):
+    """
+    Computes the ID64 a PG system name stands for, without touching the database.
+    :param name: A system name, such as 'Eol Prou RS-T d3-94'
+    :return: The ID64, or None if the name is not a valid PG system name or its numbers are out of range
+    """
+    frags = pgnames.get_system_fragments(name)
+    if frags is None or frags['SectorName'] is None or not fits_sector(frags):
+        return None
+    estimate = pgnames.get_system(pgnames.format_system_name(frags))
+    if not estimate:
+        return None
+    pos = vector3.Vector3(estimate['coords']['x'], estimate['coords']['y'], estimate['coords']['z'])
+    return system_internal.calculate_id64(pos, frags['MCode'], frags['N2'])
+
+
+def get_pg_neighbours(name):
+    """
+    Enumerates the names one typo away from a PG system name in the same sector, where one of the
+    letters or numbers is off by one, along with their ID64s.
+    :param name: A system name, such as 'Eol Prou RS-T d3-94'
+    :return: A dict of ID64 to neighbouring name, empty if the name is not a valid PG system name
+    """
+    frags = pgnames.get_system_fragments(name)
+    if frags is None or frags['SectorName'] is None:
+        return {}
+    neighbours = {}
+    for field in ('L1', 'L2', 'L3', 'N1', 'N2'):
+        for step in (-1, 1):
+            variant = dict(frags)
+            if field.startswith('L'):
+                letter = ord(frags[field].upper()) + step
+                if not ord('A') <= letter <= ord('Z'):
+                    continue
+                variant[field] = chr(letter)
+            else:
+                if frags[field] + step < 0:
+                    continue
+                variant[field] = frags[field] + step
+            variant_name = pgnames.format_system_name(variant)
+            id64 = get_pg_id64(variant_name)
+            if id64 is not None:
+                neighbours[id64] = variant_name
+    return neighbours
@@ -0,0 +1,119 @@
+"""
+Thread stages connected by bounded queues, for the EDDN client.
+
+A receiver thread only moves frames off the socket, parser threads decompress and decode them, and the main
+thread writes to the database. The queues between them absorb slow database writes; when one fills up anyway,
+the stage feeding it waits, and the stall is counted so backpressure shows up in the stats.
+"""
+import collections
+import queue
+import threading
+import time
+
+STOP = object()
+"""Put on a stage's input queue to shut the stage's threads down."""
+
+
+class StageStats(object):
+    """
+    Counters shared by the stages: items handled and failed per stage, stalls on full queues, and the deepest
+    each queue has been.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.stall_seconds = collections.Counter()
+        self.max_depth = collections.Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def stalled(self, name, seconds):
+        with self._lock:
+            self.counts[f'{name}_stalls'] += 1
+            self.stall_seconds[name] += seconds
+
+    def depth(self, name, q):
+        """
+        Records the current depth of a queue.
+        :param name: The queue name
+        :param q: The queue
+        :return: The depth
+        """
+        size = q.qsize()
+        with self._lock:
+            if size > self.max_depth[name]:
+                self.max_depth[name] = size
+        return size
+
+    def snapshot(self, reset=False):
+        """
+        :param reset: Clear the counters after reading them
+        :return: Dict of counts, stall seconds and maximum queue depths
+        """
+        with self._lock:
+            stats = {'counts': dict(self.counts), 'stall_seconds': dict(self.stall_seconds),
+                     'max_depth': dict(self.max_depth)}
+            if reset:
+                self.counts.clear()
+                self.stall_seconds.clear()
+                self.max_depth.clear()
+        return stats
+
+
+def feed(q, item, stats, name):
+    """
+    Puts an item on a queue, waiting for room if it is full and counting the wait as a stall.
+    :param q: The queue
+    :param item: The item
+    :param stats: The StageStats
+    :param name: The queue name
+    """
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        start = time.monotonic()
+        q.put(item)
+        stats.stalled(name, time.monotonic() - start)
+    stats.depth(name, q)
+
+
+def run_stage(name, work, inbox, outbox, outbox_name, stats):
+    """
+    Runs a stage until STOP comes in: every item from the inbox goes through work, and what it returns goes
+    to the outbox. Items work raises an exception for are counted as failed and dropped.
+    :param name: The stage name
+    :param work: Function of one item, returning the item for the next stage
+    :param inbox: The input queue
+    :param outbox: The output queue
+    :param outbox_name: Name of the output queue in the stats
+    :param stats: The StageStats
+    """
+    while True:
+        item = inbox.get()
+        if item is STOP:
+            # Leave it for the other threads of this stage.
+            inbox.put(STOP)
+            return
+        try:
+            result = work(item)
+        except Exception as e:
+            stats.count(f'{name}_failed')
+            print(f"{name} stage failed on an item: {e}")
+            continue
+        stats.count(name)
+        feed(outbox, result, stats, outbox_name)
+
+
+def start_stage(name, work, inbox, outbox, outbox_name, stats, threads=1):
+    """
+    Starts a stage's daemon threads.
+    :return: The list of threads
+    """
+    workers = [threading.Thread(target=run_stage, args=(name, work, inbox, outbox, outbox_name, stats),
+                                name=f'{name}-{i}', daemon=True) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    return workers
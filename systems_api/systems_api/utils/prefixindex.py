@@ -0,0 +1,308 @@
+"""
+Compact prefix index over system names for typeahead completions.
+
+Names are kept as one UTF-8 blob sorted by lowercased name, with an array of offsets into it, and
+prefixes are found by binary search. Snapshots of the blob and offsets are written by the
+build_typeahead_snapshot command and memory-mapped, so a worker only pages in the parts it touches.
+Systems added after the snapshot are kept in a small sorted in-memory delta.
+"""
+import array
+import bisect
+import datetime
+import json
+import mmap
+import threading
+import time
+
+import numpy
+from pyramid.events import ApplicationCreated
+from sqlalchemy import func
+from sqlalchemy.exc import DBAPIError
+
+from ..models import System
+
+
+class PrefixIndex(object):
+    """
+    Sorted array of system names with binary search prefix lookups, plus a delta of newer names.
+    """
+
+    def __init__(self, blob, offsets, built=None, extra=()):
+        """
+        :param blob: Bytes-like object of concatenated UTF-8 names, sorted by lowercased name
+        :param offsets: Array of len(names) + 1 offsets into the blob
+        :param built: Datetime the names were read from the database
+        :param extra: Additional names which go into the delta, e.g. ones that could not be sorted into the blob
+        """
+        self.blob = blob
+        self.offsets = offsets
+        self.built = built
+        self._delta = []
+        self._delta_names = set()
+        self._lock = threading.Lock()
+        self.add(extra)
+
+    def __len__(self):
+        return len(self.offsets) - 1 + len(self._delta)
+
+    def _name(self, i):
+        return bytes(self.blob[int(self.offsets[i]):int(self.offsets[i + 1])]).decode('utf-8')
+
+    def _lower_bound(self, key):
+        lo, hi = 0, len(self.offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid).lower() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __contains__(self, name):
+        if name in self._delta_names:
+            return True
+        i = self._lower_bound(name.lower())
+        while i < len(self.offsets) - 1:
+            candidate = self._name(i)
+            if candidate.lower() != name.lower():
+                return False
+            if candidate == name:
+                return True
+            i += 1
+        return False
+
+    def add(self, names):
+        """
+        Adds names to the delta, skipping ones already indexed.
+        :param names: Iterable of system names
+        :return: Number of names added
+        """
+        added = 0
+        for name in names:
+            if not name or name in self:
+                continue
+            with self._lock:
+                bisect.insort(self._delta, (name.lower(), name))
+                self._delta_names.add(name)
+            added += 1
+        return added
+
+    def complete(self, prefix, limit=10):
+        """
+        Finds names starting with a prefix, ignoring case.
+        :param prefix: The prefix typed so far
+        :param limit: Maximum number of completions
+        :return: List of unique names, in case-insensitive alphabetical order
+        """
+        key = prefix.lower()
+        found = []
+        # Duplicate names are skipped as they are scanned, so they don't use up the limit.
+        seen = set()
+        i = self._lower_bound(key)
+        while i < len(self.offsets) - 1 and len(found) < limit:
+            name = self._name(i)
+            if not name.lower().startswith(key):
+                break
+            if name not in seen:
+                seen.add(name)
+                found.append((name.lower(), name))
+            i += 1
+        delta = self._delta
+        j = bisect.bisect_left(delta, (key,))
+        for lname, name in delta[j:j + limit]:
+            if not lname.startswith(key):
+                break
+            if name not in seen:
+                seen.add(name)
+                found.append((lname, name))
+        return [name for _, name in sorted(found)[:limit]]
+
+
+def _pack(names, write):
+    # A typed array holds 8 bytes per offset, where a list of ints would hold a Python object each.
+    offsets = array.array('q', [0])
+    extra = []
+    last = ''
+    end = 0
+    for name in names:
+        if not name:
+            continue
+        if name.lower() < last:
+            extra.append(name)
+            continue
+        last = name.lower()
+        data = name.encode('utf-8')
+        write(data)
+        end += len(data)
+        offsets.append(end)
+    return numpy.frombuffer(offsets, dtype=numpy.int64), extra
+
+
+def build_arrays(names):
+    """
+    Packs names, which must already be sorted by their lowercase form, into a blob and offsets.
+    Names that break the order (the database's lower() and Python's can disagree outside ASCII) are
+    returned separately rather than corrupting the binary search.
+    :param names: Iterable of system names, sorted by lower(name)
+    :return: A tuple of (blob bytearray, offsets array, list of out of order names)
+    """
+    blob = bytearray()
+    offsets, extra = _pack(names, blob.extend)
+    return blob, offsets, extra
+
+
+def write_snapshot(path, names, built):
+    """
+    Writes a snapshot to path.names, path.offsets.npy and path.json, streaming names to disk.
+    :param path: Path prefix of the snapshot files
+    :param names: Iterable of system names, sorted by lower(name)
+    :param built: Datetime the names were read from the database
+    :return: Number of names written
+    """
+    with open(f'{path}.names', 'wb') as blob:
+        offsets, extra = _pack(names, blob.write)
+    numpy.save(f'{path}.offsets.npy', offsets)
+    with open(f'{path}.json', 'w') as meta:
+        json.dump({'built': built.isoformat(), 'count': len(offsets) - 1, 'extra': extra}, meta)
+    return len(offsets) - 1 + len(extra)
+
+
+def load_snapshot(path):
+    """
+    Memory-maps a snapshot written by write_snapshot.
+    :param path: Path prefix of the snapshot files
+    :return: A PrefixIndex
+    """
+    with open(f'{path}.json') as meta:
+        meta = json.load(meta)
+    offsets = numpy.load(f'{path}.offsets.npy', mmap_mode='r')
+    with open(f'{path}.names', 'rb') as blob:
+        # An empty file can't be mapped, and doesn't need to be.
+        data = mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b''
+    return PrefixIndex(data, offsets, datetime.datetime.fromisoformat(meta['built']), meta['extra'])
+
+
+def query_sorted_names(session):
+    """
+    Streams all system names from the database, sorted for build_arrays and write_snapshot.
+    :param session: A DB session
+    :return: An iterable of names
+    """
+    # The C collation sorts by code point, the same way Python compares strings.
+    query = session.query(System.name).order_by(func.lower(System.name).collate('C')). \
+        execution_options(stream_results=True)
+    return (row.name for row in query.yield_per(10000))
+
+
+class TypeaheadCache(object):
+    """
+    Holds the typeahead index in the registry, and tops up its delta with systems added since the
+    index was built, at most once per interval.
+    """
+
+    # Systems are polled again for this long after they were inserted, to catch transactions that committed
+    # after later ones, and differences between our clock and the database's. Names already indexed are skipped.
+    overlap = datetime.timedelta(minutes=5)
+
+    def __init__(self, snapshot=None, preload=False, interval=60):
+        """
+        :param snapshot: Path prefix of a snapshot to memory-map, if any
+        :param preload: Build the index from the database when there is no snapshot
+        :param interval: Seconds between delta updates
+        """
+        self.snapshot = snapshot
+        self.preload = preload
+        self.interval = interval
+        self.index = None
+        self.since = None
+        self.checked = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.snapshot or self.preload)
+
+    def load(self, session):
+        with self._lock:
+            if self.snapshot:
+                self.index = load_snapshot(self.snapshot)
+            else:
+                built = datetime.datetime.utcnow()
+                blob, offsets, extra = build_arrays(query_sorted_names(session))
+                self.index = PrefixIndex(blob, offsets, built, extra)
+            self.since = self.index.built.replace(tzinfo=datetime.timezone.utc)
+            self.checked = time.time()
+        return self.index
+
+    def update(self, session):
+        """
+        Adds systems inserted since the last update to the delta.
+        :param session: A DB session
+        :return: Number of names added
+        """
+        rows = session.query(System.name, System.inserted). \
+            filter(System.inserted > self.since - self.overlap).all()
+        added = self.index.add(row.name for row in rows)
+        if rows:
+            self.since = max(self.since, max(row.inserted for row in rows))
+        return added
+
+    def get(self, session):
+        """
+        Returns the index, loading it on first use and updating its delta when due.
+        :param session: A DB session
+        :return: A PrefixIndex, or None if the index is disabled
+        """
+        if not self.enabled:
+            return None
+        if self.index is None:
+            return self.load(session)
+        if time.time() - self.checked > self.interval and self._lock.acquire(blocking=False):
+            try:
+                self.checked = time.time()
+                self.update(session)
+            finally:
+                self._lock.release()
+        return self.index
+
+
+def get_typeahead_index(request):
+    """
+    Returns the typeahead index, if one is configured.
+    :param request: The Pyramid request object
+    :return: A PrefixIndex, or None to fall back to querying the database
+    """
+    return request.registry['typeahead_index'].get(request.dbsession)
+
+
+def warm_typeahead(event):
+    """
+    Loads the typeahead index when the application starts. Failures are not fatal; the index will
+    be loaded on first use instead.
+    """
+    registry = event.app.registry
+    cache = registry['typeahead_index']
+    if not cache.enabled:
+        return
+    session = registry['dbsession_factory']()
+    try:
+        index = cache.load(session)
+        print(f"Typeahead index loaded with {len(index)} names.")
+    except (DBAPIError, OSError, ValueError) as e:
+        print(f"Could not load typeahead index at startup, deferring to first use: {e}")
+    finally:
+        session.close()
+
+
+def includeme(config):
+    """
+    Register the typeahead index with the application.
+
+    Activate this setup using ``config.include('systems_api.utils.prefixindex')``.
+
+    """
+    settings = config.get_settings()
+    preload = settings.get('typeahead.preload', 'false').lower() in ('true', 'yes', 'on', '1')
+    config.registry['typeahead_index'] = TypeaheadCache(settings.get('typeahead.snapshot') or None, preload,
+                                                        int(settings.get('typeahead.delta_interval', 60)))
+    config.add_subscriber(warm_typeahead, ApplicationCreated)
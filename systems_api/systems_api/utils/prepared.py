@@ -0,0 +1,50 @@
+"""
+Server-side prepared statements for queries that run on every request.
+
+psycopg2 interpolates bound parameters on the client, so each query is planned anew by Postgres. A
+PreparedStatement issues PREPARE once per pooled connection and EXECUTEs it from then on, so the plan is
+reused for as long as the connection lives. On other databases, such as the SQLite used by tests, the
+query is run directly with the same bound parameters.
+"""
+import re
+
+from sqlalchemy import text
+
+
+class PreparedStatement(object):
+    """
+    A named query with bound parameters, prepared on each connection the first time it runs there.
+    """
+
+    def __init__(self, name, sql, params):
+        """
+        :param name: Statement name, unique within the application
+        :param sql: Query text, using :name style bound parameters
+        :param params: List of (parameter name, Postgres type) tuples for every parameter in the query
+        """
+        self.name = name
+        self.sql = sql
+        self.params = params
+        positional = sql
+        for i, (param, _) in enumerate(params, 1):
+            positional = re.sub(rf':{param}\b', f'${i}', positional)
+        self.prepare_sql = f"PREPARE {name}({', '.join(pgtype for _, pgtype in params)}) AS {positional}"
+        self.execute_sql = f"EXECUTE {name}({', '.join(':' + param for param, _ in params)})"
+
+    def execute(self, session, **values):
+        """
+        Runs the statement, preparing it first if this connection has not seen it yet.
+        :param session: A DB session
+        :param values: A value for every parameter
+        :return: The result
+        """
+        conn = session.connection()
+        if conn.dialect.name != 'postgresql':
+            return conn.execute(text(self.sql), values)
+        # Prepared statements belong to the DBAPI connection, and so does its info dict; a reconnect
+        # starts with an empty one.
+        prepared = conn.connection.info.setdefault('prepared_statements', set())
+        if self.name not in prepared:
+            conn.execute(text(self.prepare_sql))
+            prepared.add(self.name)
+        return conn.execute(text(self.execute_sql), values)
@@ -0,0 +1,217 @@
+"""
+In-process spatial indexes kept in the application registry.
+"""
+import threading
+import time
+
+import numpy
+from pyramid.events import ApplicationCreated
+from sqlalchemy.exc import DBAPIError
+
+from .kdtree import KDTree
+from ..models import PopulatedSystem, Landmark
+
+
+class PopulatedIndex(object):
+    """
+    Snapshot of all populated systems, with a KD-tree over their coordinates.
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: Iterable of (id64, name, coords, legacy) tuples
+        """
+        ids, names, points, legacy = [], [], [], []
+        for id64, name, coords, is_legacy in rows:
+            try:
+                points.append((float(coords['x']), float(coords['y']), float(coords['z'])))
+            except (TypeError, KeyError, ValueError):
+                print(f"Skipping populated system {name} with bad coordinates: {coords}")
+                continue
+            ids.append(id64)
+            names.append(name)
+            legacy.append(bool(is_legacy))
+        self.id64s = numpy.array(ids, dtype=numpy.int64)
+        self.names = names
+        self.legacy = numpy.array(legacy, dtype=bool)
+        self.tree = KDTree(points)
+        # Legacy lookups get their own tree, so filtering never starves the k-nearest search.
+        self._legacy_idx = numpy.flatnonzero(self.legacy)
+        self.legacy_tree = KDTree(self.tree.points[self._legacy_idx])
+        self.built = time.time()
+
+    def __len__(self):
+        return len(self.names)
+
+    def nearest(self, point, k=10, legacy=False):
+        """
+        Finds the k nearest populated systems to a position.
+        :param point: An (x, y, z) position
+        :param k: Number of systems to return
+        :param legacy: Only consider systems present in legacy mode
+        :return: List of (distance, id64, name) tuples, nearest first
+        """
+        if legacy:
+            dists, idx = self.legacy_tree.query(point, k)
+            idx = self._legacy_idx[idx]
+        else:
+            dists, idx = self.tree.query(point, k)
+        return [(float(d), int(self.id64s[i]), self.names[i]) for d, i in zip(dists, idx)]
+
+
+class LandmarkIndex(object):
+    """
+    Snapshot of all landmarks as arrays, so distances to every landmark are one vectorized operation.
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: Iterable of (name, x, y, z, soi) tuples
+        """
+        names, points, soi = [], [], []
+        for name, x, y, z, radius in rows:
+            if x is None or y is None or z is None:
+                print(f"Skipping landmark {name} with missing coordinates.")
+                continue
+            names.append(name)
+            points.append((float(x), float(y), float(z)))
+            # A landmark without a sphere of influence (or with a zero one) applies everywhere.
+            soi.append(float(radius) if radius else numpy.inf)
+        self.names = names
+        self.points = numpy.array(points, dtype=numpy.float64).reshape(-1, 3)
+        self.soi = numpy.array(soi, dtype=numpy.float64)
+        self.built = time.time()
+
+    def __len__(self):
+        return len(self.names)
+
+    def distances(self, points):
+        """
+        Computes the distance from each position to every landmark.
+        :param points: An (m, 3) array-like of positions
+        :return: An (m, n) array of distances, with infinity wherever a landmark's sphere of influence
+            does not reach the position
+        """
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+        dist = numpy.sqrt(((points[:, None, :] - self.points[None, :, :]) ** 2).sum(axis=2))
+        dist[dist >= self.soi] = numpy.inf
+        return dist
+
+    def nearest_many(self, points):
+        """
+        Finds the landmarks in range of each of several positions.
+        :param points: An (m, 3) array-like of positions
+        :return: One list of (name, distance) tuples per position, nearest first
+        """
+        dist = self.distances(points)
+        results = []
+        for row, order in zip(dist, numpy.argsort(dist, axis=1)):
+            order = order[numpy.isfinite(row[order])]
+            results.append([(self.names[i], float(row[i])) for i in order])
+        return results
+
+    def nearest(self, point):
+        """
+        Finds the landmarks in range of a position.
+        :param point: An (x, y, z) position
+        :return: List of (name, distance) tuples, nearest first
+        """
+        return self.nearest_many([point])[0]
+
+
+class SpatialCache(object):
+    """
+    Holds a lazily (re)built index in the registry. Stale indexes keep serving while a single
+    request rebuilds, so a refresh never stalls concurrent lookups.
+    """
+
+    def __init__(self, loader, ttl):
+        """
+        :param loader: Callable taking a DB session and returning a fresh index
+        :param ttl: Seconds an index is considered fresh
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self.index = None
+        self._lock = threading.Lock()
+
+    def refresh(self, session):
+        with self._lock:
+            self.index = self.loader(session)
+        return self.index
+
+    def get(self, session):
+        index = self.index
+        if index is None:
+            return self.refresh(session)
+        if time.time() - index.built > self.ttl and self._lock.acquire(blocking=False):
+            try:
+                self.index = self.loader(session)
+            finally:
+                self._lock.release()
+        return self.index
+
+    def invalidate(self):
+        self.index = None
+
+
+def load_populated_index(session):
+    rows = session.query(PopulatedSystem.id64, PopulatedSystem.name, PopulatedSystem.coords,
+                         PopulatedSystem.legacy)
+    return PopulatedIndex(rows)
+
+
+def load_landmark_index(session):
+    return LandmarkIndex(session.query(Landmark.name, Landmark.x, Landmark.y, Landmark.z, Landmark.soi))
+
+
+def get_landmark_index(request):
+    """
+    Returns the current landmark index, building it if needed.
+    :param request: The Pyramid request object
+    :return: A LandmarkIndex
+    """
+    return request.registry['landmark_index'].get(request.dbsession)
+
+
+def get_populated_index(request):
+    """
+    Returns the current populated systems index, building it if needed.
+    :param request: The Pyramid request object
+    :return: A PopulatedIndex
+    """
+    return request.registry['populated_index'].get(request.dbsession)
+
+
+def warm_indexes(event):
+    """
+    Builds the spatial indexes when the application starts, so the first lookups don't pay for it.
+    Failures are not fatal; the indexes will be built on first use instead.
+    """
+    registry = event.app.registry
+    session = registry['dbsession_factory']()
+    try:
+        index = registry['populated_index'].refresh(session)
+        print(f"Populated systems index built with {len(index)} systems.")
+        index = registry['landmark_index'].refresh(session)
+        print(f"Landmark index built with {len(index)} landmarks.")
+    except DBAPIError as e:
+        print(f"Could not build spatial indexes at startup, deferring to first use: {e}")
+    finally:
+        session.close()
+
+
+def includeme(config):
+    """
+    Register the spatial indexes with the application.
+
+    Activate this setup using ``config.include('systems_api.utils.spatial')``.
+
+    """
+    settings = config.get_settings()
+    ttl = int(settings.get('spatial.populated_ttl', 900))
+    config.registry['populated_index'] = SpatialCache(load_populated_index, ttl)
+    # Landmarks are invalidated when added through the API, the TTL only covers other workers and direct edits.
+    ttl = int(settings.get('spatial.landmark_ttl', 3600))
+    config.registry['landmark_index'] = SpatialCache(load_landmark_index, ttl)
+    config.add_subscriber(warm_indexes, ApplicationCreated)
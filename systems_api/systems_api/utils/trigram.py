@@ -0,0 +1,99 @@
+"""
+Threshold control for pg_trgm fuzzy name searches.
+
+The trigram operators match anything above a threshold read from a pg_trgm setting, 0.3 by default. On short
+or common names that matches a large part of the table, all of which is then sorted. These helpers set the
+threshold per transaction, and can raise it step by step until the number of candidates is bounded.
+"""
+import collections
+
+from pyramid.settings import asbool
+from sqlalchemy import text
+
+TrigramMode = collections.namedtuple('TrigramMode', ['score', 'condition', 'setting'])
+"""SQL for a mode's score and its indexable match condition, and the pg_trgm setting holding its threshold."""
+
+modes = {
+    'similarity': TrigramMode('similarity(name, :name)', 'name % :name', 'pg_trgm.similarity_threshold'),
+    'word': TrigramMode('word_similarity(:name, name)', ':name <% name', 'pg_trgm.word_similarity_threshold'),
+    'strict_word': TrigramMode('strict_word_similarity(:name, name)', ':name <<% name',
+                               'pg_trgm.strict_word_similarity_threshold'),
+}
+
+TrigramOptions = collections.namedtuple('TrigramOptions', ['mode', 'threshold', 'adaptive', 'max_candidates'])
+
+
+def get_trigram_options(request):
+    """
+    Reads the trigram options of a request, defaulting to the trigram.* settings.
+    :param request: The Pyramid request object
+    :return: A TrigramOptions
+    :raises ValueError: If a parameter is malformed or out of range
+    """
+    settings = request.registry.settings
+    params = request.params
+    mode = params.get('mode', settings.get('trigram.mode', 'similarity'))
+    if mode not in modes:
+        raise ValueError(f"Invalid mode '{mode}', must be one of {', '.join(modes)}.")
+    threshold = float(params.get('threshold', settings.get('trigram.threshold', 0.3)))
+    if not 0 <= threshold <= 1:
+        raise ValueError("Threshold must be between 0 and 1.")
+    adaptive = asbool(params.get('adaptive', settings.get('trigram.adaptive', False)))
+    max_candidates = int(settings.get('trigram.max_candidates', 1000))
+    return TrigramOptions(mode, threshold, adaptive, max_candidates)
+
+
+def set_threshold(session, mode, threshold):
+    """
+    Sets a mode's threshold for the rest of the session's transaction.
+    :param session: A DB session
+    :param mode: A key of modes
+    :param threshold: The threshold, between 0 and 1
+    """
+    session.execute(text("SELECT set_config(:setting, :threshold, true)"),
+                    {'setting': modes[mode].setting, 'threshold': str(threshold)})
+
+
+def count_candidates(session, name, mode, threshold, cap):
+    """
+    Counts the systems matching a name at a threshold, stopping early at cap.
+    :param session: A DB session
+    :param name: The name searched for
+    :param mode: A key of modes
+    :param threshold: The threshold, between 0 and 1
+    :param cap: Count to stop at
+    :return: The number of candidates, at most cap
+    """
+    set_threshold(session, mode, threshold)
+    return session.execute(text(f"SELECT count(*) FROM (SELECT 1 FROM systems WHERE {modes[mode].condition} "
+                                f"LIMIT :cap) AS candidates"), {'name': name, 'cap': cap}).scalar()
+
+
+def adapt_threshold(count, threshold, max_candidates, step=0.1):
+    """
+    Raises a threshold until at most max_candidates systems match it.
+    :param count: Function of (threshold, cap) returning the number of candidates at that threshold, at most cap
+    :param threshold: The threshold to start from
+    :param max_candidates: The number of candidates to get down to
+    :param step: How much to raise the threshold by each time
+    :return: The lowest threshold tried with few enough candidates, or 1.0
+    """
+    while threshold < 1 and count(threshold, max_candidates + 1) > max_candidates:
+        threshold = min(round(threshold + step, 6), 1.0)
+    return threshold
+
+
+def prepare_trigram_search(session, name, options):
+    """
+    Sets the threshold for a trigram search in the session's transaction, raising it first in adaptive mode.
+    :param session: A DB session
+    :param name: The name searched for
+    :param options: A TrigramOptions
+    :return: The threshold used
+    """
+    threshold = options.threshold
+    if options.adaptive:
+        threshold = adapt_threshold(lambda t, cap: count_candidates(session, name, options.mode, t, cap),
+                                    threshold, options.max_candidates)
+    set_threshold(session, options.mode, threshold)
+    return threshold
@@ -61,6 +61,16 @@ def jenkins32(key):
     return key
 
 
+# Shifts value left by bits, and stores new_data in the freed low bits
+def pack_and_shift(value, new_data, bits):
+  return (value << bits) + (new_data & (2**bits - 1))
+
+
+# Splits the low bits off value, returning (value shifted right by bits, the low bits)
+def unpack_and_shift(value, bits):
+  return (value >> bits, value & (2**bits - 1))
+
+
 def checkpermitname(system, permsystems, perms):
     if system not in perms:
         return None
@@ -106,4 +116,35 @@ def deinterleave(val, maxbits):
     out1 |= ((val >> i) & 1) << (i//2)
   for i in range(1, maxbits, 2):
     out2 |= ((val >> i) & 1) << (i//2)
-  return (out1, out2)
\ No newline at end of file
+  return (out1, out2)
+
+# Interleaves three values, starting at least significant bit
+# e.g. (0b11, 0b00, 0b00) --> (0b001001)
+def interleave3(val1, val2, val3, maxbits):
+  output = 0
+  for i in range(0, maxbits):
+    output |= ((val1 >> i) & 1) << (i*3)
+    output |= ((val2 >> i) & 1) << (i*3 + 1)
+    output |= ((val3 >> i) & 1) << (i*3 + 2)
+  return output
+
+
+# Morton key of the boxel an ID64 lives in, at the resolution of the smallest (mass code a) boxels.
+# Ignores the N2 and body fields, so every system and body in a boxel shares a key, and nearby boxels
+# of any mass code get nearby keys. Mirrored by the id64_spatial_key() SQL function used for clustering.
+def id64_spatial_key(id64):
+  mc = id64 & 7
+  z = (id64 >> 3) & (2**(14 - mc) - 1)
+  y = (id64 >> (17 - mc)) & (2**(13 - mc) - 1)
+  x = (id64 >> (30 - 2*mc)) & (2**(14 - mc) - 1)
+  return interleave3(x << mc, y << mc, z << mc, 14)
+
+
+def like_prefix(term):
+    """
+    Builds a LIKE pattern matching anything starting with term, escaping LIKE wildcards in the term.
+    Lowercase the term and compare against lower(name) to make use of system_idx_name_lower.
+    :param term: The prefix to match
+    :return: A LIKE pattern
+    """
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
@@ -5,7 +5,8 @@ from pyramid.view import (
     view_defaults
 )
 from sqlalchemy.exc import IntegrityError
-from systems_api.models import System, Star, PopulatedSystem, Station, Body
+from systems_api.models import System, Star, PopulatedSystem, Station, Body, ScoopableSystem
+from systems_api.models.scoopablesystem import add_scoopable_system
 import pyramid.httpexceptions as exc
 from ..utils import edsm
 import transaction
@@ -111,6 +112,7 @@ def fetch_system(request):
         sstars = request.dbsession.query(Star).filter(Star.systemId64 == sys.id64)
         sbodies = request.dbsession.query(Body).filter(Body.systemId64 == sys.id64)
         sstations = request.dbsession.query(Station).filter(Station.systemId64 == sys.id64)
+        sscoopable = request.dbsession.query(ScoopableSystem).filter(ScoopableSystem.id64 == sys.id64)
 
         for row in sstars:
             print(f"Star {row.name} with ID {row.id64} up for deletion.")
@@ -132,6 +134,7 @@ def fetch_system(request):
         sstars.delete()
         sbodies.delete()
         sstations.delete()
+        sscoopable.delete()
         transaction.commit()
 
         print("Adding stations...")
@@ -188,6 +191,9 @@ def fetch_system(request):
                                systemName=edsm_system['name'])
                 data['added_bodies'] += 1
                 request.dbsession.add(newbody)
+        if any(body['type'] == 'Star' and body['isScoopable'] for body in edsm_bodies['bodies']):
+            request.dbsession.flush()
+            add_scoopable_system(request.dbsession, edsm_system['id64'])
         transaction.commit()
         print("Operations completed.")
         return {'status': 'Success', 'data': data}
@@ -2,8 +2,9 @@ from pyramid.view import (
     view_config,
     view_defaults
 )
-from sqlalchemy import text
+from sqlalchemy import func
 from ..models import Landmark, System
+from ..utils.spatial import get_landmark_index
 from pyramid.httpexceptions import HTTPBadRequest
 
 
@@ -27,46 +28,77 @@ def landmark(request):
         if "name" not in request.params:
             return HTTPBadRequest(detail="No name parameter supplied.")
         name = str(request.params['name'])
-        result = request.dbsession.query(System).filter(System.name == name).limit(1)
-        result2 = request.dbsession.query(Landmark)
-        if name in result2:
-            return {'meta': {'error': 'System is already a landmark.'}}
-        if result.rowcount > 0:
-            for row in result:
-                x = float(row['coords']['x'])
-                y = float(row['coords']['y'])
-                z = float(row['coords']['z'])
-                sysname = str(row['name'])
-            newlandmark = Landmark(name=sysname, x=x, y=y, z=z,
-                                   soi=requests.params['soi'] if 'soi' in request.params else None)
-            request.dbsession.add(newlandmark)
-            return {'meta': {'success': 'System added as a landmark.'}}
-        else:
+        try:
+            soi = float(request.params['soi']) if 'soi' in request.params else None
+        except ValueError:
+            return HTTPBadRequest(detail="Malformed soi parameter.")
+        row = request.dbsession.query(System).filter(System.name == name).first()
+        if row is None:
             return {'meta': {'error': 'System not found.'}}
+        if request.dbsession.query(Landmark.name).filter(Landmark.name == row.name).scalar():
+            return {'meta': {'error': 'System is already a landmark.'}}
+        newlandmark = Landmark(name=row.name, x=float(row.coords['x']), y=float(row.coords['y']),
+                               z=float(row.coords['z']), soi=soi)
+        request.dbsession.add(newlandmark)
+        # Drop the cached landmarks once the new one is committed, so the next lookup picks it up.
+        cache = request.registry['landmark_index']
+        request.tm.get().addAfterCommitHook(lambda success: success and cache.invalidate())
+        return {'meta': {'success': 'System added as a landmark.'}}
     if "name" not in request.params:
         return HTTPBadRequest(detail="No name parameter supplied.")
     name = str(request.params['name'])
-    result = request.dbsession.query(System).filter(System.name == name).limit(1)
-    if result.count() > 0:
-        rname = None
-        for row in result:
-            print(f"Coords: {row.coords}")
-            x = float(row.coords['x'])
-            y = float(row.coords['y'])
-            z = float(row.coords['z'])
-            rname = str(row.name)
-        if name.lower() != rname.lower():
-            return HTTPBadRequest('System name ambiguous or not found.')
-        sql = text(f"SELECT *,(sqrt((cast(landmarks.x AS FLOAT) - {x}"
-                   f")^2 + (cast(landmarks.y AS FLOAT) - {y}"
-                   f")^2 + (cast(landmarks.z AS FLOAT) - {z}"
-                   f")^2)) as DISTANCE from landmarks ORDER BY DISTANCE;")
-        result = request.dbsession.execute(sql)
-        candidates = []
-        for row in result:
-            if row['soi'] is None or row['soi'] > row['distance'] or row['soi'] == 0.0:
-                candidates.append({'name': row['name'], 'distance': row['distance']})
-    else:
+    row = request.dbsession.query(System).filter(System.name == name).first()
+    if row is None:
         return {'meta': {'error': 'System not found.'}}
+    print(f"Coords: {row.coords}")
+    if name.lower() != str(row.name).lower():
+        return HTTPBadRequest('System name ambiguous or not found.')
+    point = (float(row.coords['x']), float(row.coords['y']), float(row.coords['z']))
+    candidates = [{'name': lname, 'distance': distance}
+                  for lname, distance in get_landmark_index(request).nearest(point)]
     return {'meta': {'name': name},
             'landmarks': candidates}
+
+
+@view_defaults(renderer='../templates/mytemplate.jinja2')
+@view_config(route_name='landmark_batch', renderer='json')
+def landmark_batch(request):
+    """
+    Gets distances to the nearest landmarks for many systems at once. Systems are given as repeated name
+    parameters, or as a JSON body with a 'names' list.
+    :param request: The Pyramid request object
+    :return: A JSON response, with one entry per found system in request order
+    """
+    names = request.params.getall('name')
+    if request.content_type == 'application/json':
+        try:
+            names = names + list(request.json_body.get('names', []))
+        except (ValueError, TypeError, AttributeError):
+            return HTTPBadRequest(detail="Malformed JSON body.")
+    if not names:
+        return HTTPBadRequest(detail="No name parameter supplied.")
+    if len(names) > 100:
+        return HTTPBadRequest(detail="Too many systems in one request (Maximum 100)")
+
+    rows = request.dbsession.query(System.name, System.x, System.y, System.z). \
+        filter(func.lower(System.name).in_([str(name).lower() for name in names])).all()
+    by_name = {}
+    for row in rows:
+        by_name.setdefault(row.name.lower(), []).append(row)
+    found = []
+    missing = []
+    for name in names:
+        matches = by_name.get(str(name).lower(), [])
+        if len(matches) != 1 or matches[0].x is None:
+            missing.append(name)
+            continue
+        found.append((name, matches[0]))
+
+    # Every system is measured against every landmark in a single vectorized pass.
+    nearest = get_landmark_index(request).nearest_many([(row.x, row.y, row.z) for _, row in found])
+    results = []
+    for (name, row), landmarks in zip(found, nearest):
+        results.append({'query': name, 'name': row.name,
+                        'landmarks': [{'name': lname, 'distance': distance} for lname, distance in landmarks]})
+    return {'meta': {'count': len(results), 'missing': missing},
+            'data': results}
@@ -2,11 +2,21 @@ from pyramid.view import (
     view_config,
     view_defaults
 )
-from sqlalchemy import text, func, column
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from difflib import SequenceMatcher
+import functools
+import json
+import threading
+
+from pyramid.settings import asbool
+from sqlalchemy import text, func, column, or_, any_, bindparam, BigInteger, Text
+from sqlalchemy.dialects.postgresql import ARRAY
 from ..models import System, Permits
 import pyramid.httpexceptions as exc
-from ..utils.util import checkpermitname, resultstocandidates
+from ..utils.util import checkpermitname, resultstocandidates, like_prefix
 from ..utils.pgnames import is_pg_system_name
+from ..utils.pgboxels import get_pg_id64, get_pg_neighbours
+from ..utils.trigram import modes, get_trigram_options, prepare_trigram_search
 from urllib.parse import unquote
 import re
 
@@ -19,7 +29,10 @@ pg_system_regex = re.compile(r"^" + pg_system_regex_str + r"$")
 @view_config(route_name='mecha', renderer='json')
 def mecha(request):
     """
-    Optimized Mecha endpoint focusing on fastest returns for precise matches.
+    Optimized Mecha endpoint focusing on fastest returns for precise matches. Found systems are cached
+    by their lowercased name. The final trigram search takes mode, threshold and adaptive parameters.
+    :param request: The Pyramid request object
+    :return: A JSON response
     """
     if 'name' not in request.params:
         return exc.HTTPBadRequest(detail="Missing 'name' parameter.")
@@ -28,38 +41,117 @@ def mecha(request):
     if len(name) < 3:
         return exc.HTTPBadRequest(detail="Search term too short (Minimum 3 characters)")
 
+    try:
+        trigram = get_trigram_options(request)
+    except ValueError as e:
+        return exc.HTTPBadRequest(detail=str(e))
+
     lname = name.lower()
-    permsystems = request.dbsession.query(Permits).all()
-    perm_systems = [system.id64 for system in permsystems]
+    cache = request.registry['mecha_cache']
+    # Results depend on the trigram options, so requests choosing their own bypass the cache.
+    cacheable = not any(param in request.params for param in ('mode', 'threshold', 'adaptive'))
+    result = cache.get(lname) if cacheable else None
+    if result is not None:
+        return cached_result(result, name)
+    result = mecha_search(request, name, lname, trigram)
+    # Only found systems are cached, a system that is missing now may be added by EDDN at any moment.
+    if cacheable and result['meta']['type'] != 'notfound' and result.get('data'):
+        cache.set(lname, result)
+    return result
+
+
+def system_result(row, permsystems, similarity=1):
+    """
+    Formats a matched system for a mecha result.
+    :param row: The System
+    :param permsystems: Dict of permit-locked systems by ID64
+    :param similarity: The match's similarity score
+    :return: A JSON serializable dict
+    """
+    perm_systems = list(permsystems)
+    return {'name': row.name, 'similarity': similarity, 'id64': row.id64, 'coords': row.coords,
+            'permit_required': row.id64 in perm_systems,
+            'permit_name': checkpermitname(row.id64, permsystems, perm_systems)}
+
+
+def exact_match_type(name, lname, row):
+    """
+    Tells what kind of exact match a system is for a name.
+    :param name: The name searched for
+    :param lname: The name in lowercase
+    :param row: The System found by name or by the name's PG ID64
+    :return: 'Perfect match', 'Case-insensitive match' or 'pg_id64'
+    """
+    if row.name == name:
+        return 'Perfect match'
+    if row.name.lower() == lname:
+        return 'Case-insensitive match'
+    # The PG designation of a system that has a proper name.
+    return 'pg_id64'
+
+
+def cached_result(result, name):
+    """
+    Adapts a cached mecha result to the casing of the name it was looked up by.
+    :param result: The cached result
+    :param name: The name searched for
+    :return: The result
+    """
+    meta = result['meta']
+    meta['name'] = name
+    meta['cached'] = True
+    # Entries are shared by every casing of a name, so tell exact and case-insensitive hits apart again.
+    if meta['type'] in ('Perfect match', 'Case-insensitive match'):
+        meta['type'] = 'Perfect match' if result['data'][0]['name'] == name else 'Case-insensitive match'
+    return result
+
+
+def mecha_search(request, name, lname, trigram=None):
+    """
+    Runs the mecha search strategies in order, returning the result of the first that matches.
+    :param request: The Pyramid request object
+    :param name: The name searched for
+    :param lname: The name in lowercase
+    :param trigram: TrigramOptions for the final trigram search, or None for the pg_trgm defaults
+    :return: A JSON serializable result
+    """
+    permsystems = {system.id64: system for system in request.dbsession.query(Permits)}
+
+    # PG names map straight to an ID64, so most of them are answered by a single primary key lookup.
+    pg_id64 = get_pg_id64(name) if is_pg_system_name(name) else None
+    if pg_id64 is not None:
+        pg_match = request.dbsession.query(System).filter(System.id64 == pg_id64).first()
+        if pg_match:
+            return {'meta': {'name': name, 'type': exact_match_type(name, lname, pg_match)},
+                    'data': [system_result(pg_match, permsystems)]}
 
     # Case-sensitive exact match
     exact_match = request.dbsession.query(System).filter(System.name == name).first()
     if exact_match:
-        return {'meta': {'name': name, 'type': 'Perfect match'}, 'data': [{
-            'name': exact_match.name,
-            'similarity': 1,
-            'id64': exact_match.id64,
-            'coords': exact_match.coords,
-            'permit_required': exact_match.id64 in perm_systems,
-            'permit_name': checkpermitname(exact_match.id64, permsystems, perm_systems)
-        }]}
+        return {'meta': {'name': name, 'type': 'Perfect match'}, 'data': [system_result(exact_match, permsystems)]}
 
     # Case-insensitive exact match
-    ci_match = request.dbsession.query(System) \
-        .filter(text("LOWER(name) = :lname")) \
-        .params(lname=lname) \
-        .first()
+    ci_match = request.dbsession.query(System).filter(func.lower(System.name) == lname).first()
 
     if ci_match:
-        return {'meta': {'name': name, 'type': 'Case-insensitive match'}, 'data': [{
-            'name': ci_match.name,
-            'similarity': 1,
-            'id64': ci_match.id64,
-            'coords': ci_match.coords,
-            'permit_required': ci_match.id64 in perm_systems,
-            'permit_name': checkpermitname(ci_match.id64, permsystems, perm_systems)
-        }]}
+        return {'meta': {'name': name, 'type': 'Case-insensitive match'},
+                'data': [system_result(ci_match, permsystems)]}
+
+    return fuzzy_search(request, name, lname, trigram, permsystems, pg_id64)
+
 
+def fuzzy_search(request, name, lname, trigram, permsystems, pg_id64):
+    """
+    Runs the mecha searches for names without an exact match.
+    :param request: The Pyramid request object
+    :param name: The name searched for
+    :param lname: The name in lowercase
+    :param trigram: TrigramOptions for the final trigram search, or None for the pg_trgm defaults
+    :param permsystems: Dict of permit-locked systems by ID64
+    :param pg_id64: The ID64 computed from the name, if it is a PG name
+    :return: A JSON serializable result
+    """
+    perm_systems = list(permsystems)
     if 'fast' in request.params:
         return {'meta': {'error': 'System not found. Query again without fast flag for in-depth search.',
                          'type': 'notfound'}}
@@ -68,78 +160,356 @@ def mecha(request):
     if pg_system_regex.match(name):
         return {'meta': {'error': 'Incomplete PG system name.', 'type': 'incomplete_name'}}
 
-    if is_pg_system_name(name):
-        qtext = text("""
-            SET LOCAL work_mem = '100MB';
-            SELECT *, similarity(name, :name) as lev
-            FROM systems
-            WHERE lower(name) LIKE :prefix
-            ORDER BY name <-> :name
-            LIMIT 10
-        """)
-        results = request.dbsession.query(System, column('lev')).from_statement(qtext).params(
-            name=lname, prefix=f"{lname}%"
-        ).all()
-        if results:
-            return {'meta': {'name': name, 'type': 'pg_trgm'}, 'data': [
-                {'name': c[0].name, 'similarity': c[1],
-                 'id64': c[0].id64, 'coords': c[0].coords,
-                 'permit_required': c[0].id64 in perm_systems,
-                 'permit_name': checkpermitname(c[0].id64, permsystems, perm_systems)}
-                for c in results
+    if pg_id64 is not None:
+        # Likely typos: the same sector with one letter or number off by one, all in one primary key lookup.
+        neighbours = get_pg_neighbours(name)
+        rows = request.dbsession.query(System).filter(System.id64.in_(list(neighbours))).all()
+        if rows:
+            rows.sort(key=lambda row: SequenceMatcher(None, lname, row.name.lower()).ratio(), reverse=True)
+            return {'meta': {'name': name, 'type': 'pg_neighbour'}, 'data': [
+                system_result(row, permsystems, SequenceMatcher(None, lname, row.name.lower()).ratio())
+                for row in rows
             ]}
 
+    strategies = [s for s in fallback_strategies if s[0] != 'pg_trgm' or is_pg_system_name(name)]
+    strategies = [(searchtype, score, functools.partial(search, trigram=trigram) if searchtype == 'gin_trgm' else search)
+                  for searchtype, score, search in strategies]
+    strategy, results = run_strategies(request, strategies, name, lname)
+    if strategy is not None:
+        searchtype, score, _ = strategies[strategy]
+        return {'meta': {'name': name, 'type': searchtype}, 'data': [
+            {'name': c[0].name, score: c[1],
+             'id64': c[0].id64, 'coords': c[0].coords,
+             'permit_required': c[0].id64 in perm_systems,
+             'permit_name': checkpermitname(c[0].id64, permsystems, perm_systems)}
+            for c in results
+        ]}
+
+    return {'meta': {'error': 'System not found.', 'type': 'notfound'}}
+
+
+def batch_exact_matches(session, names):
+    """
+    Finds the exact, case-insensitive and PG ID64 matches for many names in a single query.
+    :param session: A DB session
+    :param names: Dict of lowercased name to the name searched for
+    :return: Dict of lowercased name to a tuple of (match type, System), for the names that matched
+    """
+    pg_id64s = {}
+    for lname, name in names.items():
+        pg_id64 = get_pg_id64(name) if is_pg_system_name(name) else None
+        if pg_id64 is not None:
+            pg_id64s[pg_id64] = lname
+    # One array parameter each, rather than an IN list, so the query text is the same for every batch.
+    rows = session.query(System).filter(or_(
+        func.lower(System.name) == any_(bindparam('lnames', list(names), type_=ARRAY(Text))),
+        System.id64 == any_(bindparam('id64s', list(pg_id64s), type_=ARRAY(BigInteger)))
+    )).all()
+    by_id64 = {row.id64: row for row in rows}
+    by_lname = {}
+    for row in rows:
+        by_lname.setdefault(row.name.lower(), []).append(row)
+
+    matches = {}
+    for pg_id64, lname in pg_id64s.items():
+        if pg_id64 in by_id64:
+            matches[lname] = (exact_match_type(names[lname], lname, by_id64[pg_id64]), by_id64[pg_id64])
+    for lname, name in names.items():
+        if lname in matches or lname not in by_lname:
+            continue
+        exact = [row for row in by_lname[lname] if row.name == name]
+        row = exact[0] if exact else by_lname[lname][0]
+        matches[lname] = (exact_match_type(name, lname, row), row)
+    return matches
+
+
+def search_pg_trgm(session, name, lname):
+    qtext = text("""
+        SET LOCAL work_mem = '100MB';
+        SELECT *, similarity(name, :name) as lev
+        FROM systems
+        WHERE lower(name) LIKE :prefix
+        ORDER BY name <-> :name
+        LIMIT 10
+    """)
+    return session.query(System, column('lev')).from_statement(qtext).params(
+        name=lname, prefix=like_prefix(lname)
+    ).all()
+
+
+def search_phonetic(session, name, lname):
     # Soundex and DMetaphone matches
     qtext = text("""
         SET LOCAL work_mem = '100MB';
         WITH matches AS (
             SELECT id64, name, levenshtein(lower(name), :lname) as lev
             FROM systems
-            WHERE soundex(name) = soundex(:name) OR dmetaphone(name) = dmetaphone(:name)
+            WHERE name_soundex = soundex(:name) OR name_dmetaphone = dmetaphone(:name)
             ORDER BY lev ASC
             LIMIT 10
         ) SELECT * FROM matches WHERE lev < 3;
     """)
-    results = request.dbsession.query(System, column('lev')).from_statement(qtext).params(name=name, lname=lname).all()
-    if results:
-        return {'meta': {'name': name, 'type': 'phonetic'}, 'data': [
-            {'name': c[0].name, 'distance': c[1],
-             'id64': c[0].id64, 'coords': c[0].coords,
-             'permit_required': c[0].id64 in perm_systems,
-             'permit_name': checkpermitname(c[0].id64, permsystems, perm_systems)}
-            for c in results
-        ]}
+    return session.query(System, column('lev')).from_statement(qtext).params(name=name, lname=lname).all()
 
-    # Wildcard ILIKE search
-    wildcard_results = request.dbsession.query(System, func.similarity(System.name, name).label('sim')).\
-        filter(func.lower(System.name).like(f"{lname}%")).order_by(func.similarity(System.name, name).desc()).limit(10).all()
 
-    if wildcard_results:
-        return {'meta': {'name': name, 'type': 'wildcard'}, 'data': [
-            {'name': c[0].name, 'similarity': c[1],
-             'id64': c[0].id64, 'coords': c[0].coords,
-             'permit_required': c[0].id64 in perm_systems,
-             'permit_name': checkpermitname(c[0].id64, permsystems, perm_systems)}
-            for c in wildcard_results
-        ]}
+def search_wildcard(session, name, lname):
+    return session.query(System, func.similarity(System.name, name).label('sim')).\
+        filter(func.lower(System.name).like(like_prefix(lname))).order_by(func.similarity(System.name, name).desc()).\
+        limit(10).all()
+
 
+def search_gin_trgm(session, name, lname, trigram=None):
     # Final trigram search as fallback
-    qtext = text("""
-        SELECT *, similarity(name, :name) as lev
+    mode = modes[trigram.mode if trigram else 'similarity']
+    if trigram:
+        prepare_trigram_search(session, name, trigram)
+    qtext = text(f"""
+        SELECT *, {mode.score} as lev
         FROM systems
-        WHERE name % :name
+        WHERE {mode.condition}
         ORDER BY lev DESC
         LIMIT 10
     """)
-    results = request.dbsession.query(System, column('lev')).from_statement(qtext).params(name=name).all()
+    return session.query(System, column('lev')).from_statement(qtext).params(name=name).all()
 
-    if results:
-        return {'meta': {'name': name, 'type': 'gin_trgm'}, 'data': [
-            {'name': c[0].name, 'similarity': c[1],
-             'id64': c[0].id64, 'coords': c[0].coords,
-             'permit_required': c[0].id64 in perm_systems,
-             'permit_name': checkpermitname(c[0].id64, permsystems, perm_systems)}
-            for c in results
-        ]}
 
-    return {'meta': {'error': 'System not found.', 'type': 'notfound'}}
+# Fallback strategies in order of preference, as (result type, score field, search function).
+# Each is independent of the others, so they can also be run at the same time.
+fallback_strategies = [
+    ('pg_trgm', 'similarity', search_pg_trgm),
+    ('phonetic', 'distance', search_phonetic),
+    ('wildcard', 'similarity', search_wildcard),
+    ('gin_trgm', 'similarity', search_gin_trgm),
+]
+
+
+def run_sequential(request, strategies, name, lname):
+    """
+    Runs strategies one after the other on the request's session, stopping at the first with results.
+    :param request: The Pyramid request object
+    :param strategies: List of (result type, score field, search function) in order of preference
+    :param name: The name searched for
+    :param lname: The name in lowercase
+    :return: A tuple of (index of the winning strategy or None, its result rows)
+    """
+    for i, (_, _, search) in enumerate(strategies):
+        results = search(request.dbsession, name, lname)
+        if results:
+            return i, results
+    return None, []
+
+
+def run_strategies(request, strategies, name, lname):
+    """
+    Runs the fallback strategies in parallel when mecha.parallel allows it and enough connections are free,
+    otherwise one after the other. With mecha.parallel = request, only requests with a parallel parameter
+    run in parallel.
+    :return: A tuple of (index of the winning strategy or None, its result rows)
+    """
+    setting = str(request.registry.settings.get('mecha.parallel', 'false')).lower()
+    if asbool(setting) or (setting == 'request' and 'parallel' in request.params):
+        budget = get_connection_budget(request.registry)
+        if budget.acquire(len(strategies)):
+            return run_parallel(request, strategies, name, lname, budget)
+    return run_sequential(request, strategies, name, lname)
+
+
+class ConnectionBudget(object):
+    """
+    Counts the pooled connections parallel searches may hold between them, so they can never take the
+    whole pool from the requests' own sessions.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, n):
+        """
+        :param n: Number of connections wanted
+        :return: True if all of them were free and are now taken, False if none were taken
+        """
+        with self._lock:
+            if self.used + n > self.size:
+                return False
+            self.used += n
+            return True
+
+    def release(self, n=1):
+        with self._lock:
+            self.used -= n
+
+
+_executor_lock = threading.Lock()
+
+
+def get_executor(registry):
+    """
+    Returns the thread pool used for parallel mecha searches, creating it on first use.
+    :param registry: The Pyramid registry
+    :return: A ThreadPoolExecutor
+    """
+    with _executor_lock:
+        if 'mecha_executor' not in registry:
+            workers = int(registry.settings.get('mecha.parallel_workers', 8))
+            registry['mecha_executor'] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mecha')
+        return registry['mecha_executor']
+
+
+def get_connection_budget(registry):
+    """
+    Returns the budget of connections for parallel mecha searches, creating it on first use. It is sized by
+    mecha.parallel_connections, by default the size of the connection pool without its overflow.
+    :param registry: The Pyramid registry
+    :return: A ConnectionBudget
+    """
+    with _executor_lock:
+        if 'mecha_connections' not in registry:
+            size = registry.settings.get('mecha.parallel_connections')
+            if size is None:
+                pool = registry['dbsession_factory'].kw['bind'].pool
+                size = pool.size() if hasattr(pool, 'size') else 4
+            registry['mecha_connections'] = ConnectionBudget(int(size))
+        return registry['mecha_connections']
+
+
+def close_session(session, budget):
+    try:
+        session.close()
+    except Exception as e:
+        print(f"Could not close mecha strategy session: {e}")
+    finally:
+        budget.release()
+
+
+def run_parallel(request, strategies, name, lname, budget):
+    """
+    Runs all strategies at once, each on its own pooled connection. As soon as the most preferred
+    strategy with results is known, the others are cancelled, both queued ones and running queries.
+    :param request: The Pyramid request object
+    :param strategies: List of (result type, score field, search function) in order of preference
+    :param name: The name searched for
+    :param lname: The name in lowercase
+    :param budget: The ConnectionBudget, from which one connection per strategy has been acquired already.
+        Each is given back when its session is closed.
+    :return: A tuple of (index of the winning strategy or None, its result rows)
+    """
+    factory = request.registry['dbsession_factory']
+    # Connections are checked out up front, and only given back once their strategy is done with them
+    # (see below), so a cancel can never reach a connection that has moved on to another query.
+    sessions = []
+    try:
+        for _ in strategies:
+            session = factory()
+            sessions.append((session, session.connection().connection))
+    except Exception:
+        for session, _ in sessions:
+            close_session(session, budget)
+        budget.release(len(strategies) - len(sessions))
+        raise
+
+    executor = get_executor(request.registry)
+    futures = [executor.submit(search, session, name, lname)
+               for (_, _, search), (session, _) in zip(strategies, sessions)]
+    results = [None] * len(futures)
+    try:
+        for future in as_completed(futures):
+            i = futures.index(future)
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                print(f"Mecha strategy {strategies[i][0]} failed: {e}")
+                results[i] = []
+            for j, rows in enumerate(results):
+                if rows is None:
+                    # A more preferred strategy is still running.
+                    break
+                if rows:
+                    return j, rows
+        return None, []
+    finally:
+        for future, (session, conn) in zip(futures, sessions):
+            if not future.cancel() and not future.done():
+                try:
+                    conn.cancel()
+                except Exception as e:
+                    print(f"Could not cancel mecha strategy query: {e}")
+            # Runs straight away for strategies that are done or never started, else when the strategy returns.
+            future.add_done_callback(lambda _, session=session: close_session(session, budget))
+
+
+@view_defaults(renderer='../templates/mytemplate.jinja2')
+@view_config(route_name='mecha_batch', renderer='json', request_method='POST')
+def mecha_batch(request):
+    """
+    Resolves many system names at once, from a JSON body with a 'names' list. Exact and case-insensitive
+    matches for all names come from one query, and only the names left over are searched for one by one.
+    Takes the same parameters as mecha.
+    :param request: The Pyramid request object
+    :return: A JSON response, with one mecha result per name in request order
+    """
+    try:
+        names = request.json_body['names']
+        # A string is iterable too, and would be searched for one character at a time.
+        if not isinstance(names, list):
+            raise TypeError
+        names = [unquote(str(name)).strip() for name in names]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return exc.HTTPBadRequest(detail="Expected a JSON body with a 'names' list.")
+    batch_limit = int(request.registry.settings.get('mecha.batch_limit', 500))
+    if len(names) > batch_limit:
+        return exc.HTTPBadRequest(detail=f"Too many systems in one request (Maximum {batch_limit})")
+    try:
+        trigram = get_trigram_options(request)
+    except ValueError as e:
+        return exc.HTTPBadRequest(detail=str(e))
+
+    cache = request.registry['mecha_cache']
+    cacheable = not any(param in request.params for param in ('mode', 'threshold', 'adaptive'))
+    results = {}
+    pending = {}
+    for name in names:
+        lname = name.lower()
+        if len(name) < 3:
+            results[name] = {'meta': {'name': name, 'error': 'Search term too short (Minimum 3 characters)',
+                                      'type': 'notfound'}}
+        elif name not in results and lname not in pending:
+            result = cache.get(lname) if cacheable else None
+            if result is not None:
+                results[name] = cached_result(result, name)
+            else:
+                pending[lname] = name
+
+    permsystems = {system.id64: system for system in request.dbsession.query(Permits)}
+    matches = batch_exact_matches(request.dbsession, pending) if pending else {}
+    for lname, name in pending.items():
+        if lname in matches:
+            searchtype, row = matches[lname]
+            result = {'meta': {'name': name, 'type': searchtype}, 'data': [system_result(row, permsystems)]}
+        else:
+            pg_id64 = get_pg_id64(name) if is_pg_system_name(name) else None
+            result = fuzzy_search(request, name, lname, trigram, permsystems, pg_id64)
+        if cacheable and result['meta']['type'] != 'notfound' and result.get('data'):
+            cache.set(lname, result)
+        results[name] = result
+
+    ordered = []
+    for name in names:
+        if name not in results:
+            # Another casing of the same name was searched for; the result is the same apart from its type.
+            results[name] = cached_result(json.loads(json.dumps(results[pending[name.lower()]])), name)
+            results[name]['meta'].pop('cached')
+        ordered.append(results[name])
+    return {'meta': {'count': len(ordered)}, 'data': ordered}
+
+
+@view_defaults(renderer='../templates/mytemplate.jinja2')
+@view_config(route_name='cache_stats', renderer='json')
+def cache_stats(request):
+    """
+    Reports the hit and miss counters of this worker's result caches.
+    :param request: The Pyramid request object
+    :return: A JSON response
+    """
+    return {'meta': {'type': 'cache_stats'}, 'data': {'mecha': request.registry['mecha_cache'].stats()}}
@@ -2,14 +2,78 @@ from pyramid.view import (
     view_config,
     view_defaults
 )
-from sqlalchemy import text, func
-from ..models import System, Permits, Carrier, Star, PopulatedSystem, Station
+from sqlalchemy import text, func, column
+from ..models import System, Permits, Carrier, PopulatedSystem, Station, ScoopableSystem
 import pyramid.httpexceptions as exc
 from ..utils.util import checkpermitname, resultstocandidates
+from ..utils.spatial import get_populated_index
+from ..utils import pgboxels, pgnames
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from sqlalchemy import and_, text
+from sqlalchemy import and_, or_, text
 import numpy
 
+# Nearest systems inside an axis-aligned cube, served by the GiST index on systems with coordinates.
+nearest_system_sql = text("""
+    SELECT systems.*, cube(array[x, y, z]) <-> cube(array[:x, :y, :z]) AS distance
+    FROM systems
+    WHERE x IS NOT NULL
+      AND cube(array[x, y, z]) <@ cube(array[:x - :cube, :y - :cube, :z - :cube],
+                                           array[:x + :cube, :y + :cube, :z + :cube])
+      AND EXISTS (SELECT 1 FROM stars WHERE stars."systemId64" = systems.id64)
+    ORDER BY distance
+    LIMIT :k
+""")
+
+# Fuel star lookups only need the derived scoopable_systems table and its own GiST index.
+nearest_scoopable_sql = text("""
+    SELECT scoopable_systems.*, cube(array[x, y, z]) <-> cube(array[:x, :y, :z]) AS distance
+    FROM scoopable_systems
+    WHERE cube(array[x, y, z]) <@ cube(array[:x - :cube, :y - :cube, :z - :cube],
+                                       array[:x + :cube, :y + :cube, :z + :cube])
+    ORDER BY distance
+    LIMIT :k
+""")
+
+
+def get_max_radius(request):
+    """
+    Reads the maximum search radius for a request, capped by the nearest.max_radius setting.
+    :param request: The Pyramid request object
+    :return: The radius in ly, or None if the parameter is malformed
+    """
+    ceiling = float(request.registry.settings.get('nearest.max_radius', 1000))
+    if 'max_radius' not in request.params:
+        return ceiling
+    try:
+        return min(abs(float(request.params['max_radius'])), ceiling)
+    except ValueError:
+        return None
+
+
+def expanding_search(request, sql, x, y, z, k=1, max_radius=1000.0, model=System):
+    """
+    Finds the k nearest systems to a position by searching cubes of doubling size. A result is only
+    accepted once it lies within the current cube's inscribed sphere, as nothing outside the cube can
+    be closer than that.
+    :param request: The Pyramid request object
+    :param sql: A query taking x, y, z, cube and k parameters, returning rows ordered by distance
+    :param x: X coordinate
+    :param y: Y coordinate
+    :param z: Z coordinate
+    :param k: Number of systems to find
+    :param max_radius: Largest radius to search, in ly
+    :param model: The mapped class the query's rows are loaded as
+    :return: A tuple of (list of (model, distance) rows, the radius searched)
+    """
+    radius = min(max(float(request.registry.settings.get('nearest.start_radius', 10)), 1.0), max_radius)
+    while True:
+        rows = request.dbsession.query(model, column('distance')).from_statement(sql).params(
+            x=x, y=y, z=z, cube=radius, k=k).all()
+        rows = [row for row in rows if row[1] <= radius]
+        if len(rows) >= k or radius >= max_radius:
+            return rows, radius
+        radius = min(radius * 2, max_radius)
+
 
 @view_defaults(renderer='../templates/mytemplate.jinja2')
 @view_config(route_name='nearest_populated', renderer='json')
@@ -44,86 +108,174 @@ def nearest_populated(request):
         if len(request.params['name']) < 3:
             return exc.HTTPBadRequest('Name too short. (Must be at least 3 characters)')
         try:
-            system = request.dbsession.query(System).filter(System.name.ilike(request.params['name'])).one()
+            system = request.dbsession.query(System).filter(func.lower(System.name) == request.params['name'].lower()).one()
             x, y, z = system.coords['x'], system.coords['y'], system.coords['z']
         except NoResultFound:
             return exc.HTTPNotFound('System not found.')
         except MultipleResultsFound:
             return exc.HTTPServerError('Multiple rows matching system found. Ensure system is unambiguous.')
-        
-        legacy_filter = "WHERE legacy = true" if legacy else ""
-        candidate = request.dbsession.query(PopulatedSystem).from_statement(
-            text(f"SELECT *, (sqrt((cast(populated_systems.coords->>'x' AS FLOAT) - {x}"
-                 f")^2 + (cast(populated_systems.coords->>'y' AS FLOAT) - {y}"
-                 f")^2 + (cast(populated_systems.coords->>'z' AS FLOAT) - {z}"
-                 f")^2)) as Distance from populated_systems {legacy_filter} order by Distance LIMIT {limit}")).all()
-        populated_systems = []
-        permit_systems = []
-        permsystems = request.dbsession.query(Permits).all()
-        perm_systems = {ps.id64: ps.permit_name for ps in permsystems}
-        for cand in candidate:
-            try:
-                a = numpy.array((x, y, z))
-                b = numpy.array((cand.coords['x'], cand.coords['y'], cand.coords['z']))
-                dist = numpy.linalg.norm(a - b)
-                #print(f"{cand.name}: {dist}")
-
-                stations = []
-                station_query = request.dbsession.query(Station).filter(Station.systemId64 == cand.id64)
-                if station_query:
-                    tagAbandoned=False
-
-                    # Check the System Allegiance in Systems model for whether the system has been Thargoid attacked.
-                    sysallegiance = request.dbsession.query(System.systemAllegiance). \
-                        filter(System.id64 == cand.id64).one_or_none()
-
-                    # Set the tagAbandoned flag to True if the system is Thargoid owned
-                    tagAbandoned = False
-                    if sysallegiance and sysallegiance[0] == 'Thargoid':
-                        tagAbandoned = True
-
-                    # Append information about each station in the system to the stations list
-                    stations = []
-                    for station in station_query:
-                        stations.append({
-                            'name': station.name,
-                            'type': station.type,
-                            'distance': station.distanceToArrival,
-                            'hasOutfitting': station.haveOutfitting,
-                            'services': station.otherServices,
-                            'hasShipyard': station.haveShipyard,
-                            'hasMarket': station.haveMarket,
-                            'stationState': station.stationState if not tagAbandoned else 'Abandoned',
-                        })
-
-                    # Append information about the system to the populated_systems list
-                    populated_systems.append({
-                        'distance': dist,
-                        'name': cand.name,
-                        'id64': cand.id64,
-                        'stations': stations,
-                        'allegiance': sysallegiance[0] if sysallegiance else None,
-                    })
-
-                    if cand.id64 in perm_systems:
-                        permit_systems.append({
-                            'id64': cand.id64,
-                            'name': perm_systems[cand.id64]
-                        })
-
-            except ValueError:
-                print(
-                    f"Value error: Failed for {cand.coords['x']}, {cand.coords['y']}, {cand.coords['z']}")
-        # Only include perm_systems if there are any populated systems that require a permit.
-        if len(permit_systems) > 0:
-            return {'meta': {'name': system.name, 'type': 'nearest_populated', 'perm_systems': permit_systems},
-                    'data': populated_systems}
-        else:
-            return {'meta': {'name': system.name, 'type': 'nearest_populated'},
-                    'data': populated_systems}
     else:
         return exc.HTTPBadRequest('Missing required parameter (name or systemid64')
 
+    candidate = get_populated_index(request).nearest((x, y, z), limit, legacy=legacy)
+    details = fetch_populated_details(request, [c[1] for c in candidate])
+    populated_systems, permit_systems = expand_populated(candidate, details)
+
+    # Only include perm_systems if there are any populated systems that require a permit.
+    if len(permit_systems) > 0:
+        return {'meta': {'name': system.name, 'type': 'nearest_populated', 'perm_systems': permit_systems},
+                'data': populated_systems}
+    else:
+        return {'meta': {'name': system.name, 'type': 'nearest_populated'},
+                'data': populated_systems}
+
+
+@view_defaults(renderer='../templates/mytemplate.jinja2')
+@view_config(route_name='nearest_populated_batch', renderer='json')
+def nearest_populated_batch(request):
+    """
+    Returns the nearest populated systems for many systems in one call. Systems are given as repeated
+    name and/or systemid64 parameters, or as a JSON body with 'names' and 'systemid64s' lists.
+    :param request: The Pyramid request object
+    :return: A JSON response, with one entry per requested system in request order
+    """
+    limit = 10
+    legacy = False
+    names = request.params.getall('name')
+    id64s = request.params.getall('systemid64')
+    try:
+        if request.content_type == 'application/json':
+            body = request.json_body
+            body_names = list(body.get('names', []))
+            body_id64s = list(body.get('systemid64s', []))
+            if not all(isinstance(name, str) for name in body_names):
+                return exc.HTTPBadRequest('Malformed JSON body. (names must be strings)')
+            # bool is a subclass of int, but true is no system.
+            if not all(isinstance(i, int) and not isinstance(i, bool) for i in body_id64s):
+                return exc.HTTPBadRequest('Malformed JSON body. (systemid64s must be integers)')
+            names = names + body_names
+            id64s = id64s + body_id64s
+            if 'limit' in body:
+                limit = abs(int(body['limit']))
+            legacy = bool(body.get('legacy', False))
+        if 'limit' in request.params:
+            limit = abs(int(request.params['limit']))
+    except (ValueError, TypeError, AttributeError):
+        return exc.HTTPBadRequest('Malformed JSON body or limit parameter.')
+    if 'legacy' in request.params:
+        legacy = True
+    limit = min(limit, 100)
+    if not names and not id64s:
+        return exc.HTTPBadRequest('Missing required parameter (name or systemid64)')
+    if len(names) + len(id64s) > 100:
+        return exc.HTTPBadRequest('Too many systems in one request (Maximum 100)')
+    if any(len(name) < 3 for name in names):
+        return exc.HTTPBadRequest('Name too short. (Must be at least 3 characters)')
+    try:
+        id64s = [int(i) for i in id64s]
+    except (ValueError, TypeError):
+        return exc.HTTPBadRequest('Malformed systemid64.')
+
+    # Resolve every input in a single query.
+    lnames = [name.lower() for name in names]
+    rows = request.dbsession.query(System.id64, System.name, System.x, System.y, System.z). \
+        filter(or_(System.id64.in_(id64s), func.lower(System.name).in_(lnames))).all()
+    by_id64 = {row.id64: row for row in rows}
+    by_name = {}
+    for row in rows:
+        if row.name:
+            by_name.setdefault(row.name.lower(), []).append(row)
+
+    index = get_populated_index(request)
+    missing = []
+    found = []
+    targets = [(i, by_id64.get(i)) for i in id64s]
+    for name in names:
+        # Ambiguous names are reported as missing, the same way nearest_populated refuses them.
+        matches = by_name.get(name.lower(), [])
+        targets.append((name, matches[0] if len(matches) == 1 else None))
+    for query, system in targets:
+        if system is None or system.x is None:
+            missing.append(query)
+            continue
+        found.append((query, system, index.nearest((system.x, system.y, system.z), limit, legacy=legacy)))
+
+    # Expand every candidate of every input with a single set of bulk queries.
+    details = fetch_populated_details(request, [c[1] for _, _, candidate in found for c in candidate])
+    results = []
+    for query, system, candidate in found:
+        populated_systems, permit_systems = expand_populated(candidate, details)
+        result = {'query': query, 'name': system.name, 'id64': system.id64, 'data': populated_systems}
+        if permit_systems:
+            result['perm_systems'] = permit_systems
+        results.append(result)
+
+    return {'meta': {'type': 'nearest_populated_batch', 'count': len(results), 'missing': missing},
+            'data': results}
+
+
+def fetch_populated_details(request, id64s):
+    """
+    Bulk loads the stations, allegiances and permits for a set of populated systems, in one query each.
+    :param request: The Pyramid request object
+    :param id64s: Iterable of system id64s
+    :return: A tuple of (stations by system, allegiance by system, permit name by system) dicts
+    """
+    id64s = list(set(id64s))
+    if not id64s:
+        return {}, {}, {}
+    stations = {}
+    for station in request.dbsession.query(Station).filter(Station.systemId64.in_(id64s)):
+        stations.setdefault(station.systemId64, []).append(station)
+    allegiances = dict(request.dbsession.query(System.id64, System.systemAllegiance).
+                       filter(System.id64.in_(id64s)))
+    permits = dict(request.dbsession.query(Permits.id64, Permits.permit_name).filter(Permits.id64.in_(id64s)))
+    return stations, allegiances, permits
+
+
+def expand_populated(candidate, details):
+    """
+    Adds stations, allegiance and permit information to nearest populated system candidates.
+    :param candidate: List of (distance, id64, name) tuples from the populated index
+    :param details: Result of fetch_populated_details covering the candidates
+    :return: A tuple of (populated systems, permit systems) lists
+    """
+    stations_by_system, allegiances, permits = details
+    populated_systems = []
+    permit_systems = []
+    for dist, cand_id64, cand_name in candidate:
+        allegiance = allegiances.get(cand_id64)
+        # Systems taken over by the Thargoids have all their stations marked as abandoned.
+        tagAbandoned = allegiance == 'Thargoid'
+
+        stations = []
+        for station in stations_by_system.get(cand_id64, []):
+            stations.append({
+                'name': station.name,
+                'type': station.type,
+                'distance': station.distanceToArrival,
+                'hasOutfitting': station.haveOutfitting,
+                'services': station.otherServices,
+                'hasShipyard': station.haveShipyard,
+                'hasMarket': station.haveMarket,
+                'stationState': station.stationState if not tagAbandoned else 'Abandoned',
+            })
+
+        populated_systems.append({
+            'distance': dist,
+            'name': cand_name,
+            'id64': cand_id64,
+            'stations': stations,
+            'allegiance': allegiance,
+        })
+
+        if cand_id64 in permits:
+            permit_systems.append({
+                'id64': cand_id64,
+                'name': permits[cand_id64]
+            })
+    return populated_systems, permit_systems
+
 
 @view_defaults(renderer='../templates/mytemplate.jinja2')
 @view_config(route_name='nearest_coords', renderer='json')
@@ -139,31 +291,16 @@ def nearest_coords(request):
         x, y, z = float(request.params['x']), float(request.params['y']), float(request.params['z'])
     except ValueError:
         return exc.HTTPBadRequest('Malformed request data.')
-    try:
-        cube = 50
-        # Please, for the love of god, don't touch it thinking you can 'fix it'. It works. It's ugly, but it works.
-        # If you touch it, YOU WILL BREAK IT. I will not be held responsible for your actions.
-        candidate = request.dbsession.query(System).from_statement(
-            text(f"SELECT systems.name, systems.coords, systems.id64, (sqrt((cast(systems.coords->>'x' AS FLOAT) - {x}"
-                 f")^2 + (cast(systems.coords->>'y' AS FLOAT) - {y}"
-                 f")^2 + (cast(systems.coords->>'z' AS FLOAT) - {z}"
-                 f")^2)) AS Distance FROM systems JOIN stars ON systems.id64 = stars.\"systemId64\""
-                 f" WHERE cast(systems.coords->>'x' AS FLOAT) BETWEEN {str(float(x)-cube)} AND {str(float(x)+cube)}"
-                 f" AND cast(systems.coords->>'y' AS FLOAT) BETWEEN {str(float(y)-cube)} AND {str(float(y)+cube)}"
-                 f" AND cast(systems.coords->>'z' as FLOAT)"
-                 f" BETWEEN {str(float(z)-cube)} AND {str(float(z)+cube)} order by Distance LIMIT 1")).one()
-        a = numpy.array((x, y, z))
-        b = numpy.array((candidate.coords['x'], candidate.coords['y'], candidate.coords['z']))
-        dist = numpy.linalg.norm(a - b)
-
-        return {'meta': {'name': candidate.name, 'type': 'nearest_coords'},
-                'data': {'distance': dist, 'name': candidate.name, 'id64': candidate.id64}}
-
-    except NoResultFound:
-        return {'meta': {'name': candidate.name, 'type': 'nearest_scoopable'},
-                'error': 'No scoopable systems found.'}
-    except ValueError:
+    max_radius = get_max_radius(request)
+    if max_radius is None:
         return exc.HTTPBadRequest('Malformed request data.')
+    candidate, radius = expanding_search(request, nearest_system_sql, x, y, z, max_radius=max_radius)
+    if not candidate:
+        return {'meta': {'type': 'nearest_coords', 'radius': radius},
+                'error': 'No systems found.'}
+    system, dist = candidate[0]
+    return {'meta': {'name': system.name, 'type': 'nearest_coords', 'radius': radius},
+            'data': {'distance': dist, 'name': system.name, 'id64': system.id64}}
 
 
 @view_defaults(renderer='../templates/mytemplate.jinja2')
@@ -172,12 +309,22 @@ def nearest_scoopable(request):
     """
     Returns the nearest scoopable system to a given system. Supports being asked with either a
     systemID passed as systemid64, or searching by name with the name parameter.
+
+    With the infer parameter, returns a ranked list of up to limit candidates instead, mixing known
+    scoopable systems with procedurally generated boxels likely to hold one. Inferred candidates are
+    marked, and a PG system name we have no record of is located from its name.
     :param request: The Pyramid request object
     :return: A JSON response
     """
     x, y, z = 0.0, 0.0, 0.0
     system = System()
-    cube = 50
+    infer = 'infer' in request.params
+    limit = 10
+    if 'limit' in request.params:
+        try:
+            limit = min(abs(int(request.params['limit'])), 100)
+        except ValueError:
+            return exc.HTTPBadRequest('Malformed request data.')
     if 'systemid64' in request.params:
         try:
             system = request.dbsession.query(System).filter(System.id64 == request.params['systemid64']).one()
@@ -190,38 +337,69 @@ def nearest_scoopable(request):
         if len(request.params['name']) < 3:
             return exc.HTTPBadRequest('Search term too short (Minimum 3 characters)')
         try:
-            system = request.dbsession.query(System).filter(System.name.ilike(request.params['name'])).one()
+            system = request.dbsession.query(System).filter(func.lower(System.name) == request.params['name'].lower()).one()
             x, y, z = system.coords['x'], system.coords['y'], system.coords['z']
         except NoResultFound:
-            return exc.HTTPBadRequest('System not found.')
+            estimate = pgnames.get_system(request.params['name']) if infer else None
+            if not estimate:
+                return exc.HTTPBadRequest('System not found.')
+            system = System(name=request.params['name'])
+            x, y, z = estimate['coords']['x'], estimate['coords']['y'], estimate['coords']['z']
         except MultipleResultsFound:
             return exc.HTTPServerError('Multiple rows matching system name found. This should not happen.')
     else:
         return exc.HTTPBadRequest('Missing required parameter (name or systemid64)')
 
-    for star in request.dbsession.query(Star).filter(Star.systemId64 == system.id64):
-        if star.isScoopable:
-            # Silly wabbit, you are scoopable.
-            return {'meta': {'name': system.name, 'type': 'nearest_scoopable'},
-                    'data': {'distance': 0.0, 'name': system.name, 'id64': system.id64}}
-    try:
-        candidate = request.dbsession.query(System).from_statement(
-            text(f"SELECT *, (sqrt((cast(systems.coords->>'x' AS FLOAT) - {x}"
-                 f")^2 + (cast(systems.coords->>'y' AS FLOAT) - {y}"
-                 f")^2 + (cast(systems.coords->>'z' AS FLOAT) - {z}"
-                 f")^2)) AS Distance FROM systems JOIN stars ON systems.id64 = stars.\"systemId64\""
-                 f" WHERE cast(systems.coords->>'x' AS FLOAT) BETWEEN {str(float(x)-cube)} AND {str(float(x)+cube)}"
-                 f" AND cast(systems.coords->>'y' AS FLOAT) BETWEEN {str(float(y)-cube)} AND {str(float(y)+cube)}"
-                 f" AND cast(systems.coords->>'z' as FLOAT)"
-                 f" BETWEEN {str(float(z)-cube)} AND {str(float(z)+cube)} order by Distance LIMIT 1")).one()
-        a = numpy.array((x, y, z))
-        b = numpy.array((candidate.coords['x'], candidate.coords['y'], candidate.coords['z']))
-        dist = numpy.linalg.norm(a - b)
-
-        return {'meta': {'name': system.name, 'type': 'nearest_scoopable'},
-                'data': {'distance': dist, 'name': candidate.name, 'id64': candidate.id64}}
-    except NoResultFound:
-        return {'meta': {'name': system.name, 'type': 'nearest_scoopable'},
+    if system.id64 is not None and request.dbsession.query(ScoopableSystem.id64).\
+            filter(ScoopableSystem.id64 == system.id64).scalar():
+        # Silly wabbit, you are scoopable.
+        result = {'distance': 0.0, 'name': system.name, 'id64': system.id64}
+        if infer:
+            result['inferred'] = False
+            return {'meta': {'name': system.name, 'type': 'nearest_scoopable'}, 'data': [result]}
+        return {'meta': {'name': system.name, 'type': 'nearest_scoopable'}, 'data': result}
+    max_radius = get_max_radius(request)
+    if max_radius is None:
+        return exc.HTTPBadRequest('Malformed request data.')
+    if infer:
+        return infer_scoopable(request, system, x, y, z, limit, max_radius)
+    candidate, radius = expanding_search(request, nearest_scoopable_sql, x, y, z, max_radius=max_radius,
+                                         model=ScoopableSystem)
+    if not candidate:
+        return {'meta': {'name': system.name, 'type': 'nearest_scoopable', 'radius': radius},
                 'error': 'No scoopable systems found.'}
-    except MultipleResultsFound:
-        return exc.HTTPServerError('Multiple results from a query that should return only one hit. This is Wrong.')
+    scoopable, dist = candidate[0]
+    return {'meta': {'name': system.name, 'type': 'nearest_scoopable', 'radius': radius},
+            'data': {'distance': dist, 'name': scoopable.name, 'id64': scoopable.id64}}
+
+
+def infer_scoopable(request, system, x, y, z, limit, max_radius):
+    """
+    Ranks known scoopable systems together with nearby PG boxels that probably hold a scoopable star.
+    Boxels are only enumerated out to the nearest.pg_radius setting, and boxels that already hold a
+    known candidate are left out.
+    :param request: The Pyramid request object
+    :param system: The System searched from; may be unsaved if its position was inferred
+    :param x: X coordinate
+    :param y: Y coordinate
+    :param z: Z coordinate
+    :param limit: Number of candidates to return
+    :param max_radius: Largest radius to search for known systems, in ly
+    :return: A JSON response
+    """
+    candidate, radius = expanding_search(request, nearest_scoopable_sql, x, y, z, k=limit, max_radius=max_radius,
+                                         model=ScoopableSystem)
+    results = [{'distance': dist, 'name': scoopable.name, 'id64': scoopable.id64, 'inferred': False}
+               for scoopable, dist in candidate]
+    known_boxels = {pgboxels.get_boxel_name(result['name']) for result in results if result['name']}
+    pg_radius = min(float(request.registry.settings.get('nearest.pg_radius', 100)), max_radius)
+    for dist, boxel in pgboxels.boxels_near((x, y, z), pg_radius):
+        if boxel.name in known_boxels:
+            continue
+        results.append({'distance': dist, 'name': boxel.name, 'mass_code': boxel.mass_code,
+                        'coords': {'x': boxel.x, 'y': boxel.y, 'z': boxel.z},
+                        'uncertainty': boxel.uncertainty, 'inferred': True})
+    results.sort(key=lambda result: result['distance'])
+    return {'meta': {'name': system.name, 'type': 'nearest_scoopable', 'radius': radius,
+                     'inferred_origin': system.id64 is None},
+            'data': results[:limit]}
@@ -0,0 +1,163 @@
+import json
+
+from pyramid.response import Response
+from pyramid.view import (
+    view_config,
+    view_defaults
+)
+from sqlalchemy import text
+import pyramid.httpexceptions as exc
+
+# Both queries are answered from the GiST cube index on systems, which only covers systems with coordinates;
+# the radius query trims the cube's corners.
+systems_in_radius_sql = """
+    SELECT id64, name, x, y, z, cube(array[x, y, z]) <-> cube(array[:x, :y, :z]) AS distance
+    FROM systems
+    WHERE x IS NOT NULL
+      AND cube(array[x, y, z]) <@ cube(array[:x - :radius, :y - :radius, :z - :radius],
+                                           array[:x + :radius, :y + :radius, :z + :radius])
+      AND cube(array[x, y, z]) <-> cube(array[:x, :y, :z]) <= :radius
+"""
+
+systems_in_box_sql = """
+    SELECT id64, name, x, y, z
+    FROM systems
+    WHERE x IS NOT NULL
+      AND cube(array[x, y, z]) <@ cube(array[:xmin, :ymin, :zmin], array[:xmax, :ymax, :zmax])
+"""
+
+
+def get_float_params(request, names):
+    """
+    Reads a set of required float parameters.
+    :param request: The Pyramid request object
+    :param names: The parameter names
+    :return: A dict of parameter values, or None if any are missing or malformed
+    """
+    try:
+        return {name: float(request.params[name]) for name in names}
+    except (KeyError, ValueError):
+        return None
+
+
+def get_limit(request):
+    """
+    Reads the optional limit parameter.
+    :param request: The Pyramid request object
+    :return: The limit, 0 for no limit, or None if malformed
+    """
+    try:
+        return abs(int(request.params.get('limit', 0)))
+    except ValueError:
+        return None
+
+
+class SystemRows(object):
+    """
+    WSGI app_iter encoding the rows of a streaming query as NDJSON. The server calls close() once the
+    response is done with, whether or not the body was read (HEAD requests, clients that went away), which
+    returns the connection to the pool.
+    """
+
+    def __init__(self, conn, result, fetch_size):
+        """
+        :param conn: The connection the query runs on, owned by this object from now on
+        :param result: The query's result, with id64, name, x, y, z and optionally distance columns
+        :param fetch_size: Number of rows fetched at a time
+        """
+        self.conn = conn
+        self.result = result
+        self.fetch_size = fetch_size
+        self.has_distance = 'distance' in result.keys()
+
+    def __iter__(self):
+        while True:
+            batch = self.result.fetchmany(self.fetch_size)
+            if not batch:
+                break
+            lines = []
+            for row in batch:
+                system = {'id64': row.id64, 'name': row.name, 'coords': {'x': row.x, 'y': row.y, 'z': row.z}}
+                if self.has_distance:
+                    system['distance'] = row.distance
+                lines.append(json.dumps(system))
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def close(self):
+        self.conn.close()
+
+
+def stream_systems(request, sql, params):
+    """
+    Runs a query on a dedicated connection with a server-side cursor, and streams the rows as NDJSON.
+    The query runs before returning, so errors are still reported normally; rows are only fetched as the
+    client reads them, so large result sets never sit in memory.
+    :param request: The Pyramid request object
+    :param sql: Query text returning id64, name, x, y, z and optionally distance columns
+    :param params: The query parameters
+    :return: A streaming Response
+    """
+    fetch_size = int(request.registry.settings.get('spatial.fetch_size', 1000))
+    # The request's session is committed and closed before the response body is sent, so stream
+    # from a connection of our own.
+    conn = request.dbsession.get_bind().connect()
+    try:
+        result = conn.execution_options(stream_results=True).execute(text(sql), params)
+    except Exception:
+        conn.close()
+        raise
+    return Response(app_iter=SystemRows(conn, result, fetch_size), content_type='application/x-ndjson',
+                    charset='utf-8')
+
+
+@view_defaults(renderer='../templates/mytemplate.jinja2')
+@view_config(route_name='systems_in_radius')
+def systems_in_radius(request):
+    """
+    Streams all known systems within a radius of a position as newline delimited JSON, one system
+    per line. Add sort to get them nearest first, and limit to cap the number returned.
+    :param request: The Pyramid request object
+    :return: A streaming NDJSON response
+    """
+    params = get_float_params(request, ['x', 'y', 'z', 'radius'])
+    if params is None:
+        return exc.HTTPBadRequest('Missing or malformed x, y, z or radius parameter.')
+    max_radius = float(request.registry.settings.get('spatial.max_query_radius', 1000))
+    if not 0 < params['radius'] <= max_radius:
+        return exc.HTTPBadRequest(f'Radius must be above 0 and at most {max_radius} ly.')
+    limit = get_limit(request)
+    if limit is None:
+        return exc.HTTPBadRequest('Malformed limit parameter.')
+    sql = systems_in_radius_sql
+    if 'sort' in request.params:
+        sql += " ORDER BY distance"
+    if limit:
+        sql += " LIMIT :limit"
+        params['limit'] = limit
+    return stream_systems(request, sql, params)
+
+
+@view_defaults(renderer='../templates/mytemplate.jinja2')
+@view_config(route_name='systems_in_box')
+def systems_in_box(request):
+    """
+    Streams all known systems inside an axis-aligned box as newline delimited JSON, one system per line.
+    The box is given by xmin, xmax, ymin, ymax, zmin and zmax. Add limit to cap the number returned.
+    :param request: The Pyramid request object
+    :return: A streaming NDJSON response
+    """
+    params = get_float_params(request, ['xmin', 'xmax', 'ymin', 'ymax', 'zmin', 'zmax'])
+    if params is None:
+        return exc.HTTPBadRequest('Missing or malformed box bounds.')
+    max_side = 2 * float(request.registry.settings.get('spatial.max_query_radius', 1000))
+    for axis in 'xyz':
+        if not 0 <= params[f'{axis}max'] - params[f'{axis}min'] <= max_side:
+            return exc.HTTPBadRequest(f'Box sides must be at most {max_side} ly, with min below max.')
+    limit = get_limit(request)
+    if limit is None:
+        return exc.HTTPBadRequest('Malformed limit parameter.')
+    sql = systems_in_box_sql
+    if limit:
+        sql += " LIMIT :limit"
+        params['limit'] = limit
+    return stream_systems(request, sql, params)
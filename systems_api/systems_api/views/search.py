@@ -1,22 +1,96 @@
+import base64
+import json
+
 from pyramid.view import (
     view_config,
     view_defaults
 )
 
-from sqlalchemy import text, func
+from sqlalchemy import func
 from ..models import System, PopulatedSystem, Permits
-from ..utils.util import checkpermitname
+from ..utils.prepared import PreparedStatement
+from ..utils.trigram import modes, get_trigram_options, prepare_trigram_search
+from ..utils.util import checkpermitname, like_prefix
 import pyramid.httpexceptions as exc
 from urllib.parse import unquote
 
-valid_searches = {"lev", "soundex", "meta", "dmeta", "fulltext"}
+valid_searches = {"lev", "soundex", "meta", "dmeta", "fulltext", "trigram"}
+
+
+
+def search_statements(searchtype, where, params, score="similarity(name, :name)"):
+    """
+    Builds the prepared statements for a search type. Results are ordered by (similarity, name, id64),
+    which is unique, so a page can continue right after the last row of the previous one.
+    :param searchtype: The search type
+    :param where: Condition matching the candidate systems
+    :param params: List of (parameter name, Postgres type) tuples used by the condition, besides name and limit
+    :param score: Expression results are ranked by, returned as the similarity column
+    :return: A tuple of statements for the first page and for the pages after a cursor
+    """
+    params = [('name', 'text'), ('limit', 'integer')] + params
+    select = f"SELECT name, id64, {score} AS similarity FROM systems WHERE {where}"
+    order = " ORDER BY similarity DESC, name, id64 LIMIT :limit"
+    first = PreparedStatement(f'search_{searchtype}', select + order, params)
+    after = PreparedStatement(
+        f'search_{searchtype}_after',
+        f"SELECT * FROM ({select}) AS matches WHERE similarity < :after_similarity "
+        f"OR (similarity = :after_similarity AND (name, id64) > (:after_name, :after_id64))" + order,
+        params + [('after_similarity', 'real'), ('after_name', 'text'), ('after_id64', 'bigint')])
+    return first, after
+
+
+# Every search type, as prepared statements so Postgres plans them once per connection.
+statements = {
+    'lev': search_statements('lev', "lower(name) LIKE :pattern", [('pattern', 'text')]),
+    'soundex': search_statements('soundex', "name_soundex = soundex(:name)", []),
+    'meta': search_statements('meta', "metaphone(name, :sensitivity) = metaphone(:name, :sensitivity)",
+                              [('sensitivity', 'integer')]),
+    'dmeta': search_statements('dmeta', "name_dmetaphone = dmetaphone(:name)", []),
+    'fulltext': search_statements('fulltext', "name LIKE :pattern", [('pattern', 'text')]),
+}
+# Trigram searches match by an operator whose threshold is set per transaction, one pair of statements per mode.
+for mode, trigram_mode in modes.items():
+    statements[f'trigram_{mode}'] = search_statements(f'trigram_{mode}', trigram_mode.condition, [],
+                                                      trigram_mode.score)
+
+
+def encode_cursor(row, threshold=None):
+    """
+    Makes the continuation token for the page after a row.
+    :param row: The last row of a page
+    :param threshold: The trigram threshold the page was searched with, so later pages use the same one
+    :return: An opaque, URL safe token
+    """
+    position = [row.similarity, row.name, row.id64]
+    if threshold is not None:
+        position.append(threshold)
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Reads a continuation token made by encode_cursor.
+    :param cursor: The token
+    :return: A dict of the after_ statement parameters and the threshold if any, or None if the token is malformed
+    """
+    try:
+        similarity, name, id64, *threshold = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        position = {'after_similarity': float(similarity), 'after_name': str(name), 'after_id64': int(id64)}
+        if threshold:
+            position['threshold'] = float(threshold[0])
+        return position
+    except (ValueError, TypeError, UnicodeError):
+        return None
 
 
 @view_defaults(renderer='../templates/mytemplate.jinja2')
 @view_config(route_name='search', renderer='json')
 def search(request):
     """
-    Multi-purpose search endpoint, taking various search types.
+    Multi-purpose search endpoint, taking various search types. Results come in pages of up to limit
+    systems; when there may be more, meta.next holds a cursor to pass back for the next page. The trigram
+    type takes mode (similarity, word or strict_word), threshold and adaptive parameters.
     :param request: The Pyramid request object
     :return: A JSON response
     """
@@ -28,7 +102,6 @@ def search(request):
     else:
         searchtype = 'lev'
     if 'term' in request.params:
-        xhr = True
         request.response.headers.update({
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'POST,GET,DELETE,PUT,OPTIONS',
@@ -39,29 +112,32 @@ def search(request):
         name = unquote(request.params['term']).upper()
         searchtype = "lev"
     else:
-        xhr = False
         if 'name' not in request.params:
             return exc.HTTPBadRequest(detail="No name in search request.")
         name = unquote(request.params['name'])
     if 'limit' not in request.params:
         limit = 20
     else:
-        if int(request.params['limit']) > 200:
+        try:
+            limit = int(request.params['limit'])
+        except ValueError:
+            return exc.HTTPBadRequest(detail="Malformed limit parameter.")
+        if limit > 200:
             return exc.HTTPBadRequest(detail="Limit too high (Over 200)")
-        limit = int(request.params['limit'])
+        if limit < 1:
+            return exc.HTTPBadRequest(detail="Limit must be at least 1.")
     if len('name') < 3:
         return exc.HTTPBadRequest(detail="Name too short.")
 
     permsystems = request.dbsession.query(Permits)
     perm_systems = []
     candidates = []
-    result = None
     for system in permsystems:
         perm_systems.append(system.id64)
     # Ensure we're not wasting cycles on someone searching an exact system name on this endpoint.
     # func.similarity(System.name, name).label('similarity'))
     match = request.dbsession.query(System, func.similarity(System.name, name).label('similarity')). \
-        filter(System.name.ilike(name)).order_by(func.similarity(System.name, name).desc()).limit(1)
+        filter(func.lower(System.name) == name.lower()).order_by(func.similarity(System.name, name).desc()).limit(1)
     for candidate in match:
         candidates.append({'name': candidate[0].name, 'similarity': 1,
                            'id64': candidate[0].id64,
@@ -73,45 +149,58 @@ def search(request):
     if len(name) < 3:
         return exc.HTTPBadRequest(detail="Search term too short (Minimum 3 characters)")
 
+    values = {'name': name, 'limit': limit}
     if searchtype == 'lev':
-        result = request.dbsession.query(System, func.similarity(System.name, name).label('similarity')). \
-            filter(System.name.ilike(f"{name}%")).order_by(func.similarity(System.name, name).desc()).limit(limit)
-        for row in result:
-            candidates.append({'name': row[0].name, 'similarity': row[1], 'id64': row[0].id64,
-                               'permit_required': True if row[0].id64 in perm_systems else False,
-                               'permit_name': checkpermitname(row[0].id64, permsystems, perm_systems)
-                               })
-        return {'meta': {'name': name, 'type': searchtype, 'limit': limit}, 'data': candidates}
-
-    if searchtype == 'soundex':
-        sql = text(f"SELECT *, similarity(name, '{name}') AS similarity FROM systems "
-                   f"WHERE soundex(name) = soundex('{name}') ORDER BY "
-                   f"similarity(name, '{name}') DESC LIMIT {limit}")
-    if searchtype == 'meta':
-        if 'sensitivity' not in request.params:
-            sensitivity = 5
-        else:
-            sensitivity = request.params['sensitivity']
-        sql = text(f"SELECT *, similarity(name,  {name}) AS similarity FROM systems "
-                   f"WHERE metaphone(name, '{str(sensitivity)}') = metaphone('{name}', "
-                   f"'{str(sensitivity)}') ORDER BY similarity DESC LIMIT {str(limit)}")
-    if searchtype == 'dmeta':
-        sql = text(f"SELECT *, similarity(name, '{name}') AS similarity FROM systems "
-                   f"WHERE dmetaphone(name) = dmetaphone('{name}') ORDER BY similarity DESC LIMIT {str(limit)}")
-    if searchtype == "fulltext":
-        sql = text(f"SELECT name, id64, similarity(name, '{name}') AS similarity FROM systems "
-                   f"WHERE name LIKE '{name}%' ORDER BY similarity DESC LIMIT {str(limit)}")
-    if not result:
-        # We haven't gotten a ORM result yet, execute manual SQL.
-        result = request.dbsession.execute(sql)
-    if xhr:
-        for row in result:
-            candidates.append({row['name']})
-        return candidates
-    else:
-        for row in result:
-            candidates.append({'name': row['name'], 'similarity': row['similarity'], 'id64': row['id64'],
-                               'permit_required': True if row.id64 in perm_systems else False,
-                               'permit_name': checkpermitname(row.id64, permsystems, perm_systems)
-                               })
-        return {'meta': {'name': name, 'type': searchtype, 'limit': limit}, 'data': candidates}
+        values['pattern'] = like_prefix(name.lower())
+    elif searchtype == 'fulltext':
+        values['pattern'] = like_prefix(name)
+    elif searchtype == 'meta':
+        try:
+            values['sensitivity'] = int(request.params.get('sensitivity', 5))
+        except ValueError:
+            return exc.HTTPBadRequest(detail="Malformed sensitivity parameter.")
+    trigram = None
+    if searchtype == 'trigram':
+        try:
+            trigram = get_trigram_options(request)
+        except ValueError as e:
+            return exc.HTTPBadRequest(detail=str(e))
+    first, after = statements[f'trigram_{trigram.mode}' if trigram else searchtype]
+    if 'cursor' in request.params:
+        cursor = decode_cursor(request.params['cursor'])
+        if cursor is None:
+            return exc.HTTPBadRequest(detail="Malformed cursor.")
+        if trigram and 'threshold' in cursor:
+            # Later pages keep the threshold of the first, which adaptive mode may have raised.
+            trigram = trigram._replace(threshold=cursor['threshold'], adaptive=False)
+        cursor.pop('threshold', None)
+        values.update(cursor)
+
+    threshold = None
+    with request.registry['search_latency'].time(searchtype):
+        if trigram:
+            threshold = prepare_trigram_search(request.dbsession, name, trigram)
+        statement = after if 'cursor' in request.params else first
+        rows = statement.execute(request.dbsession, **values).fetchall()
+    for row in rows:
+        candidates.append({'name': row['name'], 'similarity': row['similarity'], 'id64': row['id64'],
+                           'permit_required': True if row.id64 in perm_systems else False,
+                           'permit_name': checkpermitname(row.id64, permsystems, perm_systems)
+                           })
+    meta = {'name': name, 'type': searchtype, 'limit': limit}
+    if trigram:
+        meta.update({'mode': trigram.mode, 'threshold': threshold})
+    if len(rows) == limit:
+        meta['next'] = encode_cursor(rows[-1], threshold)
+    return {'meta': meta, 'data': candidates}
+
+
+@view_defaults(renderer='../templates/mytemplate.jinja2')
+@view_config(route_name='search_stats', renderer='json')
+def search_stats(request):
+    """
+    Reports this worker's search latency histograms, per search type.
+    :param request: The Pyramid request object
+    :return: A JSON response
+    """
+    return {'meta': {'type': 'search_stats'}, 'data': request.registry['search_latency'].stats()}
@@ -8,6 +8,8 @@ from pyramid.response import Response
 from sqlalchemy import text
 
 from ..models import System
+from ..utils.prefixindex import get_typeahead_index
+from ..utils.util import like_prefix
 import pyramid.httpexceptions as exc
 
 
@@ -33,6 +35,10 @@ def search(request):
     if len(name) < 3:
         return exc.HTTPBadRequest(detail="Typeahead term too short (Minimum 3 characters)")
 
+    index = get_typeahead_index(request)
+    if index is not None:
+        return index.complete(name, 10)
+
     query = text("""
                  SET LOCAL work_mem = '100MB';
                  SET LOCAL statement_timeout = 5000ms;
@@ -40,13 +46,13 @@ def search(request):
                  SET LOCAL max_parallel_workers_per_gather = 4;
                  SELECT name
                  FROM systems
-                 WHERE lower(name) LIKE lower(:prefix)
+                 WHERE lower(name) LIKE :prefix
                  ORDER BY name <-> :term DESC
                      LIMIT 10
                  """)
 
     result = request.dbsession.execute(query, {
-        "prefix": f"{name}%",
+        "prefix": like_prefix(name),
         "term": name})
 
     candidates = [row[0] for row in result]